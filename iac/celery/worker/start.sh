@@ -8,4 +8,14 @@ set -o nounset
 # the celery beat process find the apps' modules and settings
 export PYTHONPATH=/app/martini:${PYTHONPATH:-}
 
-celery -A config.celery:celery worker -l info --pool=solo
+# The queues consumed, the pool and its size can be set per worker, e.g. to run
+# the CPU-bound stages of document processing on solo workers, which can extract large documents
+# with a pool of processes, and the I/O-bound ones on a pool of many threads (see MARTINI_INGESTION_*_QUEUE).
+CELERY_WORKER_QUEUES=${CELERY_WORKER_QUEUES:-celery,ingestion-cpu,ingestion-io}
+CELERY_WORKER_POOL=${CELERY_WORKER_POOL:-solo}
+
+if [ -n "${CELERY_WORKER_CONCURRENCY:-}" ]; then
+    exec celery -A config.celery:celery worker -l info -Q "$CELERY_WORKER_QUEUES" \
+        --pool="$CELERY_WORKER_POOL" --concurrency="$CELERY_WORKER_CONCURRENCY"
+fi
+exec celery -A config.celery:celery worker -l info -Q "$CELERY_WORKER_QUEUES" --pool="$CELERY_WORKER_POOL"
@@ -0,0 +1,116 @@
+import logging
+
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+import tiktoken
+
+from django.conf import settings
+
+from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+# Shorter common prefixes/suffixes of adjacent chunks are not considered an overlap.
+MIN_OVERLAP = 3
+# A passage is not truncated to fit the remaining budget below this number of tokens.
+MIN_TRUNCATED_TOKENS = 32
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    '''
+    Return the tokenizer of a model, cl100k_base if the model is unknown to tiktoken.
+    '''
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def overlap_length(previous: str, following: str, max_overlap: int) -> int:
+    '''
+    Length of the longest suffix of `previous` that `following` starts with, up to `max_overlap` characters.
+    '''
+    for length in range(min(len(previous), len(following), max_overlap), MIN_OVERLAP - 1, -1):
+        if previous.endswith(following[:length]):
+            return length
+    return 0
+
+
+def merge_adjacent_chunks(scored_docs: Iterable[Tuple[Document, float]]) -> List[Tuple[Document, float]]:
+    '''
+    Merge chunks following each other in the same document into passages, without the text they overlap by.
+    A passage has the score of its best chunk, and the metadata of its first chunk along with
+    the indexes of all its chunks. Chunks without position metadata are left as is.
+    '''
+    max_overlap = settings.MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_OVERLAP
+    passages = []
+    documents = {}
+    for doc, score in scored_docs:
+        if doc.metadata.get('instance_id') is None or doc.metadata.get('chunk') is None:
+            passages.append((doc, score))
+            continue
+        key = (doc.metadata.get('collection'), doc.metadata['instance_id'])
+        documents.setdefault(key, {})[doc.metadata['chunk']] = (doc, score)
+
+    for chunks in documents.values():
+        passage = None
+        for index in sorted(chunks):
+            doc, score = chunks[index]
+            if passage is not None and index == passage['chunks'][-1] + 1:
+                overlap = overlap_length(passage['text'], doc.page_content, max_overlap)
+                separator = '' if overlap else '\n'
+                passage['text'] += separator + doc.page_content[overlap:]
+                passage['score'] = max(passage['score'], score)
+                passage['chunks'].append(index)
+                continue
+            if passage is not None:
+                passages.append(_passage_document(passage))
+            passage = {'text': doc.page_content, 'score': score, 'metadata': doc.metadata, 'chunks': [index]}
+        passages.append(_passage_document(passage))
+    return passages
+
+
+def _passage_document(passage: dict) -> Tuple[Document, float]:
+    return (
+        Document(
+            page_content=passage['text'],
+            metadata={**passage['metadata'], 'chunks': passage['chunks']},
+        ),
+        passage['score'],
+    )
+
+
+def pack_context(
+    scored_docs: Iterable[Tuple[Document, float]],
+    model_name: str,
+    token_budget: int = None,
+) -> List[Document]:
+    '''
+    Assemble the context of a question from the retrieved chunks, within a budget of tokens of the LLM:
+    adjacent chunks of a document are merged into passages, which are then included by decreasing score
+    as long as they fit in `token_budget` tokens (MARTINI_CONTEXT_TOKEN_BUDGET by default).
+    The passage exceeding the budget is truncated to fit, unless too little of it would remain.
+    '''
+    token_budget = token_budget or settings.MARTINI_CONTEXT_TOKEN_BUDGET
+    encoding = get_encoding(model_name)
+    passages = sorted(merge_adjacent_chunks(scored_docs), key=lambda scored_doc: scored_doc[1], reverse=True)
+
+    packed = []
+    used_tokens = 0
+    for doc, _ in passages:
+        remaining_tokens = token_budget - used_tokens
+        tokens = encoding.encode(doc.page_content, disallowed_special=())
+        if len(tokens) > remaining_tokens:
+            if remaining_tokens >= MIN_TRUNCATED_TOKENS:
+                doc.page_content = encoding.decode(tokens[:remaining_tokens])
+                doc.metadata['truncated'] = True
+                packed.append(doc)
+                used_tokens += remaining_tokens
+            break
+        packed.append(doc)
+        used_tokens += len(tokens)
+
+    logger.debug(f'Packed {len(packed)} of {len(passages)} passages in the context, {used_tokens}/{token_budget} tokens')
+    return packed
@@ -0,0 +1,174 @@
+import os
+import re
+import asyncio
+import hashlib
+
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from langchain.embeddings.base import Embeddings
+
+from apps.chats.embeddings import normalize_vectors
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+class HashingEmbeddings(Embeddings):
+    '''
+    Local embedding model hashing the words of texts into `dimension` features (the "hashing trick").
+    Deterministic, instantaneous and free, but it only captures the words texts have in common:
+    meant for tests and development, not for answering questions.
+    '''
+
+    def __init__(self, dimension: int):
+        self.dimension = dimension
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            for token in TOKEN_PATTERN.findall(text.lower()):
+                value = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+                rows.append(row)
+                columns.append(value % self.dimension)
+                # The sign is taken from another bit of the hash, so that collisions tend to cancel out.
+                signs.append(1.0 if value >> 63 else -1.0)
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        np.add.at(vectors, (rows, columns), signs)
+        return normalize_vectors(vectors)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return self.embed_query(text)
+
+
+class OnnxEmbeddings(Embeddings):
+    '''
+    Local embedding model, running a sentence-transformers model exported to ONNX (e.g. all-MiniLM-L6-v2)
+    on the CPU of the worker. Texts are tokenized and embedded by batches of `batch_size`,
+    the embeddings of their tokens mean-pooled and normalized.
+    Requires the optional onnxruntime and tokenizers packages.
+    '''
+
+    def __init__(
+        self,
+        model_path: str,
+        tokenizer_path: str,
+        batch_size: int = 32,
+        threads: int = None,
+        max_length: int = 256,
+    ):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImproperlyConfigured(
+                'The "onnx" embedding backend requires the onnxruntime and tokenizers packages.'
+            ) from e
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        # The dimension of the vectors is the size of the last axis of the output of the model.
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.batch_size = batch_size
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {
+            'input_ids': np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            'attention_mask': attention_mask,
+        }
+        if 'token_type_ids' in self.input_names:
+            inputs['token_type_ids'] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = attention_mask[..., np.newaxis].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return normalize_vectors(pooled)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return np.concatenate([
+            self._embed_batch(texts[start:start + self.batch_size])
+            for start in range(0, len(texts), self.batch_size)
+        ]).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0].tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # Inference is CPU-bound: run it in a thread, not to block the event loop.
+        return await asyncio.to_thread(self.embed_query, text)
+
+
+def _openai() -> Tuple[Embeddings, str, int]:
+    from langchain.embeddings import OpenAIEmbeddings
+
+    # In OpenAI's embedding model, <|endoftext|> is a special token that indicates the end of a document in OpenAI's embeddings.
+    # We need to set this as `allowed_special` here for tiktoken to parse it without error.
+    embeddings = OpenAIEmbeddings(
+        openai_api_key=os.environ.get('OPENAI_API_KEY'),
+        allowed_special={'<|endoftext|>'}
+    )
+    return embeddings, embeddings.model, int(os.environ.get('EMBEDDINGS_DIMENSION_OPENAI') or 1536)
+
+
+def _onnx() -> Tuple[Embeddings, str, int]:
+    if not settings.MARTINI_ONNX_EMBEDDING_MODEL_PATH or not settings.MARTINI_ONNX_EMBEDDING_TOKENIZER_PATH:
+        raise ImproperlyConfigured(
+            'The "onnx" embedding backend requires MARTINI_ONNX_EMBEDDING_MODEL_PATH '
+            'and MARTINI_ONNX_EMBEDDING_TOKENIZER_PATH.'
+        )
+    embeddings = OnnxEmbeddings(
+        settings.MARTINI_ONNX_EMBEDDING_MODEL_PATH,
+        settings.MARTINI_ONNX_EMBEDDING_TOKENIZER_PATH,
+        batch_size=settings.MARTINI_ONNX_EMBEDDING_BATCH_SIZE,
+        threads=settings.MARTINI_ONNX_EMBEDDING_THREADS,
+    )
+    model_name = settings.MARTINI_ONNX_EMBEDDING_MODEL_NAME or os.path.basename(
+        os.path.dirname(os.path.abspath(settings.MARTINI_ONNX_EMBEDDING_MODEL_PATH))
+    )
+    return embeddings, f'onnx-{model_name}', embeddings.dimension
+
+
+def _hashing() -> Tuple[Embeddings, str, int]:
+    dimension = settings.MARTINI_HASHING_EMBEDDING_DIMENSION
+    return HashingEmbeddings(dimension), f'hashing-{dimension}', dimension
+
+
+# Embedding backends a DocumentCollection can use, by name.
+# Each returns the embedding model, its name (used in cache keys) and the dimension of its vectors.
+EMBEDDING_BACKENDS: Dict[str, Callable[[], Tuple[Embeddings, str, int]]] = {
+    'openai': _openai,
+    'onnx': _onnx,
+    'hashing': _hashing,
+}
+
+
+def create_embeddings(backend: str) -> Tuple[Embeddings, str, int]:
+    '''
+    Create the embedding model of a backend of EMBEDDING_BACKENDS.
+    Raises ImproperlyConfigured if the backend is unknown, or cannot be used.
+    '''
+    try:
+        factory = EMBEDDING_BACKENDS[backend]
+    except KeyError:
+        raise ImproperlyConfigured(f'Unknown embedding backend "{backend}".')
+    return factory()
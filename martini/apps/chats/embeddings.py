@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import threading
+
+from typing import List
+
+import numpy as np
+
+from langchain.embeddings.base import Embeddings
+
+from config.cache import TwoTierCache
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    '''
+    Normalize a text before hashing it, so that texts differing only by whitespace
+    share the same cache entries.
+    '''
+    return ' '.join(text.split())
+
+
+def normalize_query(text: str) -> str:
+    '''
+    Normalize a query before hashing it: questions differing only by case or whitespace
+    share the same cache entries.
+    '''
+    return normalize_text(text).casefold()
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    '''
+    Scale vectors (along the last axis) to unit length, so that their dot products are their cosine similarities.
+    Null vectors are left as they are.
+    '''
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class CacheStats:
+    '''
+    Thread-safe hit/miss counters of a cache.
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hits: int, misses: int):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return f'{self.hits} hits, {self.misses} misses ({self.hit_ratio:.0%} hit ratio)'
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Content-addressed cache in front of an embedding model.
+    Embeddings are keyed by the SHA-256 of the normalized text, the name of the model
+    and the dimension of its vectors, so that a chunk is only ever sent to the model once.
+    Queries are cached separately, in `query_cache` if specified.
+    '''
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        dimension: int,
+        cache: TwoTierCache,
+        query_cache: TwoTierCache = None,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.dimension = dimension
+        self.cache = cache
+        self.query_cache = query_cache
+        self.stats = CacheStats()
+
+    def tracked(self) -> 'CachedEmbeddings':
+        '''
+        Return a copy of this model sharing its cache, but with its own statistics,
+        e.g. to measure the cache hit ratio of a single document.
+        '''
+        return CachedEmbeddings(
+            self.embeddings,
+            self.model_name,
+            self.dimension,
+            self.cache,
+            self.query_cache,
+        )
+
+    def cache_key(self, text: str) -> str:
+        digest = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+        return f'{self.model_name}:{self.dimension}:{digest}'
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.cache_key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # Only send texts missing from the cache to the model, once each.
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(missing.keys(), vectors)
+            }
+            self.cache.set_many(computed)
+            cached.update(computed)
+
+        self.stats.record(hits=len(texts) - len(missing), misses=len(missing))
+        return [cached[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.query_cache is None:
+            return self.embeddings.embed_query(text)
+
+        key = self.cache_key(normalize_query(text))
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+            self.query_cache.set(key, vector)
+        return vector.tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.query_cache is None:
+            return await self.embeddings.aembed_query(text)
+
+        key = self.cache_key(normalize_query(text))
+        vector = await self.query_cache.aget(key)
+        if vector is None:
+            vector = np.asarray(await self.embeddings.aembed_query(text), dtype=np.float32)
+            await self.query_cache.aset(key, vector)
+        return vector.tolist()
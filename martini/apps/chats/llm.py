@@ -1,30 +1,98 @@
 import os
+import json
+import threading
+
+import numpy as np
 
 from django.conf import settings
 
 from langchain.llms import OpenAI
 from langchain.chains.question_answering import load_qa_chain
-from langchain.embeddings import OpenAIEmbeddings
 
 from apps.documents.vectorstore import get_vectorstore_for_chains
+from apps.chats.embeddings import CachedEmbeddings
+from apps.chats.embedding_backends import create_embeddings
+from config.cache import LRUCache, RedisCache, TwoTierCache
 
 _llm = OpenAI(temperature=0, openai_api_key=os.environ.get('OPENAI_API_KEY'))
 
-# In OpenAI's embedding model, <|endoftext|> is a special token that indicates the end of a document in OpenAI's embeddings.
-# We need to set this as `allowed_special` here for tiktoken to parse it without error.
-_embeddings = OpenAIEmbeddings(
-    openai_api_key=os.environ.get('OPENAI_API_KEY'),
-    allowed_special={'<|endoftext|>'}
+# Embeddings are cached in-process, and in Redis to be shared between workers if configured.
+_embeddings_cache = TwoTierCache(
+    local=LRUCache(maxsize=settings.MARTINI_EMBEDDING_CACHE_LOCAL_SIZE),
+    shared=RedisCache(
+        url=settings.MARTINI_CACHE_REDIS_URL,
+        namespace='martini:embeddings',
+        max_entries=settings.MARTINI_EMBEDDING_CACHE_SHARED_SIZE,
+        dumps=lambda vector: vector.tobytes(),
+        loads=lambda value: np.frombuffer(value, dtype=np.float32),
+    ) if settings.MARTINI_CACHE_REDIS_URL else None,
+)
+
+# Embeddings of queries expire, as popular questions change over time.
+_query_embeddings_cache = TwoTierCache(
+    local=LRUCache(
+        maxsize=settings.MARTINI_QUERY_CACHE_LOCAL_SIZE,
+        ttl=settings.MARTINI_QUERY_CACHE_TTL,
+    ),
+    shared=RedisCache(
+        url=settings.MARTINI_CACHE_REDIS_URL,
+        namespace='martini:queries',
+        max_entries=settings.MARTINI_QUERY_CACHE_SHARED_SIZE,
+        ttl=settings.MARTINI_QUERY_CACHE_TTL,
+        dumps=lambda vector: vector.tobytes(),
+        loads=lambda value: np.frombuffer(value, dtype=np.float32),
+    ) if settings.MARTINI_CACHE_REDIS_URL else None,
 )
 
+# Embedding models, by backend, created on first use.
+# They share the caches, their keys including the name of the model and the dimension of its vectors.
+_embeddings_models = {}
+_embeddings_models_lock = threading.Lock()
+
 def get_llm():
     '''
     Return an instance of an LLM. Use OpenAI's by default.
     '''
     return _llm
 
-def get_embeddings_model() -> OpenAIEmbeddings:
+def get_embeddings_model(backend: str = 'openai') -> CachedEmbeddings:
+    '''
+    Return the embedding model of a backend (see EMBEDDING_BACKENDS), behind a cache. Use OpenAI's by default.
+    Raises ImproperlyConfigured if the backend cannot be used.
+    '''
+    model = _embeddings_models.get(backend)
+    if model is None:
+        with _embeddings_models_lock:
+            model = _embeddings_models.get(backend)
+            if model is None:
+                embeddings, model_name, dimension = create_embeddings(backend)
+                model = _embeddings_models[backend] = CachedEmbeddings(
+                    embeddings,
+                    model_name=model_name,
+                    dimension=dimension,
+                    cache=_embeddings_cache,
+                    query_cache=_query_embeddings_cache,
+                )
+    return model
+
+# Answers to questions, keyed by the version of the content of the collection they were asked to.
+_answers_cache = TwoTierCache(
+    local=LRUCache(
+        maxsize=settings.MARTINI_ANSWER_CACHE_LOCAL_SIZE,
+        ttl=settings.MARTINI_ANSWER_CACHE_TTL,
+    ),
+    shared=RedisCache(
+        url=settings.MARTINI_CACHE_REDIS_URL,
+        namespace='martini:answers',
+        max_entries=settings.MARTINI_ANSWER_CACHE_SHARED_SIZE,
+        ttl=settings.MARTINI_ANSWER_CACHE_TTL,
+        dumps=lambda answer: json.dumps(answer).encode('utf-8'),
+        loads=lambda value: json.loads(value),
+    ) if settings.MARTINI_CACHE_REDIS_URL else None,
+)
+
+def get_answers_cache() -> TwoTierCache:
     '''
-    Return embedding model. Use OpenAI's' by default.
+    Return the cache of answers to questions asked to document collections.
     '''
-    return _embeddings
+    return _answers_cache
@@ -0,0 +1,143 @@
+import time
+import asyncio
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+from apps.chats import qa
+from apps.chats.embeddings import CachedEmbeddings
+from apps.documents.models import DocumentCollection
+from config.cache import LRUCache, TwoTierCache
+
+
+class StubEmbeddings(Embeddings):
+    '''
+    Embedding model answering after a fixed latency, without any network call.
+    '''
+
+    def __init__(self, latency: float, dimension: int = 8):
+        self.latency = latency
+        self.dimension = dimension
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [[0.0] * self.dimension for _ in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return [0.0] * self.dimension
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return [0.0] * self.dimension
+
+
+class StubLLM(LLM):
+    '''
+    LLM answering after a fixed latency, without any network call.
+    '''
+
+    latency: float
+
+    @property
+    def _llm_type(self) -> str:
+        return 'stub'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        time.sleep(self.latency)
+        return 'Stub answer.'
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        await asyncio.sleep(self.latency)
+        return 'Stub answer.'
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare how many questions the synchronous and asynchronous chat pipelines answer concurrently, '
+        'with stubbed embedding model, Qdrant and LLM simulating their latency.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Number of questions to answer.')
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='Number of threads of the synchronous pipeline, i.e. of requests a sync worker serves at once.'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=200,
+            help='Maximum number of questions in flight in the asynchronous pipeline.'
+        )
+        parser.add_argument('--embedding-latency', type=float, default=0.05, help='In seconds.')
+        parser.add_argument('--search-latency', type=float, default=0.02, help='In seconds.')
+        parser.add_argument('--llm-latency', type=float, default=0.5, help='In seconds.')
+
+    def handle(self, *args, **options):
+        search_latency = options['search_latency']
+        docs = [(Document(page_content='Stub chunk.', metadata={}), 1.0)]
+
+        def search_by_vector(collection_name, vector, k=4, **kwargs):
+            time.sleep(search_latency)
+            return docs
+
+        async def asearch_by_vector(collection_name, vector, k=4, **kwargs):
+            await asyncio.sleep(search_latency)
+            return docs
+
+        embeddings = CachedEmbeddings(
+            StubEmbeddings(options['embedding_latency']),
+            model_name='stub',
+            dimension=8,
+            cache=TwoTierCache(LRUCache(maxsize=1)),
+            query_cache=TwoTierCache(LRUCache(maxsize=1)),
+        )
+        llm = StubLLM(latency=options['llm_latency'])
+        # Never saved: the collection is only used to build cache keys and name the Qdrant collection.
+        collection = DocumentCollection(id=0, slug='benchmark', content_version=0)
+
+        with mock.patch.object(qa, 'get_llm', return_value=llm), \
+                mock.patch.object(qa, 'get_embeddings_model', return_value=embeddings), \
+                mock.patch.object(qa, 'search_by_vector', search_by_vector), \
+                mock.patch.object(qa, 'asearch_by_vector', asearch_by_vector):
+            # Unique questions, so that no answer is served from the cache.
+            with mock.patch.object(qa, 'get_answers_cache', return_value=TwoTierCache(LRUCache(maxsize=1))):
+                sync_time = self.run_sync(collection, options['requests'], options['workers'])
+            with mock.patch.object(qa, 'get_answers_cache', return_value=TwoTierCache(LRUCache(maxsize=1))):
+                async_time = asyncio.run(self.run_async(collection, options['requests'], options['concurrency']))
+
+        self.report('sync', f'{options["workers"]} threads', options['requests'], sync_time)
+        self.report('async', f'{options["concurrency"]} in flight', options['requests'], async_time)
+
+    def run_sync(self, collection: DocumentCollection, requests: int, workers: int) -> float:
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(
+                lambda _: qa.answer_question([collection], f'Question {uuid.uuid4()}?'),
+                range(requests)
+            ))
+        return time.perf_counter() - started_at
+
+    async def run_async(self, collection: DocumentCollection, requests: int, concurrency: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def answer():
+            async with semaphore:
+                return await qa.aanswer_question([collection], f'Question {uuid.uuid4()}?')
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(answer() for _ in range(requests)))
+        return time.perf_counter() - started_at
+
+    def report(self, pipeline: str, concurrency: str, requests: int, elapsed: float):
+        self.stdout.write(
+            f'{pipeline:<6} ({concurrency}): {requests} questions in {elapsed:.2f}s, '
+            f'{requests / elapsed:.1f} questions/s'
+        )
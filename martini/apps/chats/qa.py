@@ -0,0 +1,470 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+
+from langchain.chains.question_answering import load_qa_chain
+from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR as QA_PROMPT_SELECTOR
+from langchain.docstore.document import Document
+
+from apps.documents.vectorstore import (
+    asearch_by_vector,
+    asearch_with_vectors,
+    search_by_vector,
+    search_with_vectors,
+)
+from apps.documents.models import DocumentCollection
+from apps.chats.llm import get_answers_cache, get_embeddings_model, get_llm
+from apps.chats.embeddings import normalize_query
+from apps.chats.context import pack_context
+from apps.chats.rerank import RerankOptions, rerank
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the tokens streamed from a thread by `astream_tokens`.
+_END_OF_STREAM = object()
+
+
+def parse_collection_params(data) -> Tuple[Optional[list], Optional[list]]:
+    '''
+    Read the collections a question is asked to from the parameters of a request:
+    lists of `collection_ids` or `collection_names`, or a single `collection_id` or `collection_name`.
+    Raises a ValueError if the lists are not lists.
+    '''
+    collection_ids = data.get('collection_ids')
+    if collection_ids is None and data.get('collection_id') is not None:
+        collection_ids = [data.get('collection_id')]
+    collection_names = data.get('collection_names')
+    if collection_names is None and data.get('collection_name') is not None:
+        collection_names = [data.get('collection_name')]
+
+    for value in (collection_ids, collection_names):
+        if value is not None and (not isinstance(value, list) or not value):
+            raise ValueError('collection_ids and collection_names must be non-empty lists.')
+    return collection_ids, collection_names
+
+
+def parse_document_ids(value) -> Optional[List[int]]:
+    '''
+    Validate the IDs of the documents a question is restricted to, as received in a request.
+    Raises a ValueError if they are not a list of integers.
+    '''
+    if value is None:
+        return None
+    if not isinstance(value, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in value):
+        raise ValueError('document_ids must be a list of document IDs.')
+    return sorted(set(value))
+
+
+def parse_rerank_params(data) -> Optional[RerankOptions]:
+    '''
+    Read the options of the re-ranking of retrieved chunks from the parameters of a request:
+    enabled by `rerank`, with `candidates`, `mmr_lambda` and `dedup_threshold`
+    (MARTINI_RERANK_* settings by default). Raises a ValueError if they are invalid.
+    '''
+    if not data.get('rerank'):
+        return None
+    try:
+        options = RerankOptions(
+            candidates=int(data.get('candidates', settings.MARTINI_RERANK_CANDIDATES)),
+            mmr_lambda=float(data.get('mmr_lambda', settings.MARTINI_RERANK_MMR_LAMBDA)),
+            dedup_threshold=float(data.get('dedup_threshold', settings.MARTINI_RERANK_DEDUP_THRESHOLD)),
+        )
+    except (TypeError, ValueError):
+        options = None
+    if (
+        options is None
+        or not 1 <= options.candidates <= settings.MARTINI_RERANK_MAX_CANDIDATES
+        or not 0 <= options.mmr_lambda <= 1
+        or not 0 < options.dedup_threshold <= 1
+    ):
+        raise ValueError(
+            f'candidates must be an integer between 1 and {settings.MARTINI_RERANK_MAX_CANDIDATES}, '
+            'mmr_lambda a number between 0 and 1, and dedup_threshold a number between 0 (excluded) and 1.'
+        )
+    return options
+
+
+def _collections_query(collection_ids: Optional[list], collection_names: Optional[list]):
+    if collection_ids:
+        return DocumentCollection.objects.filter(id__in=collection_ids)
+    return DocumentCollection.objects.filter(Q(name__in=collection_names) | Q(slug__in=collection_names))
+
+
+def _check_collections(
+    collections: List[DocumentCollection],
+    collection_ids: Optional[list],
+    collection_names: Optional[list],
+) -> List[DocumentCollection]:
+    if collection_ids:
+        found = {str(collection.id) for collection in collections}
+        missing = [id for id in collection_ids if str(id) not in found]
+    else:
+        found = {collection.name for collection in collections} | {collection.slug for collection in collections}
+        missing = [name for name in collection_names if name not in found]
+    if missing or not collections:
+        raise Exception('DocumentCollection not found.')
+    return collections
+
+
+def get_collections(
+    collection_ids: Optional[list] = None,
+    collection_names: Optional[list] = None,
+) -> List[DocumentCollection]:
+    '''
+    Find collections by ids if provided, by names (or slugs) otherwise.
+    '''
+    collections = list(_collections_query(collection_ids, collection_names).order_by('id'))
+    return _check_collections(collections, collection_ids, collection_names)
+
+
+async def aget_collections(
+    collection_ids: Optional[list] = None,
+    collection_names: Optional[list] = None,
+) -> List[DocumentCollection]:
+    '''
+    Asynchronous counterpart of `get_collections`.
+    '''
+    collections = [
+        collection async for collection in _collections_query(collection_ids, collection_names).order_by('id')
+    ]
+    return _check_collections(collections, collection_ids, collection_names)
+
+
+def llm_model_name(llm) -> str:
+    return getattr(llm, 'model_name', type(llm).__name__)
+
+
+def answer_cache_key(
+    collections: List[DocumentCollection],
+    llm,
+    query: str,
+    document_ids: Optional[List[int]] = None,
+    rerank_options: Optional[RerankOptions] = None,
+) -> str:
+    '''
+    Key of the answer to a query in the answers cache.
+    It includes the version of the content of the collections, so that answers are not served
+    anymore once documents are added to or removed from one of them,
+    and the documents the question is restricted to and the re-ranking options, if any.
+    '''
+    digest = hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+    model_name = llm_model_name(llm)
+    versions = ','.join(
+        f'{collection.id}.{collection.content_version}'
+        for collection in sorted(collections, key=lambda collection: collection.id)
+    )
+    key = f'{versions}:{model_name}:{digest}'
+    if document_ids is not None:
+        key += ':' + ','.join(str(id) for id in document_ids)
+    if rerank_options is not None:
+        key += ':' + rerank_options.cache_key()
+    return key
+
+
+def merge_results(results: Iterable[Tuple[DocumentCollection, List[tuple]]]) -> List[tuple]:
+    '''
+    Merge the chunks found in several collections (along with their score, and possibly their vector),
+    sorted by similarity score. Each chunk is marked with the slug of the collection it comes from.
+    '''
+    merged = []
+    for collection, collection_results in results:
+        for result in collection_results:
+            result[0].metadata['collection'] = collection.slug
+            merged.append(result)
+    merged.sort(key=lambda result: result[1], reverse=True)
+    return merged
+
+
+def select_chunks(
+    query_vectors: Dict[str, List[float]],
+    results: List[Tuple[DocumentCollection, List[tuple]]],
+    k: int,
+    rerank_options: Optional[RerankOptions],
+) -> List[Tuple[Document, float]]:
+    '''
+    Choose the `k` chunks to answer from among the ones found in the collections:
+    the most relevant ones, or the ones chosen by re-ranking if `rerank_options` are specified.
+    The vectors of different embedding models cannot be compared: the chunks of the collections
+    of each embedding backend (whose query vector is in `query_vectors`) are re-ranked separately.
+    '''
+    if rerank_options is None:
+        return merge_results(results)[:k]
+    chosen = []
+    for backend, query_vector in query_vectors.items():
+        backend_results = [result for result in results if result[0].embedding_backend == backend]
+        chosen.extend(rerank(query_vector, merge_results(backend_results), k, rerank_options))
+    chosen.sort(key=lambda result: result[1], reverse=True)
+    return chosen[:k]
+
+
+def retrieve_documents(
+    collections: List[DocumentCollection],
+    query: str,
+    document_ids: Optional[List[int]] = None,
+    rerank_options: Optional[RerankOptions] = None,
+    k: int = None,
+) -> List[Document]:
+    '''
+    Retrieve the `k` chunks of the collections most relevant to the query (MARTINI_RETRIEVAL_K by default),
+    among the chunks of the documents of `document_ids` if specified, and pack them in the context of the LLM.
+    With `rerank_options`, more candidates are fetched along with their vectors, and the `k` chunks are
+    chosen among them for both their relevance and their diversity.
+    The query is embedded once by embedding backend of the collections, and the embedding is cached:
+    popular questions are only embedded once. Each collection is searched with the vector of its backend
+    directly, with the search settings of its index profile. Collections are searched concurrently.
+    '''
+    k = k or settings.MARTINI_RETRIEVAL_K
+    query_vectors = {
+        backend: get_embeddings_model(backend).embed_query(query)
+        for backend in {collection.embedding_backend for collection in collections}
+    }
+    search_function = search_by_vector if rerank_options is None else search_with_vectors
+
+    def search(collection):
+        return collection, search_function(
+            collection.vectorstore_collection_name,
+            query_vectors[collection.embedding_backend],
+            k=k if rerank_options is None else rerank_options.candidates,
+            document_ids=document_ids,
+            search_params=collection.index_profile.search_params(),
+        )
+
+    if len(collections) == 1:
+        results = [search(collections[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(collections)) as executor:
+            results = list(executor.map(search, collections))
+    return pack_context(select_chunks(query_vectors, results, k, rerank_options), llm_model_name(get_llm()))
+
+
+def answer_question(
+    collections: List[DocumentCollection],
+    query: str,
+    document_ids: Optional[List[int]] = None,
+    rerank_options: Optional[RerankOptions] = None,
+) -> dict:
+    '''
+    Answer a question from the documents of one or several collections (or only some of these documents),
+    with the QA chain, in a single LLM call over the most relevant chunks of all the collections.
+    The same question asked to the same content gets the same answer (the LLM is not sampled):
+    it is served from the cache if possible.
+    '''
+    llm = get_llm()
+    answers_cache = get_answers_cache()
+    cache_key = answer_cache_key(collections, llm, query, document_ids, rerank_options)
+    answer = answers_cache.get(cache_key)
+    cached = answer is not None
+
+    if not cached:
+        chain = load_qa_chain(llm, chain_type='stuff')
+        docs = retrieve_documents(collections, query, document_ids, rerank_options)
+        answer = chain.run(input_documents=docs, question=query).strip()
+        answers_cache.set(cache_key, answer)
+
+    return {
+        'query': query,
+        'answer': answer,
+        'cached': cached,
+    }
+
+
+async def aretrieve_documents(
+    collections: List[DocumentCollection],
+    query: str,
+    document_ids: Optional[List[int]] = None,
+    rerank_options: Optional[RerankOptions] = None,
+    k: int = None,
+) -> List[Document]:
+    '''
+    Asynchronous counterpart of `retrieve_documents`.
+    '''
+    k = k or settings.MARTINI_RETRIEVAL_K
+    backends = list({collection.embedding_backend for collection in collections})
+    query_vectors = dict(zip(backends, await asyncio.gather(*(
+        get_embeddings_model(backend).aembed_query(query) for backend in backends
+    ))))
+    search_function = asearch_by_vector if rerank_options is None else asearch_with_vectors
+
+    async def search(collection):
+        return collection, await search_function(
+            collection.vectorstore_collection_name,
+            query_vectors[collection.embedding_backend],
+            k=k if rerank_options is None else rerank_options.candidates,
+            document_ids=document_ids,
+            search_params=collection.index_profile.search_params(),
+        )
+
+    results = await asyncio.gather(*(search(collection) for collection in collections))
+    return pack_context(select_chunks(query_vectors, results, k, rerank_options), llm_model_name(get_llm()))
+
+
+async def aanswer_question(
+    collections: List[DocumentCollection],
+    query: str,
+    document_ids: Optional[List[int]] = None,
+    rerank_options: Optional[RerankOptions] = None,
+) -> dict:
+    '''
+    Asynchronous counterpart of `answer_question`: the cache, the embedding model, Qdrant and the LLM
+    are all awaited, so that a single process can serve many questions at once while they wait on I/O.
+    '''
+    llm = get_llm()
+    answers_cache = get_answers_cache()
+    cache_key = answer_cache_key(collections, llm, query, document_ids, rerank_options)
+    answer = await answers_cache.aget(cache_key)
+    cached = answer is not None
+
+    if not cached:
+        chain = load_qa_chain(llm, chain_type='stuff')
+        docs = await aretrieve_documents(collections, query, document_ids, rerank_options)
+        answer = (await chain.arun(input_documents=docs, question=query)).strip()
+        await answers_cache.aset(cache_key, answer)
+
+    return {
+        'query': query,
+        'answer': answer,
+        'cached': cached,
+    }
+
+
+def sse_event(event: str, data: dict) -> str:
+    '''
+    Format a server-sent event.
+    '''
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def stream_tokens(llm, prompt: str) -> Iterator[str]:
+    '''
+    Stream the completion of a prompt token by token, if the LLM supports it.
+    Otherwise, the whole completion is returned as a single token.
+    '''
+    if not hasattr(llm, 'stream'):
+        yield llm(prompt)
+        return
+
+    for chunk in llm.stream(prompt):
+        token = chunk['choices'][0]['text']
+        if token:
+            yield token
+
+
+async def astream_tokens(llm, prompt: str) -> AsyncIterator[str]:
+    '''
+    Asynchronous counterpart of `stream_tokens`: the LLM is streamed from a thread,
+    which hands the tokens over to the event loop through a queue as they are generated.
+    The thread stops reading the stream if the iteration is abandoned (i.e. the client went away).
+    '''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is closed, nobody is waiting for the tokens anymore.
+            stopped.set()
+
+    def produce():
+        try:
+            for token in stream_tokens(llm, prompt):
+                if stopped.is_set():
+                    return
+                put(token)
+        except Exception as e:
+            put(e)
+        finally:
+            put(_END_OF_STREAM)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END_OF_STREAM:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+
+def build_prompt(llm, docs: List[Document], query: str) -> str:
+    '''
+    Build the prompt the "stuff" QA chain sends to the LLM: its prompt template,
+    with the packed documents, separated by blank lines, as the context of the question.
+    '''
+    context = '\n\n'.join(doc.page_content for doc in docs)
+    return QA_PROMPT_SELECTOR.get_prompt(llm).format(context=context, question=query)
+
+
+async def stream_answer(
+    collections: List[DocumentCollection],
+    query: str,
+    document_ids: Optional[List[int]] = None,
+    rerank_options: Optional[RerankOptions] = None,
+) -> AsyncIterator[str]:
+    '''
+    Answer a question from the documents of one or several collections (or only some of these documents),
+    as server-sent events:
+    - "sources": the retrieved chunks, as soon as the retrieval is done;
+    - "token": each token of the answer, as the LLM generates it;
+    - "done": the whole answer, with the time to first token and total time (in seconds);
+    - "error": if anything fails along the way.
+    A cached answer is sent right away as a single token.
+    This is an asynchronous generator, so that the ASGI server sends each event as soon as it is yielded.
+    '''
+    started_at = time.perf_counter()
+    slugs = ', '.join(collection.slug for collection in collections)
+    try:
+        llm = get_llm()
+        answers_cache = get_answers_cache()
+        cache_key = answer_cache_key(collections, llm, query, document_ids, rerank_options)
+        answer = await answers_cache.aget(cache_key)
+        cached = answer is not None
+
+        if cached:
+            yield sse_event('token', {'text': answer})
+            time_to_first_token = time.perf_counter() - started_at
+        else:
+            docs = await aretrieve_documents(collections, query, document_ids, rerank_options)
+            yield sse_event('sources', {
+                'documents': [{'content': doc.page_content, 'metadata': doc.metadata} for doc in docs]
+            })
+
+            tokens = []
+            time_to_first_token = None
+            async for token in astream_tokens(llm, build_prompt(llm, docs, query)):
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - started_at
+                tokens.append(token)
+                yield sse_event('token', {'text': token})
+
+            answer = ''.join(tokens).strip()
+            await answers_cache.aset(cache_key, answer)
+
+        total_time = time.perf_counter() - started_at
+        logger.info(
+            f'Streamed answer to collections "{slugs}": '
+            f'first token after {time_to_first_token or total_time:.3f}s, done after {total_time:.3f}s'
+        )
+        yield sse_event('done', {
+            'query': query,
+            'answer': answer,
+            'cached': cached,
+            'time_to_first_token': time_to_first_token,
+            'total_time': total_time,
+        })
+    except Exception as e:
+        logger.exception(f'Streaming an answer to collections "{slugs}" failed')
+        yield sse_event('error', {'error': str(e)})
@@ -0,0 +1,90 @@
+import time
+import logging
+
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from langchain.docstore.document import Document
+
+from apps.chats.embeddings import normalize_vectors
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RerankOptions:
+    '''
+    Settings of the re-ranking of retrieved chunks:
+    - candidates: number of chunks fetched from each collection, to choose the final ones from;
+    - mmr_lambda: trade-off between relevance to the query (1) and diversity of the chunks (0);
+    - dedup_threshold: cosine similarity above which a chunk is a near-duplicate of an already chosen one,
+      and is discarded.
+    '''
+    candidates: int
+    mmr_lambda: float
+    dedup_threshold: float
+
+    def cache_key(self) -> str:
+        return f'mmr{self.candidates},{self.mmr_lambda},{self.dedup_threshold}'
+
+
+def maximal_marginal_relevance(
+    query_vector: Sequence[float],
+    vectors: Sequence[Sequence[float]],
+    k: int,
+    mmr_lambda: float,
+    dedup_threshold: float,
+) -> List[int]:
+    '''
+    Choose up to `k` vectors both relevant to the query and different from each other, with maximal marginal
+    relevance: each step picks the vector maximizing `mmr_lambda * relevance - (1 - mmr_lambda) * redundancy`,
+    redundancy being its highest cosine similarity to the vectors already picked.
+    Vectors at least `dedup_threshold` similar to a picked one are discarded.
+    Returns the indexes of the chosen vectors, in the order they were picked.
+    '''
+    if not len(vectors):
+        return []
+    vectors = normalize_vectors(np.asarray(vectors, dtype=np.float32))
+    query = normalize_vectors(np.asarray(query_vector, dtype=np.float32))
+    relevance = vectors @ query
+
+    chosen = []
+    redundancy = np.zeros(len(vectors), dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+    while len(chosen) < k and available.any():
+        scores = relevance if not chosen else mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        index = int(np.argmax(np.where(available, scores, -np.inf)))
+        chosen.append(index)
+        # Only the similarities to the chosen vectors are needed, not the whole similarity matrix.
+        similarity = vectors @ vectors[index]
+        redundancy = np.maximum(redundancy, similarity)
+        available &= similarity < dedup_threshold
+        available[index] = False
+    return chosen
+
+
+def rerank(
+    query_vector: Sequence[float],
+    candidates: List[Tuple[Document, float, List[float]]],
+    k: int,
+    options: RerankOptions,
+) -> List[Tuple[Document, float]]:
+    '''
+    Choose the `k` chunks to answer from among the candidates (chunks, scores and vectors),
+    with maximal marginal relevance. The chunks keep their similarity score to the query.
+    '''
+    started_at = time.perf_counter()
+    chosen = maximal_marginal_relevance(
+        query_vector,
+        [vector for _, _, vector in candidates],
+        k,
+        options.mmr_lambda,
+        options.dedup_threshold,
+    )
+    logger.debug(
+        f'Re-ranked {len(candidates)} candidates into {len(chosen)} chunks '
+        f'in {(time.perf_counter() - started_at) * 1000:.1f}ms'
+    )
+    return [candidates[index][:2] for index in chosen]
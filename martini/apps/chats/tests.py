@@ -1,3 +1,217 @@
-from django.test import TestCase
+import os
+import tempfile
 
-# Create your tests here.
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from langchain.docstore.document import Document
+
+from apps.chats import context, qa
+from apps.chats.rerank import RerankOptions, maximal_marginal_relevance, rerank
+from apps.documents.local_vectorstore import LocalVectorStore
+from apps.documents.models import DocumentCollection, UnstructuredDocument
+from config.cache import LRUCache, TwoTierCache
+
+
+class AnswerCacheTest(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        store = LocalVectorStore(os.path.join(temp_dir.name, 'vectorstore'))
+        store.create_collection('answers', 3)
+        self.collection = DocumentCollection.objects.create(name='answers', slug='answers')
+        self.document = UnstructuredDocument.objects.create(
+            name='document.pdf', file='document.pdf', collection=self.collection
+        )
+        store.collection('answers').add(
+            ['chunk'], ['Some text.'], [[1, 0, 0]], [{'instance_id': self.document.id, 'chunk': 0}]
+        )
+
+        self.llm = SimpleNamespace(model_name='model-a')
+        self.chain = mock.Mock()
+        self.chain.run.return_value = 'An answer.'
+        for patch in (
+            mock.patch('apps.documents.vectorstore.get_local_store', return_value=store),
+            mock.patch.object(qa, 'get_llm', return_value=self.llm),
+            mock.patch.object(qa, 'get_answers_cache', return_value=TwoTierCache(LRUCache(maxsize=16))),
+            mock.patch.object(qa, 'retrieve_documents', return_value=[]),
+            mock.patch.object(qa, 'load_qa_chain', return_value=self.chain),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def ask(self, query='What is it about?'):
+        # As the views do, read the collection again for each question.
+        collections = [DocumentCollection.objects.get(id=self.collection.id)]
+        return qa.answer_question(collections, query)['cached']
+
+    def test_same_question_is_answered_from_the_cache(self):
+        self.assertFalse(self.ask())
+        self.assertTrue(self.ask('  What is it   about? '))
+        self.assertEqual(self.chain.run.call_count, 1)
+
+    def test_deleting_a_document_invalidates_answers(self):
+        self.ask()
+
+        UnstructuredDocument.delete_embeddings('answers', 'document.pdf', self.document.id)
+
+        self.assertFalse(self.ask())
+        self.assertTrue(self.ask())
+
+    def test_adding_a_document_invalidates_answers(self):
+        copy = UnstructuredDocument.objects.create(name='copy.pdf', file='copy.pdf', collection=self.collection)
+        self.ask()
+
+        UnstructuredDocument.copy_embeddings('answers', self.document.id, 'answers', 'copy.pdf', copy.id)
+
+        self.assertFalse(self.ask())
+
+    def test_keys_differ_by_model_documents_and_rerank_options(self):
+        collections = [self.collection]
+        keys = [
+            qa.answer_cache_key(collections, self.llm, 'Question?'),
+            qa.answer_cache_key(collections, SimpleNamespace(model_name='model-b'), 'Question?'),
+            qa.answer_cache_key(collections, self.llm, 'Question?', document_ids=[1]),
+            qa.answer_cache_key(collections, self.llm, 'Question?', document_ids=[1, 2]),
+            qa.answer_cache_key(collections, self.llm, 'Question?', rerank_options=RerankOptions(20, 0.5, 0.95)),
+            qa.answer_cache_key(collections, self.llm, 'Question?', rerank_options=RerankOptions(20, 0.7, 0.95)),
+            qa.answer_cache_key(collections, self.llm, 'Another question?'),
+        ]
+
+        self.assertEqual(len(set(keys)), len(keys))
+
+
+class MaximalMarginalRelevanceTest(SimpleTestCase):
+    QUERY = [1, 0, 0]
+    VECTORS = [
+        [1, 0, 0],
+        # Near-duplicate of the first vector (cosine similarity of 0.99).
+        [0.99, 0.141, 0],
+        [0.7, 0.7, 0],
+        [0.6, 0, 0.8],
+    ]
+
+    def mmr(self, k=4, mmr_lambda=0.5, dedup_threshold=1.1):
+        return maximal_marginal_relevance(self.QUERY, self.VECTORS, k, mmr_lambda, dedup_threshold)
+
+    def test_relevance_only(self):
+        self.assertEqual(self.mmr(mmr_lambda=1), [0, 1, 2, 3])
+
+    def test_diversity_only(self):
+        # The most relevant vector first, then the least similar to those already picked.
+        self.assertEqual(self.mmr(mmr_lambda=0), [0, 3, 2, 1])
+
+    def test_trade_off(self):
+        # The query being the first vector, redundancy to it equals relevance:
+        # the second pick is the most relevant vector above 0.5, the least relevant below.
+        self.assertEqual(self.mmr(mmr_lambda=0.6, k=2), [0, 1])
+        self.assertEqual(self.mmr(mmr_lambda=0.4, k=2), [0, 3])
+
+    def test_near_duplicates_are_discarded(self):
+        self.assertEqual(self.mmr(mmr_lambda=1, dedup_threshold=0.95), [0, 2, 3])
+
+    def test_at_most_k_vectors(self):
+        self.assertEqual(self.mmr(k=2, mmr_lambda=1), [0, 1])
+        self.assertEqual(maximal_marginal_relevance(self.QUERY, [], 2, 0.5, 0.95), [])
+
+    def test_rerank_keeps_the_scores_of_the_chunks(self):
+        candidates = [
+            (Document(page_content=str(index)), 1.0 - index / 10, vector)
+            for index, vector in enumerate(self.VECTORS)
+        ]
+
+        reranked = rerank(self.QUERY, candidates, 2, RerankOptions(candidates=4, mmr_lambda=0, dedup_threshold=0.95))
+
+        self.assertEqual([(doc.page_content, score) for doc, score in reranked], [('0', 1.0), ('3', 0.7)])
+
+
+class CharacterEncoding:
+    '''
+    Tokenizer with a token per character, standing in for tiktoken, which downloads its encodings.
+    '''
+
+    def encode(self, text, disallowed_special=()):
+        return list(text)
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+
+def chunk(text, chunk_index, instance_id=1, collection='default'):
+    return Document(
+        page_content=text,
+        metadata={'instance_id': instance_id, 'chunk': chunk_index, 'page': 1, 'collection': collection},
+    )
+
+
+@override_settings(MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_OVERLAP=10)
+class MergeAdjacentChunksTest(SimpleTestCase):
+    def test_overlap_of_adjacent_chunks_is_merged(self):
+        passages = context.merge_adjacent_chunks([
+            (chunk('The cat sat on the mat.', 1), 0.5),
+            (chunk('the mat. Then it slept.', 2), 0.8),
+        ])
+
+        self.assertEqual(len(passages), 1)
+        doc, score = passages[0]
+        self.assertEqual(doc.page_content, 'The cat sat on the mat. Then it slept.')
+        self.assertEqual(score, 0.8)
+        self.assertEqual((doc.metadata['chunk'], doc.metadata['chunks']), (1, [1, 2]))
+
+    def test_chunks_without_overlap_are_joined_by_a_line(self):
+        passages = context.merge_adjacent_chunks([(chunk('First.', 1), 0.5), (chunk('Second.', 2), 0.5)])
+
+        self.assertEqual([doc.page_content for doc, _ in passages], ['First.\nSecond.'])
+
+    def test_only_adjacent_chunks_of_the_same_document_are_merged(self):
+        passages = context.merge_adjacent_chunks([
+            (chunk('First.', 1), 0.9),
+            (chunk('Third.', 3), 0.8),
+            (chunk('Second of another document.', 2, instance_id=2), 0.7),
+            (chunk('Second in another collection.', 2, collection='other'), 0.6),
+            (Document(page_content='Without position.'), 0.5),
+        ])
+
+        self.assertEqual(sorted(doc.page_content for doc, _ in passages), [
+            'First.', 'Second in another collection.', 'Second of another document.', 'Third.', 'Without position.',
+        ])
+
+
+@override_settings(MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_OVERLAP=10)
+class PackContextTest(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.object(context, 'get_encoding', return_value=CharacterEncoding())
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def pack(self, scored_docs, token_budget):
+        return [
+            (doc.page_content, doc.metadata.get('truncated', False))
+            for doc in context.pack_context(scored_docs, 'model', token_budget)
+        ]
+
+    def test_passages_are_packed_by_score_within_the_budget(self):
+        scored_docs = [(chunk('a' * 40, 1), 0.5), (chunk('b' * 50, 4), 0.9), (chunk('c' * 30, 7), 0.7)]
+
+        self.assertEqual(self.pack(scored_docs, 120), [('b' * 50, False), ('c' * 30, False), ('a' * 40, False)])
+        self.assertEqual(self.pack(scored_docs, 80), [('b' * 50, False), ('c' * 30, False)])
+
+    def test_last_passage_is_truncated_to_fit(self):
+        scored_docs = [(chunk('a' * 100, 1), 0.9), (chunk('b' * 100, 4), 0.5)]
+
+        packed = self.pack(scored_docs, 140)
+
+        self.assertEqual(packed, [('a' * 100, False), ('b' * 40, True)])
+        self.assertEqual(sum(len(text) for text, _ in packed), 140)
+
+    def test_last_passage_is_dropped_if_too_little_of_it_fits(self):
+        scored_docs = [(chunk('a' * 100, 1), 0.9), (chunk('b' * 100, 4), 0.5)]
+
+        self.assertEqual(self.pack(scored_docs, 100 + context.MIN_TRUNCATED_TOKENS - 1), [('a' * 100, False)])
+
+    def test_merged_passages_are_counted_once(self):
+        scored_docs = [(chunk('The cat sat on the mat.', 1), 0.9), (chunk('the mat. Then it slept.', 2), 0.8)]
+
+        self.assertEqual(self.pack(scored_docs, 38), [('The cat sat on the mat. Then it slept.', False)])
@@ -1,11 +1,26 @@
+import json
+
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+
 from rest_framework import viewsets, status
 from rest_framework.response import Response
+from rest_framework.decorators import action
 
-from langchain.chains.question_answering import load_qa_chain
+from apps.chats.qa import (
+    aanswer_question,
+    aget_collections,
+    answer_question,
+    get_collections,
+    parse_collection_params,
+    parse_document_ids,
+    parse_rerank_params,
+    stream_answer,
+)
 
-from apps.documents.vectorstore import get_vectorstore_for_chains
-from apps.documents.models import DocumentCollection
-from apps.chats.llm import get_embeddings_model, get_llm
+MISSING_PARAMS_ERROR = (
+    'query, and collection_ids or collection_names (or collection_id or collection_name) parameters, are required.'
+)
 
 
 class MessageViewSet(viewsets.ViewSet):
@@ -13,37 +28,29 @@ class MessageViewSet(viewsets.ViewSet):
         '''
         Builds the QA chain from a query and a list of documents, then runs the chain to get an answer.
         This is the bread and butter of the "chat your documents" feature.
+        A question can be asked to several collections at once, with a list of `collection_ids`
+        (or `collection_names`): their most relevant chunks are merged and answered from in a single LLM call.
+        The answer can be restricted to some documents of the collections with a list of `document_ids`.
+        With `rerank`, near-duplicate chunks are discarded and the chunks answered from are chosen among
+        `candidates` for both their relevance and their diversity (see `parse_rerank_params`).
         '''
         query = request.data.get('query')
-        collection_id = request.data.get('collection_id')
-        collection_name = request.data.get('collection_name')
+        try:
+            collection_ids, collection_names = parse_collection_params(request.data)
+            document_ids = parse_document_ids(request.data.get('document_ids'))
+            rerank_options = parse_rerank_params(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        if query is None or (collection_id is None and collection_name is None):
-            return Response(
-                {"error": "query, and collection_id or collection_name parameters, are required."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        if query is None or (collection_ids is None and collection_names is None):
+            return Response({'error': MISSING_PARAMS_ERROR}, status=status.HTTP_400_BAD_REQUEST)
 
         payload = None
         status_code = None
 
         try:
-            # If a collection id is provided, use that to get the collection name.
-            if collection_id:
-                collection_name = DocumentCollection.objects.get(id=collection_id).name
-                if not collection_name:
-                    raise Exception('DocumentCollection not found.')
-
-            docsearch = get_vectorstore_for_chains(get_embeddings_model(), collection_name)
-            llm = get_llm()
-            query = query.strip()
-            chain = load_qa_chain(llm, chain_type='stuff')
-            docs = docsearch.similarity_search(query)
-            answer = chain.run(input_documents=docs, question=query).strip()
-            payload = {
-                'query': query,
-                'answer': answer,
-            }
+            collections = get_collections(collection_ids, collection_names)
+            payload = answer_question(collections, query.strip(), document_ids, rerank_options)
             status_code = status.HTTP_200_OK
         except Exception as e:
             payload = {
@@ -52,3 +59,79 @@ class MessageViewSet(viewsets.ViewSet):
             status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         finally:
             return Response(payload, status=status_code)
+
+    @action(detail=False, methods=['post'], url_path='stream')
+    def stream(self, request):
+        '''
+        Same as creating a message, but the answer is streamed as server-sent events (text/event-stream):
+        a "sources" event with the retrieved chunks, "token" events as the LLM generates the answer,
+        then a "done" event with the whole answer and timings, or an "error" event.
+        The events are produced by an asynchronous generator: served through the ASGI application,
+        each one is sent as soon as it is generated (a WSGI server sends them all once the answer is done).
+        '''
+        query = request.data.get('query')
+        try:
+            collection_ids, collection_names = parse_collection_params(request.data)
+            document_ids = parse_document_ids(request.data.get('document_ids'))
+            rerank_options = parse_rerank_params(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if query is None or (collection_ids is None and collection_names is None):
+            return Response({'error': MISSING_PARAMS_ERROR}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            collections = get_collections(collection_ids, collection_names)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        response = StreamingHttpResponse(
+            stream_answer(collections, query.strip(), document_ids, rerank_options),
+            content_type='text/event-stream'
+        )
+        # Prevent caches and proxies (i.e. Nginx) from buffering the events.
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class AsyncMessageView(View):
+    '''
+    Asynchronous implementation of the messages endpoint, with the same parameters and responses.
+    Served through the ASGI application, it does not hold a worker while waiting on the embedding model,
+    Qdrant and the LLM, so that a single process can answer many questions concurrently.
+    '''
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Like the API views of DRF, rely on the API's authentication rather than on CSRF protection.
+        view.csrf_exempt = True
+        return view
+
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            data = {}
+        query = data.get('query')
+        try:
+            collection_ids, collection_names = parse_collection_params(data)
+            document_ids = parse_document_ids(data.get('document_ids'))
+            rerank_options = parse_rerank_params(data)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if query is None or (collection_ids is None and collection_names is None):
+            return JsonResponse({'error': MISSING_PARAMS_ERROR}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            collections = await aget_collections(collection_ids, collection_names)
+            payload = await aanswer_question(collections, query.strip(), document_ids, rerank_options)
+            status_code = status.HTTP_200_OK
+        except Exception as e:
+            payload = {
+                'error': str(e)
+            }
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return JsonResponse(payload, status=status_code)
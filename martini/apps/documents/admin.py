@@ -3,3 +3,4 @@ from apps.documents import models
 
 
 admin.site.register(models.UnstructuredDocument)
+admin.site.register(models.UploadSession)
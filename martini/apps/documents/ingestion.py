@@ -0,0 +1,147 @@
+import time
+import logging
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from apps.documents.loaders import batched
+from apps.documents.vectorstore import upsert_embeddings
+
+logger = logging.getLogger(__name__)
+
+
+def embed_batch(
+    embeddings: Embeddings,
+    batch: List[Document],
+) -> Tuple[List[Document], List[List[float]], float]:
+    '''
+    Embed a batch of chunks.
+
+    Args:
+        embeddings (Embeddings): Embedding model.
+        batch (List[Document]): Chunks to embed, with their metadata.
+
+    Returns:
+        Tuple[List[Document], List[List[float]], float]: The chunks, their embeddings,
+            and the latency of the batch, in seconds.
+    '''
+    started_at = time.perf_counter()
+    vectors = embeddings.embed_documents([chunk.page_content for chunk in batch])
+    return batch, vectors, time.perf_counter() - started_at
+
+
+def store_embeddings(collection_name: str, chunks: List[Document], vectors: List[List[float]]) -> float:
+    '''
+    Upsert embedded chunks into the vector store, through its bulk path.
+
+    Args:
+        collection_name (str): Name of the collection to store the embeddings in.
+        chunks (List[Document]): Chunks, with their metadata.
+        vectors (List[List[float]]): Embeddings of the chunks.
+
+    Returns:
+        float: Latency of the upsert, in seconds.
+    '''
+    started_at = time.perf_counter()
+    upsert_embeddings(
+        collection_name,
+        [chunk.page_content for chunk in chunks],
+        vectors,
+        [chunk.metadata for chunk in chunks],
+    )
+    return time.perf_counter() - started_at
+
+
+def embed_and_store(
+    chunks: Iterable[Document],
+    embeddings: Embeddings,
+    collection_name: str,
+    doc_name: str,
+    batch_size: int = None,
+    concurrency: int = None,
+    on_progress: Optional[Callable[[int, float], None]] = None,
+    on_stored: Optional[Callable[[List[Document]], None]] = None,
+) -> int:
+    '''
+    Embed chunks and store them in the vector store, several batches at a time.
+    Batches are pulled lazily from `chunks` and at most `concurrency` of them are in flight.
+    Embedded chunks are upserted in order as soon as there are enough of them to fill the parallel
+    upsert requests of the vector store, so memory stays bounded whatever the size of the document,
+    and all the chunks before the last one stored are stored too, e.g. to resume from there.
+
+    Args:
+        chunks (Iterable[Document]): Chunks to embed, with their metadata.
+        embeddings (Embeddings): Embedding model.
+        collection_name (str): Name of the collection to store the embeddings in.
+        doc_name (str): Name of the document the chunks come from, for logging purposes.
+        batch_size (int): Chunks per embedding request. Defaults to MARTINI_EMBEDDING_BATCH_SIZE.
+        concurrency (int): Batches processed concurrently. Defaults to MARTINI_EMBEDDING_CONCURRENCY.
+        on_progress (Callable[[int, float], None]): Called with the number of chunks of each batch embedded
+            and its latency, and with 0 and the latency of each upsert.
+        on_stored (Callable[[List[Document]], None]): Called with the chunks of each upsert, once stored.
+
+    Returns:
+        int: Number of chunks stored.
+    '''
+    batch_size = batch_size or settings.MARTINI_EMBEDDING_BATCH_SIZE
+    concurrency = concurrency or settings.MARTINI_EMBEDDING_CONCURRENCY
+    flush_size = settings.MARTINI_QDRANT_UPSERT_BATCH_SIZE * settings.MARTINI_QDRANT_UPSERT_PARALLEL
+
+    chunks_count = 0
+    upsert_time = 0.0
+    pending_chunks = []
+    pending_vectors = []
+    started_at = time.perf_counter()
+
+    def flush():
+        nonlocal chunks_count, upsert_time
+        if not pending_chunks:
+            return
+        latency = store_embeddings(collection_name, pending_chunks, pending_vectors)
+        chunks_count += len(pending_chunks)
+        upsert_time += latency
+        if on_progress is not None:
+            on_progress(0, latency)
+        if on_stored is not None:
+            on_stored(pending_chunks)
+        logger.info(
+            f'Stored {len(pending_chunks)} chunks from {doc_name} in {latency:.2f}s '
+            f'({chunks_count} chunks so far)'
+        )
+        pending_chunks.clear()
+        pending_vectors.clear()
+
+    def collect(future):
+        # Re-raises the exception of a failed batch, cancelling the whole ingestion.
+        batch, vectors, latency = future.result()
+        pending_chunks.extend(batch)
+        pending_vectors.extend(vectors)
+        logger.info(f'Embedded a batch of {len(batch)} chunks from {doc_name} in {latency:.2f}s')
+        if on_progress is not None:
+            on_progress(len(batch), latency)
+        if len(pending_chunks) >= flush_size:
+            flush()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Batches are collected in order, waiting for the oldest one.
+        pending = deque()
+        for batch in batched(chunks, batch_size):
+            if len(pending) >= concurrency:
+                collect(pending.popleft())
+            pending.append(executor.submit(embed_batch, embeddings, batch))
+        while pending:
+            collect(pending.popleft())
+    flush()
+
+    elapsed = time.perf_counter() - started_at
+    logger.info(
+        f'Stored {chunks_count} chunks from {doc_name} in {elapsed:.2f}s '
+        f'({chunks_count / elapsed if elapsed else 0:.1f} chunks/s, {upsert_time:.2f}s upserting)'
+    )
+    return chunks_count
@@ -0,0 +1,241 @@
+import io
+import logging
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+
+def iter_pdf_pages(filepath: str, first_page: int = 1, last_page: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+    '''
+    Extract the text of a PDF document one page at a time.
+    Only the page being interpreted is held in memory, instead of the whole document.
+
+    Args:
+        filepath (str): Path to the PDF file to process.
+        first_page (int): Number of the first page to extract (starting at 1).
+        last_page (int): Number of the last page to extract, included. Defaults to the last page of the document.
+
+    Yields:
+        Tuple[int, str]: The page number (starting at 1) and the text of the page.
+    '''
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+
+    resource_manager = PDFResourceManager(caching=True)
+    output = io.StringIO()
+    converter = TextConverter(resource_manager, output, laparams=LAParams())
+    interpreter = PDFPageInterpreter(resource_manager, converter)
+
+    try:
+        with open(filepath, 'rb') as fp:
+            for page_number, page in enumerate(PDFPage.get_pages(fp), start=1):
+                # Skipped pages are not interpreted, which is where the time goes.
+                if page_number < first_page:
+                    continue
+                if last_page is not None and page_number > last_page:
+                    break
+                interpreter.process_page(page)
+                yield page_number, output.getvalue()
+                # Reset the buffer so that it only ever holds a single page.
+                output.seek(0)
+                output.truncate(0)
+    finally:
+        converter.close()
+
+
+def count_pdf_pages(filepath: str) -> int:
+    '''
+    Count the pages of a PDF document, without interpreting them.
+    '''
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdftypes import resolve1
+
+    with open(filepath, 'rb') as fp:
+        document = PDFDocument(PDFParser(fp))
+        try:
+            return int(resolve1(resolve1(document.catalog['Pages'])['Count']))
+        except (KeyError, TypeError, ValueError):
+            # No page count in the page tree: go through the pages.
+            return sum(1 for _ in PDFPage.create_pages(document))
+
+
+def extract_pdf_pages(filepath: str, first_page: int, last_page: int) -> List[Tuple[int, str]]:
+    '''
+    Extract the text of a range of pages of a PDF document, in a process of the pool of `iter_pdf_pages_parallel`.
+    '''
+    return list(iter_pdf_pages(filepath, first_page, last_page))
+
+
+def iter_pdf_pages_parallel(
+    filepath: str,
+    workers: int,
+    pages_per_task: int,
+    page_count: Optional[int] = None,
+    first_page: int = 1,
+) -> Iterator[Tuple[int, str]]:
+    '''
+    Extract the text of a PDF document with a pool of processes, each extracting a range of pages at a time.
+    Pages are yielded in order, as soon as their range is extracted. At most two ranges per process are
+    extracted ahead of the pages consumed, so that memory does not depend on the size of the document.
+
+    Args:
+        filepath (str): Path to the PDF file to process.
+        workers (int): Number of processes extracting pages.
+        pages_per_task (int): Number of pages of each range.
+        page_count (int): Number of pages of the document, if already known.
+        first_page (int): Number of the first page to extract (starting at 1).
+
+    Yields:
+        Tuple[int, str]: The page number (starting at 1) and the text of the page.
+    '''
+    page_count = page_count or count_pdf_pages(filepath)
+    ranges = (
+        (first_page, min(first_page + pages_per_task - 1, page_count))
+        for first_page in range(first_page, page_count + 1, pages_per_task)
+    )
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = deque(
+            executor.submit(extract_pdf_pages, filepath, first_page, last_page)
+            for first_page, last_page in islice(ranges, workers * 2)
+        )
+        while pending:
+            pages = pending.popleft().result()
+            next_range = next(ranges, None)
+            if next_range is not None:
+                pending.append(executor.submit(extract_pdf_pages, filepath, *next_range))
+            yield from pages
+    finally:
+        # Stop extracting if the pages are not consumed until the end, e.g. if their processing failed.
+        executor.shutdown(cancel_futures=True)
+
+
+def iter_document_pages(filepath: str, first_page: int = 1) -> Iterator[Tuple[int, str]]:
+    '''
+    Extract the text of a PDF document one page at a time: with a pool of MARTINI_PDF_EXTRACTION_WORKERS processes
+    if it has at least MARTINI_PDF_PARALLEL_MIN_PAGES pages left, in the current process otherwise.
+
+    Args:
+        filepath (str): Path to the PDF file to process.
+        first_page (int): Number of the first page to extract (starting at 1), e.g. to resume an extraction.
+
+    Yields:
+        Tuple[int, str]: The page number (starting at 1) and the text of the page.
+    '''
+    workers = settings.MARTINI_PDF_EXTRACTION_WORKERS
+    # Daemonic processes, such as the children of Celery's prefork pool, cannot start processes.
+    if workers > 1 and not multiprocessing.current_process().daemon:
+        page_count = count_pdf_pages(filepath)
+        if page_count - first_page + 1 >= settings.MARTINI_PDF_PARALLEL_MIN_PAGES:
+            logger.info(f'Extracting {page_count - first_page + 1} pages from {filepath} with {workers} processes')
+            yield from iter_pdf_pages_parallel(
+                filepath, workers, settings.MARTINI_PDF_PAGES_PER_TASK, page_count, first_page
+            )
+            return
+    yield from iter_pdf_pages(filepath, first_page)
+
+
+def iter_chunks(
+    pages: Iterable[Tuple[int, str]],
+    chunk_size: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+    state: Optional[dict] = None,
+    on_page: Optional[Callable[[dict], None]] = None,
+) -> Iterator[Document]:
+    '''
+    Split a stream of pages into chunks, incrementally.
+    The last chunk of a page is carried over and split again along with the next page,
+    so that chunks (and their overlap) flow across page boundaries as if the document
+    had been split in one go.
+    The state of the splitting after each page (`page`: the page split, `chunk`: the index of the next chunk,
+    `carry` and `carry_page`: the text carried over and the page it starts on, `carry_pages`: the offsets in it
+    where pages start, along with their numbers) can be recorded with `on_page`, to resume the splitting later on
+    from the next page, with the same chunks.
+
+    Args:
+        pages (Iterable[Tuple[int, str]]): Page numbers and texts, e.g. from `iter_pdf_pages`.
+        chunk_size (int): Maximum size of a chunk. Defaults to MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_SIZE.
+        chunk_overlap (int): Overlap between chunks. Defaults to MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_OVERLAP.
+        state (dict): State recorded with `on_page` to resume from, `pages` starting at the page after it.
+        on_page (Callable[[dict], None]): Called with the state of the splitting after each page,
+            before the chunks ending on the next pages are yielded.
+
+    Yields:
+        Document: A chunk, with the page it starts on and its index in the document as metadata.
+    '''
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size or settings.MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_SIZE,
+        chunk_overlap=chunk_overlap or settings.MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_OVERLAP,
+    )
+
+    chunk_index = state['chunk'] if state else 0
+    carry = state['carry'] if state else ''
+    # Offsets in the carried over text where pages start, as it may span several short pages.
+    carry_pages = (state.get('carry_pages') or [[0, state['carry_page']]]) if carry else []
+    for page_number, page_text in pages:
+        if on_page is not None:
+            # The chunks of the previous pages are all yielded by now.
+            on_page({
+                'page': page_number - 1,
+                'chunk': chunk_index,
+                'carry': carry,
+                'carry_page': carry_pages[0][1] if carry_pages else None,
+                'carry_pages': carry_pages,
+            })
+        if not page_text.strip():
+            continue
+
+        text = f'{carry}\n{page_text}' if carry else page_text
+        page_starts = carry_pages + [[len(carry) + 1 if carry else 0, page_number]]
+        chunks = text_splitter.split_text(text)
+        if not chunks:
+            continue
+
+        # Locate each chunk in the text to attribute it to the page it starts on.
+        cursor = 0
+        positions = []
+        for chunk in chunks:
+            position = text.find(chunk, cursor)
+            if position == -1:
+                position = cursor
+            positions.append(position)
+            cursor = position + 1
+        pages_of_chunks = [
+            next(page for offset, page in reversed(page_starts) if offset <= position) for position in positions
+        ]
+
+        for chunk, chunk_page in zip(chunks[:-1], pages_of_chunks[:-1]):
+            yield Document(page_content=chunk, metadata={'page': chunk_page, 'chunk': chunk_index})
+            chunk_index += 1
+
+        carry, position = chunks[-1], positions[-1]
+        carry_pages = [[0, pages_of_chunks[-1]]] + [
+            [offset - position, page] for offset, page in page_starts if position < offset < position + len(carry)
+        ]
+
+    if carry:
+        yield Document(page_content=carry, metadata={'page': carry_pages[0][1], 'chunk': chunk_index})
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    '''
+    Group the items of an iterable in lists of at most `size` items, lazily.
+    '''
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
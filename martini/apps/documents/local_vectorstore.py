@@ -0,0 +1,398 @@
+import os
+import json
+import uuid
+import fcntl
+import shutil
+import logging
+import threading
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from apps.chats.embeddings import normalize_vectors
+
+logger = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+LOCK_FILE = '.lock'
+# Rows of vectors scored at once when searching, to bound the memory used by a search.
+SEARCH_BLOCK_ROWS = 8192
+
+
+@dataclass
+class _Snapshot:
+    '''
+    Rows of a collection visible to searches, as of a version of its meta file.
+    '''
+    version: int
+    vectors: np.ndarray
+    instance_ids: np.ndarray
+    payloads: np.ndarray
+    payload_starts: np.ndarray
+    payload_ends: np.ndarray
+
+    def payload(self, row: int) -> dict:
+        return json.loads(bytes(self.payloads[self.payload_starts[row]:self.payload_ends[row]]))
+
+    def document(self, row: int) -> Document:
+        payload = self.payload(row)
+        return Document(page_content=payload['text'], metadata=payload['metadata'])
+
+
+class LocalCollection:
+    '''
+    A collection of the local vector store, stored in its own directory:
+    - vectors.<generation>.f32: vectors (normalized, for cosine similarity), as a float32 matrix;
+    - instance_ids.<generation>.i64: instance_id of the UnstructuredDocument of each vector, to filter and delete;
+    - payloads.<generation>.jsonl: ID, text and metadata of each vector, one JSON line each,
+      only parsed for search results;
+    - meta.json: dimension, number of rows and size of the payloads.
+    Files are memory-mapped, so that the OS pages vectors in and out, and shares them between processes.
+    Rows are appended after the ones counted in meta.json, which is then replaced atomically:
+    searches never see partial writes. Deleting rows writes the next generation of the files,
+    and so does adding rows with the IDs of rows already stored, which replaces them.
+    Writes are serialized between threads and processes with a lock file.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._snapshot = None
+
+    def create(self, dimension: int):
+        '''
+        Create the collection, replacing any existing one.
+        '''
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            meta = {'dimension': dimension, 'count': 0, 'payload_bytes': 0, 'generation': 0, 'version': 0}
+            for name in self._data_files(meta):
+                open(os.path.join(self.path, name), 'wb').close()
+            self._write_meta(meta)
+            self._snapshot = None
+
+    def _data_files(self, meta: dict) -> Tuple[str, str, str]:
+        generation = meta['generation']
+        return f'vectors.{generation}.f32', f'instance_ids.{generation}.i64', f'payloads.{generation}.jsonl'
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(os.path.join(self.path, META_FILE)) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            raise ValueError(f'Collection {os.path.basename(self.path)} does not exist')
+
+    def _write_meta(self, meta: dict):
+        temp_path = os.path.join(self.path, f'{META_FILE}.{uuid.uuid4().hex}')
+        with open(temp_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(temp_path, os.path.join(self.path, META_FILE))
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock, open(os.path.join(self.path, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _map(self, name: str, dtype, shape) -> np.ndarray:
+        if not np.prod(shape):
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    def snapshot(self) -> _Snapshot:
+        '''
+        Return the rows of the collection, mapped again if it changed since the last call.
+        '''
+        meta = self._read_meta()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == meta['version']:
+            return snapshot
+        with self._lock:
+            try:
+                return self._map_snapshot(meta)
+            except FileNotFoundError:
+                # The files were replaced by a deletion in another process since meta.json was read.
+                return self._map_snapshot(self._read_meta())
+
+    def _map_snapshot(self, meta: dict) -> _Snapshot:
+        vectors_file, instance_ids_file, payloads_file = self._data_files(meta)
+        payloads = self._map(payloads_file, np.uint8, (meta['payload_bytes'],))
+        payload_ends = np.flatnonzero(payloads == ord('\n')) + 1
+        self._snapshot = _Snapshot(
+            version=meta['version'],
+            vectors=self._map(vectors_file, np.float32, (meta['count'], meta['dimension'])),
+            instance_ids=self._map(instance_ids_file, np.int64, (meta['count'],)),
+            payloads=payloads,
+            payload_starts=np.concatenate(([0], payload_ends[:-1])).astype(np.int64),
+            payload_ends=payload_ends,
+        )
+        return self._snapshot
+
+    def _write_at(self, name: str, offset: int, data: bytes):
+        # Anything past the rows counted in meta.json is left over by an interrupted write: overwrite it.
+        with open(os.path.join(self.path, name), 'r+b') as data_file:
+            data_file.seek(offset)
+            data_file.write(data)
+            data_file.truncate()
+
+    def add(self, ids: List[str], texts: List[str], vectors: List[List[float]], metadatas: List[dict]):
+        '''
+        Append vectors to the collection, with their IDs, texts and metadata,
+        replacing the vectors of the same UnstructuredDocument instances already stored with the same IDs.
+        '''
+        if not ids:
+            return
+        vectors = normalize_vectors(np.asarray(vectors, dtype=np.float32))
+        instance_ids = np.array([metadata.get('instance_id', -1) for metadata in metadatas], dtype=np.int64)
+        payloads = b''.join(
+            json.dumps({'id': id, 'text': text, 'metadata': metadata}).encode('utf-8') + b'\n'
+            for id, text, metadata in zip(ids, texts, metadatas)
+        )
+        with self._write_lock():
+            meta = self._read_meta()
+            if vectors.shape[1] != meta['dimension']:
+                raise ValueError(
+                    f'Vectors of dimension {vectors.shape[1]} cannot be stored in '
+                    f'collection {os.path.basename(self.path)}, of dimension {meta["dimension"]}'
+                )
+            snapshot = self.snapshot()
+            # Only the payloads of the rows of the same instances are parsed: none for a new document.
+            replaced = set(ids)
+            replaced_rows = [
+                row for row in self._candidate_rows(snapshot, set(instance_ids.tolist()) - {-1})
+                if snapshot.payload(row)['id'] in replaced
+            ]
+            if replaced_rows:
+                self._keep_rows(meta, snapshot, np.setdiff1d(np.arange(meta['count']), replaced_rows))
+            vectors_file, instance_ids_file, payloads_file = self._data_files(meta)
+            self._write_at(vectors_file, meta['count'] * meta['dimension'] * 4, vectors.tobytes())
+            self._write_at(instance_ids_file, meta['count'] * 8, instance_ids.tobytes())
+            self._write_at(payloads_file, meta['payload_bytes'], payloads)
+            meta['count'] += len(ids)
+            meta['payload_bytes'] += len(payloads)
+            meta['version'] += 1
+            self._write_meta(meta)
+
+    def delete(self, instance_ids: Iterable[int]) -> int:
+        '''
+        Delete the vectors of UnstructuredDocument instances. Returns the number of vectors deleted.
+        '''
+        with self._write_lock():
+            meta = self._read_meta()
+            snapshot = self.snapshot()
+            keep = np.flatnonzero(~np.isin(snapshot.instance_ids, list(instance_ids)))
+            deleted = len(snapshot.instance_ids) - len(keep)
+            if not deleted:
+                return 0
+            self._keep_rows(meta, snapshot, keep)
+            logger.info(f'Deleted {deleted} vectors from local collection {os.path.basename(self.path)}')
+            return deleted
+
+    def _keep_rows(self, meta: dict, snapshot: _Snapshot, keep: np.ndarray):
+        # Write the next generation of the files with the rows to keep only, updating `meta`.
+        # Called with the write lock held.
+        previous_files = self._data_files(meta)
+        meta['generation'] += 1
+        vectors_file, instance_ids_file, payloads_file = self._data_files(meta)
+        payload_bytes = 0
+        with open(os.path.join(self.path, vectors_file), 'wb') as vectors_out, \
+                open(os.path.join(self.path, payloads_file), 'wb') as payloads_out:
+            for start in range(0, len(keep), SEARCH_BLOCK_ROWS):
+                rows = keep[start:start + SEARCH_BLOCK_ROWS]
+                vectors_out.write(np.ascontiguousarray(snapshot.vectors[rows]).tobytes())
+                for row in rows:
+                    payload = snapshot.payloads[snapshot.payload_starts[row]:snapshot.payload_ends[row]]
+                    payloads_out.write(payload.tobytes())
+                    payload_bytes += len(payload)
+        with open(os.path.join(self.path, instance_ids_file), 'wb') as instance_ids_out:
+            instance_ids_out.write(np.ascontiguousarray(snapshot.instance_ids[keep]).tobytes())
+
+        meta['count'] = len(keep)
+        meta['payload_bytes'] = payload_bytes
+        meta['version'] += 1
+        self._write_meta(meta)
+        # Searches still using the previous files keep them open until they are done.
+        for name in previous_files:
+            os.remove(os.path.join(self.path, name))
+
+    def _candidate_rows(self, snapshot: _Snapshot, instance_ids: Optional[Iterable[int]]) -> Optional[np.ndarray]:
+        if instance_ids is None:
+            return None
+        return np.flatnonzero(np.isin(snapshot.instance_ids, list(instance_ids)))
+
+    def search_batch(
+        self,
+        query_vectors: List[List[float]],
+        k: int,
+        instance_ids: Optional[Iterable[int]] = None,
+        with_vectors: bool = False,
+    ) -> List[List[Tuple[Document, float, Optional[List[float]]]]]:
+        '''
+        Search the `k` vectors most similar (cosine) to each of the query vectors, among the vectors
+        of the UnstructuredDocument instances of `instance_ids` if specified.
+        Exact search: the queries are scored against blocks of SEARCH_BLOCK_ROWS vectors at a time,
+        keeping the best `k` of each block.
+        Returns the matching chunks of each query, with their score and, if requested, their vector.
+        '''
+        snapshot = self.snapshot()
+        queries = normalize_vectors(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        candidate_rows = self._candidate_rows(snapshot, instance_ids)
+        rows_count = len(snapshot.vectors) if candidate_rows is None else len(candidate_rows)
+
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, rows_count, SEARCH_BLOCK_ROWS):
+            if candidate_rows is None:
+                rows = np.arange(start, min(start + SEARCH_BLOCK_ROWS, rows_count))
+                block = snapshot.vectors[start:start + SEARCH_BLOCK_ROWS]
+            else:
+                rows = candidate_rows[start:start + SEARCH_BLOCK_ROWS]
+                block = snapshot.vectors[rows]
+            scores = np.concatenate((best_scores, queries @ block.T), axis=1)
+            rows = np.concatenate((best_rows, np.broadcast_to(rows, (len(queries), len(rows)))), axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [
+            [
+                (
+                    snapshot.document(row),
+                    float(score),
+                    snapshot.vectors[row].tolist() if with_vectors else None,
+                )
+                for row, score in zip(query_rows, query_scores)
+            ]
+            for query_rows, query_scores in zip(best_rows, best_scores)
+        ]
+
+    def search(
+        self,
+        query_vector: List[float],
+        k: int,
+        instance_ids: Optional[Iterable[int]] = None,
+        with_vectors: bool = False,
+    ) -> List[Tuple[Document, float, Optional[List[float]]]]:
+        '''
+        Same as `search_batch`, for a single query vector.
+        '''
+        return self.search_batch([query_vector], k, instance_ids, with_vectors)[0]
+
+    def records(
+        self,
+        instance_ids: Iterable[int],
+        batch_size: int,
+    ) -> Iterator[Tuple[List[str], List[List[float]], List[dict]]]:
+        '''
+        Iterate over the texts, vectors and metadata of UnstructuredDocument instances, `batch_size` at a time.
+        '''
+        snapshot = self.snapshot()
+        rows = self._candidate_rows(snapshot, instance_ids)
+        for start in range(0, len(rows), batch_size):
+            documents = [snapshot.document(row) for row in rows[start:start + batch_size]]
+            yield (
+                [document.page_content for document in documents],
+                snapshot.vectors[rows[start:start + batch_size]].tolist(),
+                [document.metadata for document in documents],
+            )
+
+
+class LocalVectorStore:
+    '''
+    In-process vector store, keeping each collection in memory-mapped files under `path`.
+    An alternative to Qdrant for small deployments and CI, where running a Qdrant server
+    for a few thousand vectors is not worth it. Processes sharing `path` share the collections.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def collection(self, name: str) -> LocalCollection:
+        if not name or name.startswith('.') or os.sep in name:
+            raise ValueError(f'Invalid collection name: {name}')
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = LocalCollection(os.path.join(self.path, name))
+            return collection
+
+    def create_collection(self, name: str, dimension: int):
+        self.collection(name).create(dimension)
+
+    def delete_collection(self, name: str):
+        with self._lock:
+            self._collections.pop(name, None)
+        shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+class LocalVectorStoreForChains(VectorStore):
+    '''
+    Langchain wrapper of a collection of the local vector store, for usage in Langchain's chains.
+    '''
+
+    def __init__(self, collection: LocalCollection, embeddings: Embeddings):
+        self.collection = collection
+        self.embeddings = embeddings
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self._add(texts, self.embeddings.embed_documents(texts), metadatas)
+
+    def _add(self, texts: List[str], vectors: List[List[float]], metadatas: Optional[List[dict]]) -> List[str]:
+        # Same IDs as in Qdrant: adding the chunks of a document again replaces them.
+        from apps.documents.vectorstore import point_id
+
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [point_id(metadata) for metadata in metadatas]
+        self.collection.add(ids, texts, vectors, metadatas)
+        return ids
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return [result[:2] for result in self.collection.search(self.embeddings.embed_query(query), k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        path: Optional[str] = None,
+        collection_name: Optional[str] = None,
+        **kwargs: Any,
+    ) -> 'LocalVectorStoreForChains':
+        '''
+        Create a collection of the local vector store under `path`, named `collection_name` (random by default)
+        and sized for the vectors of `embedding`, replacing any existing one, then add texts to it.
+        '''
+        if path is None:
+            raise ValueError('The path of the local vector store is required.')
+        texts = list(texts)
+        if not texts:
+            raise ValueError('At least one text is required to size the collection.')
+        vectors = embedding.embed_documents(texts)
+        collection = LocalVectorStore(path).collection(collection_name or uuid.uuid4().hex)
+        collection.create(len(vectors[0]))
+        store = cls(collection, embedding)
+        store._add(texts, vectors, metadatas)
+        return store
@@ -0,0 +1,102 @@
+import os
+import time
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.documents.loaders import iter_pdf_pages, iter_pdf_pages_parallel
+
+LOREM_IPSUM = (
+    'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore '
+    'et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris.'
+).split()
+
+
+def write_synthetic_pdf(path: str, pages: int, lines_per_page: int):
+    '''
+    Write a PDF document of `pages` pages of text, `lines_per_page` lines each.
+    '''
+    objects = {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    }
+    kids = []
+    for page in range(pages):
+        page_id, content_id = 4 + 2 * page, 5 + 2 * page
+        kids.append(page_id)
+        lines = []
+        for line in range(lines_per_page):
+            words = [LOREM_IPSUM[(page + line + word) % len(LOREM_IPSUM)] for word in range(12)]
+            lines.append(f'(Page {page + 1}, line {line + 1}: {" ".join(words)}) \''.encode('latin-1'))
+        text = b'BT /F1 9 Tf 40 800 Td 11 TL ' + b' '.join(lines) + b' ET'
+        objects[page_id] = (
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % content_id
+        )
+        objects[content_id] = b'<< /Length %d >>\nstream\n%s\nendstream' % (len(text), text)
+    objects[2] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % kid for kid in kids), pages)
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(output)
+        output += b'%d 0 obj\n%s\nendobj\n' % (object_id, objects[object_id])
+    xref_offset = len(output)
+    size = max(objects) + 1
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % size
+    output += b''.join(b'%010d 00000 n \n' % offsets[object_id] for object_id in range(1, size))
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref_offset)
+    with open(path, 'wb') as fp:
+        fp.write(output)
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the text extraction of a synthetic PDF document in the current process '
+        'with its extraction by a pool of processes, by ranges of pages.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=400, help='Number of pages of the document.')
+        parser.add_argument('--lines', type=int, default=50, help='Number of lines of text per page.')
+        parser.add_argument(
+            '--workers', type=int, default=settings.MARTINI_PDF_EXTRACTION_WORKERS,
+            help='Number of processes extracting pages. Defaults to MARTINI_PDF_EXTRACTION_WORKERS.'
+        )
+        parser.add_argument(
+            '--pages-per-task', type=int, default=settings.MARTINI_PDF_PAGES_PER_TASK,
+            help='Number of pages extracted by a process at a time. Defaults to MARTINI_PDF_PAGES_PER_TASK.'
+        )
+
+    def handle(self, *args, **options):
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            write_synthetic_pdf(path, options['pages'], options['lines'])
+
+            started_at = time.perf_counter()
+            sequential_pages = list(iter_pdf_pages(path))
+            sequential_time = time.perf_counter() - started_at
+
+            started_at = time.perf_counter()
+            parallel_pages = list(
+                iter_pdf_pages_parallel(path, options['workers'], options['pages_per_task'])
+            )
+            parallel_time = time.perf_counter() - started_at
+        finally:
+            os.remove(path)
+
+        if parallel_pages != sequential_pages:
+            self.stderr.write('Pages extracted in parallel differ from the pages extracted sequentially.')
+            return
+
+        self.stdout.write(
+            f'sequential      extracted {len(sequential_pages)} pages in {sequential_time:.2f}s '
+            f'({len(sequential_pages) / sequential_time:.1f} pages/s)'
+        )
+        self.stdout.write(
+            f'{options["workers"]} processes     extracted {len(parallel_pages)} pages in {parallel_time:.2f}s '
+            f'({len(parallel_pages) / parallel_time:.1f} pages/s), '
+            f'{sequential_time / parallel_time:.2f}x speedup on {os.cpu_count()} CPUs'
+        )
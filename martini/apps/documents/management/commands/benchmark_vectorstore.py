@@ -0,0 +1,116 @@
+import os
+import time
+import uuid
+import random
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from typing import List
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from qdrant_client import QdrantClient
+
+from apps.documents import vectorstore
+from apps.documents.local_vectorstore import LocalVectorStore
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare upsert and search times against Qdrant of the previous client (REST, one request per '
+        'batch of embeddings) with the configured one (MARTINI_QDRANT_* settings, parallel bulk upserts), '
+        'and with the local memory-mapped vector store. '
+        'Random vectors are stored in a temporary collection, deleted afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--points', type=int, default=5000, help='Number of points to upsert.')
+        parser.add_argument('--searches', type=int, default=200, help='Number of searches to run.')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Points per upsert request of the previous client, i.e. MARTINI_EMBEDDING_BATCH_SIZE.'
+        )
+        parser.add_argument(
+            '--backends', nargs='+', choices=['previous', 'configured', 'local'],
+            default=['previous', 'configured', 'local'],
+            help='Vector stores to benchmark. Only "local" runs without a Qdrant server.'
+        )
+
+    def handle(self, *args, **options):
+        dimension = int(os.environ.get('EMBEDDINGS_DIMENSION_OPENAI') or 1536)
+        texts = [f'Benchmark chunk {i}.' for i in range(options['points'])]
+        vectors = [self.random_vector(dimension) for _ in texts]
+        metadatas = [{'instance_id': 0, 'page': i // 10, 'chunk': i} for i in range(len(texts))]
+        queries = [self.random_vector(dimension) for _ in range(options['searches'])]
+
+        backends = {
+            'previous': ('previous (REST)', self.qdrant_backend, options['batch_size']),
+            'configured': ('configured', self.qdrant_backend, None),
+            'local': ('local (mmap)', self.local_backend, None),
+        }
+        for backend in options['backends']:
+            label, use_backend, batch_size = backends[backend]
+            collection_name = f'benchmark-{uuid.uuid4().hex}'
+            with use_backend(backend):
+                vectorstore.create_vectorstore_collection(collection_name, dimension=dimension)
+                try:
+                    upsert_time = self.upsert(collection_name, texts, vectors, metadatas, batch_size)
+                    latencies = self.search(collection_name, queries)
+                finally:
+                    vectorstore.delete_vectorstore_collection(collection_name)
+
+            self.stdout.write(
+                f'{label:<16} upserted {len(texts)} points in {upsert_time:.2f}s '
+                f'({len(texts) / upsert_time:.0f} points/s), '
+                f'search p50 {self.percentile(latencies, 50) * 1000:.1f}ms, '
+                f'p99 {self.percentile(latencies, 99) * 1000:.1f}ms'
+            )
+
+    @contextmanager
+    def qdrant_backend(self, backend: str):
+        if backend == 'previous':
+            client = QdrantClient(url=os.environ.get('QDRANT_URL'), prefer_grpc=False)
+        else:
+            client = vectorstore.create_client()
+        with mock.patch.object(vectorstore, 'get_local_store', return_value=None), \
+                mock.patch.object(vectorstore, 'get_client', return_value=client):
+            yield
+
+    @contextmanager
+    def local_backend(self, backend: str):
+        path = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(vectorstore, 'get_local_store', return_value=LocalVectorStore(path)):
+                yield
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def upsert(self, collection_name: str, texts, vectors, metadatas, batch_size: int = None) -> float:
+        started_at = time.perf_counter()
+        if batch_size is None:
+            vectorstore.upsert_embeddings(collection_name, texts, vectors, metadatas)
+        else:
+            for start in range(0, len(texts), batch_size):
+                end = start + batch_size
+                vectorstore.upsert_embeddings(
+                    collection_name, texts[start:end], vectors[start:end], metadatas[start:end],
+                    batch_size=batch_size, parallel=1,
+                )
+        return time.perf_counter() - started_at
+
+    def search(self, collection_name: str, queries: List[List[float]]) -> List[float]:
+        latencies = []
+        for query in queries:
+            started_at = time.perf_counter()
+            vectorstore.search_by_vector(collection_name, query)
+            latencies.append(time.perf_counter() - started_at)
+        return latencies
+
+    def random_vector(self, dimension: int) -> List[float]:
+        return [random.uniform(-1, 1) for _ in range(dimension)]
+
+    def percentile(self, values: List[float], percent: int) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
@@ -0,0 +1,79 @@
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.documents.models import DocumentCollection, ReembeddingJob
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-embed the documents of a collection from their stored files into a new Qdrant collection, '
+        'e.g. with another embedding backend or after a change of chunk size, while the current one keeps '
+        'answering questions. The collection is switched to the new Qdrant collection once all documents '
+        'are re-embedded, and the previous one is deleted. An interrupted re-embedding can be resumed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', help='Slug of the collection to re-embed.')
+        parser.add_argument(
+            '--embedding-backend', choices=[choice for choice, _ in DocumentCollection.EMBEDDING_BACKEND_CHOICES],
+            help='Embedding backend to re-embed the documents with. Defaults to the current one of the collection.'
+        )
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Resume the last re-embedding of the collection, if it did not succeed.'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=settings.MARTINI_REEMBEDDING_PAUSE,
+            help='Seconds to wait between documents. Defaults to MARTINI_REEMBEDDING_PAUSE.'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.MARTINI_REEMBEDDING_CONCURRENCY,
+            help='Batches of chunks embedded concurrently. Defaults to MARTINI_REEMBEDDING_CONCURRENCY.'
+        )
+        parser.add_argument(
+            '--grace-period', type=int, default=settings.MARTINI_REEMBEDDING_GRACE_PERIOD,
+            help=(
+                'Seconds to wait before deleting the previous Qdrant collection. '
+                'Defaults to MARTINI_REEMBEDDING_GRACE_PERIOD.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        try:
+            collection = DocumentCollection.objects.get(slug=options['collection'])
+        except DocumentCollection.DoesNotExist:
+            raise CommandError(f'Collection "{options["collection"]}" does not exist.')
+
+        try:
+            if options['resume']:
+                job = ReembeddingJob.resume(collection)
+            else:
+                job = ReembeddingJob.start(collection, options['embedding_backend'])
+        except (ValueError, ImproperlyConfigured) as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f'Re-embedding collection "{collection.slug}" into "{job.vectorstore_name}" '
+            f'with the "{job.embedding_backend}" embedding backend ({job.pending} documents left).'
+        )
+
+        try:
+            ReembeddingJob.run(job.id, pause=options['pause'], concurrency=options['concurrency'])
+        except BaseException as e:
+            # Including interruptions (Ctrl-C): the job can be resumed with --resume.
+            ReembeddingJob.fail(job.id, str(e) or type(e).__name__)
+            raise
+        job.refresh_from_db()
+        self.stdout.write(
+            f'Switched collection "{collection.slug}" to "{job.vectorstore_name}": '
+            f'{job.done} documents done, {job.failed} failed.'
+        )
+
+        if job.previous_vectorstore_name:
+            self.stdout.write(
+                f'Deleting "{job.previous_vectorstore_name}" in {options["grace_period"]} seconds.'
+            )
+            time.sleep(options['grace_period'])
+            ReembeddingJob.collect_garbage(job.id)
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0004_unstructureddocument_has_embeddings_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentcollection',
+            name='content_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,27 @@
+import logging
+
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+
+def create_payload_indexes(apps, schema_editor):
+    from ..vectorstore import create_payload_indexes
+
+    DocumentCollection = apps.get_model('documents', 'DocumentCollection')
+    for slug in DocumentCollection.objects.values_list('slug', flat=True):
+        try:
+            create_payload_indexes(slug)
+        except Exception as e:
+            logger.warning(f'Could not create payload indexes of collection "{slug}": {e}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0007_documentcollection_content_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_payload_indexes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:22
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_create_payload_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentcollection',
+            name='hnsw_ef_construct',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(4)]),
+        ),
+        migrations.AddField(
+            model_name='documentcollection',
+            name='hnsw_m',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(4)]),
+        ),
+        migrations.AddField(
+            model_name='documentcollection',
+            name='on_disk_payload',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='documentcollection',
+            name='on_disk_vectors',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='documentcollection',
+            name='quantization_oversampling',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1.0)]),
+        ),
+        migrations.AddField(
+            model_name='documentcollection',
+            name='quantization_rescore',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='documentcollection',
+            name='scalar_quantization',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='documentcollection',
+            name='search_hnsw_ef',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
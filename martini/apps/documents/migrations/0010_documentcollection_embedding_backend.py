@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_documentcollection_index_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentcollection',
+            name='embedding_backend',
+            field=models.CharField(choices=[('openai', 'OpenAI'), ('onnx', 'Local ONNX model'), ('hashing', 'Hashing (tests and development only)')], default='openai', max_length=20),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0011_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentcollection',
+            name='vectorstore_name',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.CreateModel(
+            name='ReembeddingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('embedding_backend', models.CharField(choices=[('openai', 'OpenAI'), ('onnx', 'Local ONNX model'), ('hashing', 'Hashing (tests and development only)')], max_length=20)),
+                ('vectorstore_name', models.CharField(max_length=100)),
+                ('previous_vectorstore_name', models.CharField(blank=True, max_length=100, null=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('last_document_id', models.BigIntegerField(default=0)),
+                ('done', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('switched_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reembedding_jobs', to='documents.documentcollection')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='reembeddingjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'running')), fields=('collection',), name='unique_running_reembedding_job'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+def mark_processed_documents_indexed(apps, schema_editor):
+    UnstructuredDocument = apps.get_model('documents', 'UnstructuredDocument')
+    UnstructuredDocument.objects.filter(has_embeddings=True).update(status='indexed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0012_reembeddingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='chunking_seconds',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='chunks_embedded',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='chunks_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='embedding_seconds',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='pages_parsed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='pages_total',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='parsing_seconds',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='processing_finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='processing_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('parsing', 'Parsing'), ('chunking', 'Chunking'), ('embedding', 'Embedding'), ('indexed', 'Indexed'), ('failed', 'Failed')], default='queued', max_length=20),
+        ),
+        migrations.RunPython(mark_processed_documents_indexed, migrations.RunPython.noop),
+    ]
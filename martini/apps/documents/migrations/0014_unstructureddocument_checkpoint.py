@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0013_unstructureddocument_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='checkpoint',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.3 on 2026-10-18 11:04
+
+import os
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def upload_time(file_name):
+    # Stored files are named after the time they were uploaded at: {timestamp}_{uuid}.pdf.
+    try:
+        return datetime.fromtimestamp(int(os.path.basename(file_name).split('_', 1)[0]), tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+def backfill_created_at(apps, schema_editor):
+    UnstructuredDocument = apps.get_model('documents', 'UnstructuredDocument')
+    documents = (
+        UnstructuredDocument.objects
+        .filter(created_at__isnull=True)
+        .select_related('import_job')
+        .only('id', 'file', 'import_job__created_at', 'processing_started_at')
+    )
+    batch = []
+    for document in documents.iterator(chunk_size=1000):
+        # Best estimates for existing documents: when their file was uploaded, or imported,
+        # or when their processing started.
+        document.created_at = (
+            upload_time(document.file.name or '')
+            or (document.import_job.created_at if document.import_job else None)
+            or document.processing_started_at
+        )
+        if document.created_at is not None:
+            batch.append(document)
+        if len(batch) >= 1000:
+            UnstructuredDocument.objects.bulk_update(batch, ['created_at'])
+            batch = []
+    UnstructuredDocument.objects.bulk_update(batch, ['created_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0014_unstructureddocument_checkpoint'),
+    ]
+
+    operations = [
+        # Added without auto_now_add first, which would set existing rows to the time of the migration.
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_created_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='unstructureddocument',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='DeletionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_before', models.DateTimeField(blank=True, null=True)),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('done', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('collection', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='deletion_jobs', to='documents.documentcollection')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='unstructureddocument',
+            name='deletion_job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='documents', to='documents.deletionjob'),
+        ),
+    ]
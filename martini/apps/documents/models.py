@@ -1,8 +1,17 @@
 import os
+import time
+import uuid
 import logging
+import dataclasses
 
-from django.db import models
+from collections import deque
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from django.db import models, transaction
 from django.conf import settings
+from django.core.validators import MinValueValidator
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
@@ -12,60 +21,311 @@ class DocumentCollection(models.Model):
     DocumentCollection regroups UnstructuredDocuments.
     In other words, a DocumentCollection is a group of documents that are related,
     and that can be searched together.
-    DocumentCollection stores its documents in a single Qdrant collection.
+    DocumentCollection stores its documents in a single Qdrant collection,
+    named after its slug unless the collection was re-embedded (see ReembeddingJob).
     '''
+    EMBEDDING_BACKEND_CHOICES = [
+        ('openai', 'OpenAI'),
+        ('onnx', 'Local ONNX model'),
+        ('hashing', 'Hashing (tests and development only)'),
+    ]
+
     name = models.CharField(max_length=75, unique=True, null=True)
     slug = models.SlugField(unique=True, null=True)
     description = models.TextField(null=True, blank=True)
+    # Incremented whenever the embeddings stored in the collection change,
+    # so that anything derived from its content (e.g. cached answers) can be invalidated.
+    content_version = models.PositiveIntegerField(default=0)
+    # Settings of the vector index of the Qdrant collection (see IndexProfile), Qdrant's defaults if null.
+    hnsw_m = models.PositiveSmallIntegerField(null=True, blank=True, validators=[MinValueValidator(4)])
+    hnsw_ef_construct = models.PositiveSmallIntegerField(null=True, blank=True, validators=[MinValueValidator(4)])
+    search_hnsw_ef = models.PositiveSmallIntegerField(null=True, blank=True, validators=[MinValueValidator(1)])
+    scalar_quantization = models.BooleanField(default=False)
+    quantization_rescore = models.BooleanField(default=True)
+    quantization_oversampling = models.FloatField(null=True, blank=True, validators=[MinValueValidator(1.0)])
+    on_disk_vectors = models.BooleanField(default=False)
+    on_disk_payload = models.BooleanField(default=False)
+    # Model embedding the documents of the collection and the questions asked to it.
+    # It sets the dimension of the vectors of the Qdrant collection, so it can only be changed
+    # by re-embedding the collection into a new Qdrant collection (see ReembeddingJob).
+    embedding_backend = models.CharField(max_length=20, choices=EMBEDDING_BACKEND_CHOICES, default='openai')
+    # Name of the Qdrant collection serving the collection, if not its slug (i.e. once re-embedded).
+    vectorstore_name = models.CharField(max_length=100, null=True, blank=True)
 
     def __str__(self):
         return f'DocumentCollection (name="{self.name}")'
 
+    @property
+    def index_profile(self) -> 'IndexProfile':
+        '''
+        Settings of the vector index of the Qdrant collection.
+        '''
+        from apps.documents.vectorstore import IndexProfile
+
+        return IndexProfile(**{
+            field.name: getattr(self, field.name) for field in dataclasses.fields(IndexProfile)
+        })
+
+    @property
+    def vectorstore_collection_name(self) -> str:
+        '''
+        Name of the Qdrant collection searched to answer questions about the collection.
+        '''
+        return self.vectorstore_name or self.slug
+
+    @classmethod
+    def get_vectorstore_collection_names(cls, slug: str) -> List[str]:
+        '''
+        Names of the Qdrant collections holding embeddings of the collection with the given slug:
+        the one serving it, and the one being built by a re-embedding in progress, if any.
+        '''
+        collection = cls.objects.get(slug=slug)
+        names = [collection.vectorstore_collection_name]
+        job = collection.reembedding_jobs.filter(status=ReembeddingJob.STATUS_RUNNING).first()
+        if job is not None and job.vectorstore_name not in names:
+            names.append(job.vectorstore_name)
+        return names
+
+    @classmethod
+    def bump_content_version(cls, slug: str):
+        '''
+        Mark the content of the collection with the given slug as changed.
+        '''
+        cls.objects.filter(slug=slug).update(content_version=models.F('content_version') + 1)
+
+    @classmethod
+    def get_default(cls) -> 'DocumentCollection':
+        '''
+        Return the collection documents are assigned to when none is specified.
+        '''
+        return cls.objects.get(slug=settings.MARTINI_DEFAULT_COLLECTION_NAME)
+
 
 class UnstructuredDocument(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('parsing', 'Parsing'),
+        ('chunking', 'Chunking'),
+        ('embedding', 'Embedding'),
+        ('indexed', 'Indexed'),
+        ('failed', 'Failed'),
+    ]
+
     name = models.CharField(max_length=255, default='Untitled')
     description = models.TextField(null=True, blank=True)
     file = models.FileField()
     task_id = models.CharField(max_length=255, blank=True, null=True)
     has_embeddings = models.BooleanField(default=False)
+    # SHA-256 of the file, used to spot documents uploaded several times.
+    sha256 = models.CharField(max_length=64, blank=True, null=True, db_index=True)
     collection = models.ForeignKey(
         DocumentCollection,
         related_name='documents',
         on_delete=models.CASCADE,
     )
+    # Bulk import the document was created by, if any.
+    import_job = models.ForeignKey(
+        'ImportJob',
+        related_name='documents',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    # Bulk deletion the document is to be deleted by, if any.
+    deletion_job = models.ForeignKey(
+        'DeletionJob',
+        related_name='documents',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    # Null for documents created before it was recorded, and not known from their processing.
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+    # Progress of the processing of the document (see ProcessingProgress),
+    # read by the /api/documents/{id}/status endpoint.
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    error = models.TextField(blank=True, null=True)
+    pages_total = models.PositiveIntegerField(null=True, blank=True)
+    pages_parsed = models.PositiveIntegerField(default=0)
+    # Chunks the document was split into (so far, while it is parsed), and chunks embedded.
+    chunks_total = models.PositiveIntegerField(default=0)
+    chunks_embedded = models.PositiveIntegerField(default=0)
+    # Time spent in each stage of the processing, in seconds.
+    parsing_seconds = models.FloatField(default=0.0)
+    chunking_seconds = models.FloatField(default=0.0)
+    embedding_seconds = models.FloatField(default=0.0)
+    processing_started_at = models.DateTimeField(null=True, blank=True)
+    processing_finished_at = models.DateTimeField(null=True, blank=True)
+    # Where the processing of the document can resume from, once the chunks before it are stored
+    # (see embed_document and pipeline.upsert_chunks, whose checkpoints differ in `kind`):
+    # a retried task only processes the rest of the document.
+    checkpoint = models.JSONField(null=True, blank=True)
 
     def __str__(self):
         return f'UnstructuredDocument (name="{self.name}")'
 
+    @property
+    def stored_file_name(self) -> str:
+        '''
+        Name of the file of the document, in the media directory.
+        '''
+        if self.file.name.startswith(settings.UPLOAD_URL):
+            return self.file.name[len(settings.UPLOAD_URL):]
+        return self.file.name
+
+    def find_processed_duplicate(self) -> Optional['UnstructuredDocument']:
+        '''
+        Return an identical document (same file digest) whose embeddings were already computed,
+        if any. Its embeddings can only be reused if they come from the same embedding model.
+        '''
+        if not self.sha256:
+            return None
+        return (
+            UnstructuredDocument.objects
+            .filter(
+                sha256=self.sha256,
+                has_embeddings=True,
+                collection__embedding_backend=self.collection.embedding_backend,
+            )
+            .exclude(id=self.id)
+            .select_related('collection')
+            .first()
+        )
+
     @classmethod
-    def chunk_document(cls, filepath: str, doc_name: str):
+    def chunk_document(
+        cls,
+        filepath: str,
+        doc_name: str,
+        progress: 'ProcessingProgress' = None,
+        checkpoint: dict = None,
+        on_page: Callable[[dict], None] = None,
+    ):
         '''
-        Chunks a PDF document into smaller documents.
+        Chunks a PDF document into smaller documents, lazily.
+        Pages are extracted and split one at a time, so that memory usage does not depend
+        on the size of the document. Pages of large documents are extracted in parallel.
 
         Args:
             filepath (str): Path to the file to process.
             doc_name (str): Name of the document the embeddings are extracted from;
                 this is used as a marker in the metadata of the embeddings for when
                 the document is deleted.
+            progress (ProcessingProgress): Records the pages parsed and the chunks split, if specified.
+            checkpoint (dict): State of the splitting after a page, to resume from the next page (see `iter_chunks`).
+            on_page (Callable[[dict], None]): Called with the state of the splitting after each page.
+
+        Yields:
+            Document: A chunk of the document (instance of langchain.docstore.document.Document),
+                carrying its page number and index in the document as metadata.
+        '''
+        from apps.documents.loaders import iter_document_pages, iter_chunks
+
+        logger.info(f'Streaming pages from document {doc_name} (file path: {filepath})')
+        pages = iter_document_pages(filepath, checkpoint['page'] + 1 if checkpoint else 1)
+        if progress is None:
+            yield from iter_chunks(pages, state=checkpoint, on_page=on_page)
+        else:
+            yield from progress.track_chunks(
+                iter_chunks(progress.track_pages(pages), state=checkpoint, on_page=on_page)
+            )
+
+    @classmethod
+    def embed_document(
+        cls,
+        filepath: str,
+        vectorstore_name: str,
+        embedding_backend: str,
+        doc_name: str,
+        instance_id: int,
+        concurrency: int = None,
+        progress: 'ProcessingProgress' = None,
+        checkpoint: dict = None,
+    ) -> int:
+        '''
+        Chunk a document, embed its chunks and store them in a Qdrant collection.
+        With `progress`, checkpoints are recorded as chunks are stored: the state of the splitting
+        after the last page whose chunks are all stored, from which a later attempt can resume
+        with `checkpoint`, without extracting, embedding and storing these pages again.
+        Chunks stored twice (after the checkpoint) replace themselves, as their IDs are deterministic.
+
+        Args:
+            filepath (str): Path to the file to process.
+            vectorstore_name (str): Name of the Qdrant collection to store the embeddings in.
+            embedding_backend (str): Embedding backend to embed the chunks with.
+            doc_name (str): Name of the document the embeddings are extracted from.
+            instance_id (int): ID of the UnstructuredDocument instance.
+            concurrency (int): Batches of chunks embedded concurrently. Defaults to MARTINI_EMBEDDING_CONCURRENCY.
+            progress (ProcessingProgress): Records the progress of the processing, if specified.
+            checkpoint (dict): Checkpoint recorded by a previous attempt in the same Qdrant collection.
+
+        Returns:
+            int: Number of chunks of the document.
         '''
-        from langchain.document_loaders import PDFMinerLoader
-        from langchain.text_splitter import RecursiveCharacterTextSplitter
-
-        # For PDFs, we use PyPDF2 to load the document.
-        loader = PDFMinerLoader(filepath)
-        data = loader.load()
-        logger.info(f'Data loaded from document {doc_name} (file path: {filepath})')
-
-        # The Document (note the capital D as it is an instance of langchain.docstore.document.Document)
-        # is milked out of its text content. The text content is then split into smaller chunks.
-        chunk_size = settings.MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_SIZE
-        chunk_overlap = settings.MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_OVERLAP
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
+        from langchain.docstore.document import Document
+
+        from apps.documents.exceptions import UnprocessableDocumentError
+        from apps.documents.ingestion import embed_and_store
+        from apps.documents.progress import CHECKPOINT_STREAM, count_pages
+
+        from apps.chats.llm import get_embeddings_model
+
+        if not os.path.exists(filepath):
+            raise ValueError(f'File {filepath} does not exist')
+
+        resumed_chunks = checkpoint['chunk'] if checkpoint else 0
+        # States of the splitting after each page, until the chunks before them are stored.
+        page_states = deque()
+        on_stored = None
+        if progress is not None:
+            if checkpoint:
+                logger.info(f'Resuming {doc_name} after page {checkpoint["page"]} ({resumed_chunks} chunks stored)')
+                progress.start(
+                    count_pages(filepath),
+                    pages_parsed=checkpoint['page'],
+                    chunks_total=resumed_chunks,
+                    chunks_embedded=resumed_chunks,
+                    checkpoint=checkpoint,
+                )
+            else:
+                progress.start(count_pages(filepath))
+
+            def on_stored(stored_chunks):
+                stored = stored_chunks[-1].metadata['chunk'] + 1
+                state = None
+                while page_states and page_states[0]['chunk'] <= stored:
+                    state = page_states.popleft()
+                if state is not None:
+                    progress.checkpoint({**state, 'kind': CHECKPOINT_STREAM, 'vectorstore_name': vectorstore_name})
+
+        # Chunks are embedded and stored batch by batch as pages are extracted,
+        # each chunk carrying the Document instance ID as metadata.
+        # This is used to facilitate deletion of the embeddings of a removed Document.
+        chunks = (
+            Document(page_content=chunk.page_content, metadata={**chunk.metadata, 'instance_id': instance_id})
+            for chunk in cls.chunk_document(
+                filepath, doc_name, progress, checkpoint, page_states.append if progress is not None else None
+            )
         )
-        texts = text_splitter.split_text(data[0].page_content)
-        return texts
+        # Track the embedding cache separately for this document to log what it saved.
+        embeddings = get_embeddings_model(embedding_backend).tracked()
+        chunks_count = embed_and_store(
+            chunks,
+            embeddings,
+            vectorstore_name,
+            doc_name,
+            concurrency=concurrency,
+            on_progress=progress.embedded if progress is not None else None,
+            on_stored=on_stored,
+        ) + resumed_chunks
+        logger.info(f'Embedding cache for {doc_name}: {embeddings.stats}')
+
+        if chunks_count == 0:
+            raise UnprocessableDocumentError(
+                f'No text extracted from {doc_name}. Maybe this is an image only document?'
+            )
+        logger.info(f'Text from {doc_name} was split into {chunks_count} smaller chunks')
+        return chunks_count
 
     @classmethod
     def save_embeddings(
@@ -77,7 +337,8 @@ class UnstructuredDocument(models.Model):
     ):
         '''
         Save the embeddings of a document in Qdrant.
-        Used directly in local development, and as a Celery task in production.
+        Used directly in local development; in production, the stages run as Celery tasks
+        (see tasks.dispatch_ingestion).
 
         Args:
             filepath (str): Path to the file to process.
@@ -87,38 +348,128 @@ class UnstructuredDocument(models.Model):
                 the document is deleted.
             instance_id (int): ID of the UnstructuredDocument instance.
         '''
-        from apps.documents.vectorstore import get_vectorstore_for_chains
-        from apps.documents.exceptions import UnprocessableDocumentError
-
-        from apps.chats.llm import get_embeddings_model
-
         if not collection_name or not doc_name or not instance_id:
             raise ValueError('collection_name, doc_name and instance_id must be specified')
 
-        if not os.path.exists(filepath):
-            raise ValueError(f'File {filepath} does not exist')
+        from apps.documents.progress import CHECKPOINT_STREAM, ProcessingProgress, read_checkpoint
 
-        texts = cls.chunk_document(filepath, doc_name)
-        if len(texts) == 0:
-            raise UnprocessableDocumentError(
-                f'No text extracted from {doc_name}. Maybe this is an image only document?'
-            )
-        logger.info(f'Text from {doc_name} was split into {len(texts)} smaller chunks')
-        embeddings = get_embeddings_model()
-        qdrant = get_vectorstore_for_chains(embeddings, collection_name=collection_name)
-        # Create a list of metadata dictionaries, one for each text, that all contains
-        # the Document instance ID as metadata, to be added to the embeddings.
-        # This is used to facilitate deletion of the embeddings of a removed Document.
-        metadata_list = [{'instance_id': instance_id} for _ in range(len(texts))]
-        qdrant.add_texts(texts, metadata_list)
+        # Embed with the model of the collection, into the Qdrant collection serving it.
+        collection = DocumentCollection.objects.get(slug=collection_name)
+        # Resume a previous attempt, unless the collection was re-embedded since.
+        checkpoint = read_checkpoint(instance_id, CHECKPOINT_STREAM, collection.vectorstore_collection_name)
+        progress = ProcessingProgress(instance_id)
+        cls.embed_document(
+            filepath,
+            collection.vectorstore_collection_name,
+            collection.embedding_backend,
+            doc_name,
+            instance_id,
+            progress=progress,
+            checkpoint=checkpoint
+        )
 
         # Update the UnstructuredDocument instance to reflect that the embeddings
         # have been stored in Qdrant.
+        progress.finish(
+            has_embeddings=True,
+            task_id=None,
+            checkpoint=None
+        )
+        DocumentCollection.bump_content_version(collection_name)
+
+    @classmethod
+    def copy_embeddings(
+        cls,
+        source_collection_name: str,
+        source_instance_id: int,
+        collection_name: str,
+        doc_name: str,
+        instance_id: int
+    ):
+        '''
+        Copy the embeddings of an identical document, instead of computing them again.
+        Used directly in local development, and as a Celery task in production.
+
+        Args:
+            source_collection_name (str): Name of the collection storing the embeddings to copy.
+            source_instance_id (int): ID of the UnstructuredDocument instance the embeddings belong to.
+            collection_name (str): Name of the collection to store the embeddings in.
+            doc_name (str): Name of the document the embeddings are copied for.
+            instance_id (int): ID of the UnstructuredDocument instance.
+        '''
+        from apps.documents.vectorstore import copy_points_by_metadata
+
+        if not source_collection_name or not source_instance_id:
+            raise ValueError('source_collection_name and source_instance_id must be specified')
+        if not collection_name or not doc_name or not instance_id:
+            raise ValueError('collection_name, doc_name and instance_id must be specified')
+
+        started_at = timezone.now()
+        copied = copy_points_by_metadata(
+            DocumentCollection.objects.get(slug=source_collection_name).vectorstore_collection_name,
+            source_instance_id,
+            DocumentCollection.objects.get(slug=collection_name).vectorstore_collection_name,
+            instance_id
+        )
+        logger.info(f'Copied {copied} embeddings to {doc_name} from document {source_instance_id}')
+
         cls.objects.filter(id=instance_id).update(
             has_embeddings=True,
-            task_id=None
+            task_id=None,
+            status='indexed',
+            error=None,
+            chunks_total=copied,
+            chunks_embedded=copied,
+            processing_started_at=started_at,
+            processing_finished_at=timezone.now()
+        )
+        DocumentCollection.bump_content_version(collection_name)
+
+    @classmethod
+    def mark_failed(cls, instance_id: int, error: str):
+        '''
+        Mark the processing of a document as failed, once given up on.
+        '''
+        cls.objects.filter(id=instance_id).update(
+            status='failed',
+            error=error,
+            processing_finished_at=timezone.now()
         )
 
+    @classmethod
+    def import_document(cls, instance_id: int, file_name: str, ingest: Callable = None) -> bool:
+        '''
+        Process a document created by a bulk import: copy the embeddings of an identical document
+        if one was already processed (reusing its stored file), otherwise extract them from the file with `ingest`.
+        Used directly in local development, and as a Celery task in production.
+
+        Args:
+            instance_id (int): ID of the UnstructuredDocument instance.
+            file_name (str): Name of the file of the document, in the media directory.
+            ingest (Callable): Called with the path of the file, the name of the collection, the name
+                and the ID of the document to extract its embeddings; `save_embeddings` by default.
+
+        Returns:
+            bool: Whether the embeddings of an identical document were copied, rather than sent to `ingest`.
+        '''
+        from apps.documents.storage import storage_path
+
+        udoc = cls.objects.select_related('collection').get(id=instance_id)
+        duplicate = udoc.find_processed_duplicate()
+        if duplicate is None:
+            (ingest or cls.save_embeddings)(storage_path(file_name), udoc.collection.slug, udoc.name, udoc.id)
+            return False
+
+        cls.objects.filter(id=udoc.id).update(file=duplicate.file.name)
+        # Files identical within an import are stored once: only delete the file if no other document uses it.
+        if not cls.objects.filter(file=settings.UPLOAD_URL + file_name).exists():
+            try:
+                os.remove(storage_path(file_name))
+            except FileNotFoundError:
+                pass
+        cls.copy_embeddings(duplicate.collection.slug, duplicate.id, udoc.collection.slug, udoc.name, udoc.id)
+        return True
+
     @classmethod
     def delete_embeddings(
         cls,
@@ -142,8 +493,464 @@ class UnstructuredDocument(models.Model):
         if not collection_name or not doc_name or not instance_id:
             raise ValueError('collection_name, doc_name and instance_id must be specified')
 
-        delete_points_by_metadata(collection_name, doc_name, instance_id)
+        # Also delete them from the Qdrant collection being built by a re-embedding, if any.
+        for vectorstore_name in DocumentCollection.get_vectorstore_collection_names(collection_name):
+            delete_points_by_metadata(vectorstore_name, doc_name, instance_id)
         cls.objects.filter(id=instance_id).update(
             has_embeddings=False,
             task_id=None
         )
+        DocumentCollection.bump_content_version(collection_name)
+
+
+class ImportJob(models.Model):
+    '''
+    ImportJob tracks the processing of documents imported into a collection in bulk,
+    from a zip archive or several files uploaded at once. Its documents are processed in parallel,
+    each counted as done or failed as soon as it is processed (or given up on).
+    '''
+    collection = models.ForeignKey(
+        DocumentCollection,
+        related_name='import_jobs',
+        on_delete=models.CASCADE,
+    )
+    # ID of the Celery group processing the documents.
+    task_id = models.CharField(max_length=255, blank=True, null=True)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'ImportJob (total={self.total}, done={self.done}, failed={self.failed})'
+
+    @property
+    def pending(self) -> int:
+        return max(self.total - self.done - self.failed, 0)
+
+    @property
+    def throughput(self) -> float:
+        '''
+        Documents processed per second since the import started.
+        '''
+        elapsed = ((self.finished_at or timezone.now()) - self.created_at).total_seconds()
+        return round((self.done + self.failed) / elapsed, 2) if elapsed > 0 else 0.0
+
+    @classmethod
+    def record_result(cls, job_id: int, succeeded: bool):
+        '''
+        Count a document of the import as done or failed, and mark the import as finished
+        once all its documents were counted. Safe to call concurrently.
+        '''
+        counter = 'done' if succeeded else 'failed'
+        cls.objects.filter(id=job_id, finished_at__isnull=True).update(**{counter: models.F(counter) + 1})
+        finished = cls.objects.filter(
+            id=job_id,
+            finished_at__isnull=True,
+            total__lte=models.F('done') + models.F('failed'),
+        ).update(finished_at=timezone.now())
+        if finished:
+            job = cls.objects.get(id=job_id)
+            logger.info(
+                f'Import {job_id} finished: {job.done} documents done, {job.failed} failed '
+                f'({job.throughput} documents/s)'
+            )
+
+    @classmethod
+    def record_document_result(cls, instance_id: int, succeeded: bool):
+        '''
+        Count a document as done or failed in the import it was created by, if any.
+        '''
+        job_id = UnstructuredDocument.objects.filter(id=instance_id).values_list('import_job_id', flat=True).first()
+        if job_id is not None:
+            cls.record_result(job_id, succeeded)
+
+
+class DeletionJob(models.Model):
+    '''
+    DeletionJob deletes documents in bulk: those of a list of IDs, and/or those matching a filter,
+    e.g. the documents of a collection created before a date. The documents are assigned to the job
+    in a single update when it starts, then deleted MARTINI_DELETION_BATCH_SIZE at a time: their embeddings
+    with a single filter deletion per Qdrant collection, their files, then their rows with a single query.
+    Deleting a batch again is harmless, so that an interrupted job resumes with the documents left.
+    '''
+    collection = models.ForeignKey(
+        DocumentCollection,
+        related_name='deletion_jobs',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+    )
+    created_before = models.DateTimeField(null=True, blank=True)
+    # ID of the Celery task deleting the documents.
+    task_id = models.CharField(max_length=255, blank=True, null=True)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'DeletionJob (total={self.total}, done={self.done})'
+
+    @property
+    def pending(self) -> int:
+        return max(self.total - self.done, 0)
+
+    @classmethod
+    def start(
+        cls,
+        document_ids: List[int] = None,
+        collection: DocumentCollection = None,
+        created_before: datetime = None,
+    ) -> 'DeletionJob':
+        '''
+        Create a job deleting the documents matching all the criteria given, and assign them to it.
+        Documents already assigned to a job not finished yet are left to it.
+
+        Args:
+            document_ids (List[int]): IDs of the documents to delete.
+            collection (DocumentCollection): Collection of the documents to delete.
+            created_before (datetime): Delete the documents created before this date (or at an unknown date).
+
+        Returns:
+            DeletionJob: The job, already finished if no document matches.
+        '''
+        documents = UnstructuredDocument.objects.filter(
+            models.Q(deletion_job__isnull=True) | models.Q(deletion_job__finished_at__isnull=False)
+        )
+        if document_ids is not None:
+            documents = documents.filter(id__in=document_ids)
+        if collection is not None:
+            documents = documents.filter(collection=collection)
+        if created_before is not None:
+            # Documents without a creation date were created before it was recorded, so before any recent date.
+            documents = documents.filter(models.Q(created_at__lt=created_before) | models.Q(created_at__isnull=True))
+
+        with transaction.atomic():
+            job = cls.objects.create(collection=collection, created_before=created_before)
+            job.total = documents.update(deletion_job=job)
+            job.finished_at = None if job.total else timezone.now()
+            job.save(update_fields=['total', 'finished_at'])
+        return job
+
+    @classmethod
+    def run(cls, job_id: int, batch_size: int = None):
+        '''
+        Delete the documents of a job, `batch_size` at a time (MARTINI_DELETION_BATCH_SIZE by default).
+        Used directly in local development, and as a Celery task in production.
+        '''
+        batch_size = batch_size or settings.MARTINI_DELETION_BATCH_SIZE
+        started_at = time.perf_counter()
+        while True:
+            documents = list(
+                UnstructuredDocument.objects
+                .filter(deletion_job_id=job_id)
+                .order_by('id')
+                .values('id', 'file', 'collection__slug')[:batch_size]
+            )
+            if not documents:
+                break
+            cls._delete_documents(documents)
+            cls.objects.filter(id=job_id).update(done=models.F('done') + len(documents))
+
+        cls.objects.filter(id=job_id).update(finished_at=timezone.now())
+        job = cls.objects.get(id=job_id)
+        logger.info(
+            f'Deletion {job_id} finished: {job.done} documents deleted in {time.perf_counter() - started_at:.2f}s'
+        )
+
+    @staticmethod
+    def _delete_documents(documents: List[dict]):
+        from apps.documents.storage import storage_path
+        from apps.documents.vectorstore import delete_points_by_instances
+
+        ids = [document['id'] for document in documents]
+        instance_ids_by_collection = {}
+        for document in documents:
+            instance_ids_by_collection.setdefault(document['collection__slug'], []).append(document['id'])
+        # Also delete them from the Qdrant collection being built by a re-embedding, if any.
+        for collection_name, instance_ids in instance_ids_by_collection.items():
+            for vectorstore_name in DocumentCollection.get_vectorstore_collection_names(collection_name):
+                delete_points_by_instances(vectorstore_name, instance_ids)
+
+        # Identical documents share the same stored file: only delete the files no other document uses.
+        files = {document['file'] for document in documents}
+        shared_files = set(
+            UnstructuredDocument.objects
+            .filter(file__in=files)
+            .exclude(id__in=ids)
+            .values_list('file', flat=True)
+        )
+        for file in files - shared_files:
+            file_name = file[len(settings.UPLOAD_URL):] if file.startswith(settings.UPLOAD_URL) else file
+            try:
+                os.remove(storage_path(file_name))
+            except FileNotFoundError:
+                # Already deleted by a previous attempt.
+                pass
+
+        UnstructuredDocument.objects.filter(id__in=ids).delete()
+        for collection_name in instance_ids_by_collection:
+            DocumentCollection.bump_content_version(collection_name)
+
+    @classmethod
+    def fail(cls, job_id: int, error: str):
+        '''
+        Mark a job as failed: its documents not deleted yet are left assigned to it, and can be deleted by another one.
+        '''
+        cls.objects.filter(id=job_id).update(finished_at=timezone.now(), error=error)
+
+
+class ReembeddingJob(models.Model):
+    '''
+    ReembeddingJob rebuilds the embeddings of a collection in a new Qdrant collection, e.g. to change
+    its embedding model or the size of its chunks, while the current one keeps answering questions.
+    Documents are re-embedded from their stored files one at a time, in order of ID, and the last one done
+    is recorded so that an interrupted job can be resumed. Once all documents are re-embedded, the
+    DocumentCollection is switched to the new Qdrant collection in a single update, and the previous one
+    is deleted after a grace period, for the searches started before the switch to complete.
+    '''
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    collection = models.ForeignKey(
+        DocumentCollection,
+        related_name='reembedding_jobs',
+        on_delete=models.CASCADE,
+    )
+    embedding_backend = models.CharField(max_length=20, choices=DocumentCollection.EMBEDDING_BACKEND_CHOICES)
+    # Qdrant collection the documents are re-embedded into, and the one it replaced once switched.
+    vectorstore_name = models.CharField(max_length=100)
+    previous_vectorstore_name = models.CharField(max_length=100, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    # ID of the Celery task running the job.
+    task_id = models.CharField(max_length=255, blank=True, null=True)
+    # ID of the last document re-embedded: the job resumes with the next one.
+    last_document_id = models.BigIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    switched_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['collection'],
+                condition=models.Q(status='running'),
+                name='unique_running_reembedding_job',
+            ),
+        ]
+
+    def __str__(self):
+        return f'ReembeddingJob (collection={self.collection_id}, status="{self.status}")'
+
+    @property
+    def pending(self) -> int:
+        '''
+        Documents of the collection left to re-embed.
+        '''
+        return self.collection.documents.filter(id__gt=self.last_document_id).count()
+
+    @classmethod
+    def start(cls, collection: DocumentCollection, embedding_backend: str = None) -> 'ReembeddingJob':
+        '''
+        Create the Qdrant collection the documents of `collection` are to be re-embedded into,
+        with `embedding_backend` (the current one of the collection if not specified).
+        Raises ValueError if a re-embedding of the collection is already running.
+        '''
+        from apps.chats.llm import get_embeddings_model
+        from apps.documents.vectorstore import create_vectorstore_collection, delete_vectorstore_collection
+
+        if collection.reembedding_jobs.filter(status=cls.STATUS_RUNNING).exists():
+            raise ValueError(f'A re-embedding of collection "{collection.slug}" is already running.')
+
+        # Failed jobs cannot be resumed once another one started: clean up after them.
+        for job in collection.reembedding_jobs.filter(status=cls.STATUS_FAILED):
+            if job.switched_at is None:
+                delete_vectorstore_collection(job.vectorstore_name)
+            else:
+                cls.collect_garbage(job.id)
+
+        embedding_backend = embedding_backend or collection.embedding_backend
+        dimension = get_embeddings_model(embedding_backend).dimension
+        vectorstore_name = f'{collection.slug}-{uuid.uuid4().hex[:8]}'
+        create_vectorstore_collection(vectorstore_name, collection.index_profile, dimension)
+        return cls.objects.create(
+            collection=collection,
+            embedding_backend=embedding_backend,
+            vectorstore_name=vectorstore_name,
+        )
+
+    @classmethod
+    def resume(cls, collection: DocumentCollection) -> 'ReembeddingJob':
+        '''
+        Resume the last re-embedding of `collection` if it did not succeed, after the last document it re-embedded.
+        A job still marked as running is resumed as well, for when the process running it was killed.
+        Raises ValueError if there is none.
+        '''
+        job = collection.reembedding_jobs.order_by('-created_at').first()
+        if job is None or job.status == cls.STATUS_SUCCEEDED:
+            raise ValueError(f'No re-embedding of collection "{collection.slug}" to resume.')
+        job.status = cls.STATUS_RUNNING
+        job.error = None
+        job.save(update_fields=['status', 'error'])
+        return job
+
+    @classmethod
+    def run(cls, job_id: int, pause: float = None, concurrency: int = None):
+        '''
+        Re-embed the documents of the collection of a job into its Qdrant collection, then switch to it.
+        Used directly in local development and by the reembed_collection command, and as a Celery task in production.
+        The previous Qdrant collection is left for `collect_garbage` to delete.
+
+        Args:
+            job_id (int): ID of the ReembeddingJob instance.
+            pause (float): Seconds to wait between documents, to throttle the job.
+                Defaults to MARTINI_REEMBEDDING_PAUSE.
+            concurrency (int): Batches of chunks embedded concurrently. Defaults to MARTINI_REEMBEDDING_CONCURRENCY.
+        '''
+        job = cls.objects.select_related('collection').get(id=job_id)
+        if job.status != cls.STATUS_RUNNING:
+            raise ValueError(f'Re-embedding {job_id} is not running.')
+        pause = settings.MARTINI_REEMBEDDING_PAUSE if pause is None else pause
+        concurrency = concurrency or settings.MARTINI_REEMBEDDING_CONCURRENCY
+
+        if job.switched_at is None:
+            # Documents created in the meantime are re-embedded as well, until there are none left.
+            job._reembed_documents(pause, concurrency)
+            job._switch()
+        # Documents created during the switch may have been embedded in the previous Qdrant collection only.
+        job._reembed_documents(pause, concurrency)
+
+        job.status = cls.STATUS_SUCCEEDED
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'finished_at'])
+        logger.info(
+            f'Re-embedded collection "{job.collection.slug}" into "{job.vectorstore_name}": '
+            f'{job.done} documents done, {job.failed} failed'
+        )
+
+    def _reembed_documents(self, pause: float, concurrency: int):
+        from apps.documents.exceptions import UnprocessableDocumentError
+        from apps.documents.storage import storage_path
+        from apps.documents.vectorstore import delete_points_by_metadata
+
+        while True:
+            udoc = self.collection.documents.filter(id__gt=self.last_document_id).order_by('id').first()
+            if udoc is None:
+                return
+            # Points of a document interrupted midway, or already embedded there since the switch, are replaced.
+            delete_points_by_metadata(self.vectorstore_name, udoc.name, udoc.id)
+            try:
+                UnstructuredDocument.embed_document(
+                    storage_path(udoc.stored_file_name),
+                    self.vectorstore_name,
+                    self.embedding_backend,
+                    udoc.name,
+                    udoc.id,
+                    concurrency=concurrency,
+                )
+            except (UnprocessableDocumentError, ValueError) as e:
+                # The document could not be processed in the first place, or its file is gone.
+                logger.error(f'Re-embedding of document {udoc.id} failed. Error: {e}')
+                counter = 'failed'
+            else:
+                counter = 'done'
+            self.last_document_id = udoc.id
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.save(update_fields=['last_document_id', counter])
+            time.sleep(pause)
+
+    def _switch(self):
+        '''
+        Switch the collection to the Qdrant collection of the job, along with its embedding backend:
+        questions are embedded with the backend of the collection they search, so both change at once.
+        '''
+        with transaction.atomic():
+            collection = DocumentCollection.objects.select_for_update().get(id=self.collection_id)
+            self.previous_vectorstore_name = collection.vectorstore_collection_name
+            self.switched_at = timezone.now()
+            self.save(update_fields=['previous_vectorstore_name', 'switched_at'])
+            collection.vectorstore_name = self.vectorstore_name
+            collection.embedding_backend = self.embedding_backend
+            # Invalidate the answers cached from the previous embeddings.
+            collection.content_version = models.F('content_version') + 1
+            collection.save(update_fields=['vectorstore_name', 'embedding_backend', 'content_version'])
+        self.collection.refresh_from_db()
+        logger.info(
+            f'Switched collection "{collection.slug}" from "{self.previous_vectorstore_name}" '
+            f'to "{self.vectorstore_name}"'
+        )
+
+    @classmethod
+    def fail(cls, job_id: int, error: str):
+        '''
+        Mark a job as failed: it can be resumed after the last document it re-embedded.
+        '''
+        cls.objects.filter(id=job_id).update(status=cls.STATUS_FAILED, error=error)
+
+    @classmethod
+    def collect_garbage(cls, job_id: int):
+        '''
+        Delete the Qdrant collection a job replaced.
+        Used directly in local development and by the reembed_collection command, and as a Celery task in production.
+        '''
+        from apps.documents.vectorstore import delete_vectorstore_collection
+
+        job = cls.objects.get(id=job_id)
+        if job.previous_vectorstore_name:
+            delete_vectorstore_collection(job.previous_vectorstore_name)
+            logger.info(f'Deleted the previous Qdrant collection "{job.previous_vectorstore_name}"')
+
+
+class UploadSession(models.Model):
+    '''
+    UploadSession tracks the upload of a file sent in several parts.
+    Parts are appended to the final file as they are received, so an interrupted upload
+    can be resumed from the last acknowledged offset. Once complete, the file becomes
+    the file of a new UnstructuredDocument, without being copied.
+    '''
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255, default='Untitled')
+    description = models.TextField(null=True, blank=True)
+    collection = models.ForeignKey(
+        DocumentCollection,
+        related_name='upload_sessions',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+    )
+    file_name = models.CharField(max_length=255)
+    # Expected size of the file in bytes, if known, and number of bytes received so far.
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    offset = models.PositiveBigIntegerField(default=0)
+    document = models.OneToOneField(
+        UnstructuredDocument,
+        related_name='upload_session',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'UploadSession (name="{self.name}", offset={self.offset})'
+
+    @property
+    def path(self) -> str:
+        '''
+        Path of the file of the upload, the same for the API and the workers processing it (see `storage_path`).
+        '''
+        from apps.documents.storage import storage_path
+
+        return storage_path(self.file_name)
@@ -0,0 +1,263 @@
+'''
+Processing of a document in separate stages, run as a chain of Celery tasks (see `tasks.dispatch_ingestion`)
+so that each kind of work runs on workers sized for it: extraction and chunking are CPU-bound,
+embedding and upserting wait on the network. Stages hand their output over to the next one
+through files in MARTINI_INGESTION_SPOOL_DIR, which must be shared by the workers of both kinds.
+'''
+import os
+import json
+import math
+import time
+import shutil
+import logging
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from django.conf import settings
+from django.db import models
+
+from langchain.docstore.document import Document
+
+from apps.documents.exceptions import UnprocessableDocumentError
+from apps.documents.loaders import batched, iter_chunks, iter_document_pages
+from apps.documents.progress import CHECKPOINT_STAGES, ProcessingProgress, count_pages, read_checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+def spool_path(instance_id: int, name: str = '') -> str:
+    '''
+    Path of a file handed over between the stages of the processing of a document (of its directory by default).
+    '''
+    spool_dir = settings.MARTINI_INGESTION_SPOOL_DIR
+    if not spool_dir:
+        from apps.documents.storage import storage_path
+
+        spool_dir = storage_path('.ingestion')
+    return os.path.join(spool_dir, str(instance_id), name)
+
+
+def remove_spool(instance_id: int):
+    '''
+    Delete the files handed over between the stages of the processing of a document.
+    '''
+    shutil.rmtree(spool_path(instance_id), ignore_errors=True)
+
+
+def ingestion_priority(size: int) -> int:
+    '''
+    Priority of the processing of a document of `size` bytes, from 0 (highest) to 9 (lowest),
+    as ordered by the Redis broker: the larger the document, the lower the priority, so that small documents
+    are not stuck behind large ones. Each step doubles the size, from MARTINI_INGESTION_PRIORITY_BASE_SIZE.
+    '''
+    return min(9, int(math.log2(1 + size / settings.MARTINI_INGESTION_PRIORITY_BASE_SIZE)))
+
+
+def _write_atomically(path: str, write):
+    # A retried stage starts over: the next stage only ever sees complete files.
+    with open(f'{path}.tmp', 'wb') as fp:
+        write(fp)
+    os.replace(f'{path}.tmp', path)
+
+
+def _read_pages(instance_id: int) -> Iterator[Tuple[int, str]]:
+    with open(spool_path(instance_id, 'pages.jsonl'), 'rb') as fp:
+        for line in fp:
+            page_number, text = json.loads(line)
+            yield page_number, text
+
+
+def _read_chunks(instance_id: int) -> Iterator[Document]:
+    with open(spool_path(instance_id, 'chunks.jsonl'), 'rb') as fp:
+        for line in fp:
+            yield Document(**json.loads(line))
+
+
+def extract_pages(instance_id: int, filepath: str, doc_name: str) -> int:
+    '''
+    First stage: extract the text of the pages of a document.
+
+    Args:
+        instance_id (int): ID of the UnstructuredDocument instance.
+        filepath (str): Path to the file to process.
+        doc_name (str): Name of the document, for logging purposes.
+
+    Returns:
+        int: Number of pages extracted.
+    '''
+    if not os.path.exists(filepath):
+        raise ValueError(f'File {filepath} does not exist')
+
+    progress = ProcessingProgress(instance_id)
+    progress.start(count_pages(filepath))
+    # The files of a previous processing of the document are not reused by the next stages.
+    remove_spool(instance_id)
+    os.makedirs(spool_path(instance_id), exist_ok=True)
+    pages_count = 0
+
+    def write(fp):
+        nonlocal pages_count
+        for page in progress.track_pages(iter_document_pages(filepath)):
+            fp.write(json.dumps(page).encode('utf-8') + b'\n')
+            pages_count += 1
+
+    _write_atomically(spool_path(instance_id, 'pages.jsonl'), write)
+    progress.flush()
+    logger.info(f'Extracted {pages_count} pages from {doc_name} (file path: {filepath})')
+    return pages_count
+
+
+def chunk_pages(instance_id: int, doc_name: str) -> int:
+    '''
+    Second stage: split the pages of a document into chunks.
+
+    Args:
+        instance_id (int): ID of the UnstructuredDocument instance.
+        doc_name (str): Name of the document, for logging purposes.
+
+    Returns:
+        int: Number of chunks.
+    '''
+    pages_path = spool_path(instance_id, 'pages.jsonl')
+    if not os.path.exists(pages_path) and os.path.exists(spool_path(instance_id, 'chunks.jsonl')):
+        # Redelivered after the pages were split, and removed.
+        with open(spool_path(instance_id, 'chunks.jsonl'), 'rb') as fp:
+            return sum(1 for _ in fp)
+
+    progress = ProcessingProgress(instance_id)
+    progress.enter_stage('chunking', chunks_total=0, chunking_seconds=0.0)
+    chunks_count = 0
+
+    def write(fp):
+        nonlocal chunks_count
+        for chunk in progress.track_chunks(iter_chunks(_read_pages(instance_id))):
+            # Each chunk carries the Document instance ID as metadata,
+            # to facilitate deletion of the embeddings of a removed Document.
+            metadata = {**chunk.metadata, 'instance_id': instance_id}
+            fp.write(json.dumps({'page_content': chunk.page_content, 'metadata': metadata}).encode('utf-8') + b'\n')
+            chunks_count += 1
+
+    _write_atomically(spool_path(instance_id, 'chunks.jsonl'), write)
+    progress.flush()
+    if chunks_count == 0:
+        raise UnprocessableDocumentError(
+            f'No text extracted from {doc_name}. Maybe this is an image only document?'
+        )
+    os.remove(pages_path)
+    logger.info(f'Text from {doc_name} was split into {chunks_count} smaller chunks')
+    return chunks_count
+
+
+def embed_chunks(instance_id: int, collection_name: str, doc_name: str) -> dict:
+    '''
+    Third stage: embed the chunks of a document with the model of its collection,
+    MARTINI_EMBEDDING_CONCURRENCY batches at a time. Vectors are written in order as batches are embedded,
+    so that a retry resumes after the vectors written by the previous attempt (or not at all once they all were).
+
+    Args:
+        instance_id (int): ID of the UnstructuredDocument instance.
+        collection_name (str): Name of the collection of the document.
+        doc_name (str): Name of the document, for logging purposes.
+
+    Returns:
+        dict: The Qdrant collection to store the embeddings in (`vectorstore_name`),
+            and the dimension of the embeddings (`dimension`).
+    '''
+    from apps.documents.ingestion import embed_batch
+    from apps.documents.models import DocumentCollection
+
+    from apps.chats.llm import get_embeddings_model
+
+    # The Qdrant collection is chosen along with the model, as they change together when re-embedding.
+    collection = DocumentCollection.objects.get(slug=collection_name)
+    embeddings = get_embeddings_model(collection.embedding_backend).tracked()
+    concurrency = settings.MARTINI_EMBEDDING_CONCURRENCY
+    path = spool_path(instance_id, 'vectors.f32')
+    row_size = embeddings.dimension * 4
+    result = {'vectorstore_name': collection.vectorstore_collection_name, 'dimension': embeddings.dimension}
+    if os.path.exists(path):
+        # Redelivered after all the chunks were embedded.
+        logger.info(f'Chunks of {doc_name} already embedded')
+        return result
+
+    with open(f'{path}.tmp', 'ab') as fp:
+        # Only whole vectors of the previous attempt are kept.
+        embedded = fp.tell() // row_size
+        fp.truncate(embedded * row_size)
+        progress = ProcessingProgress(instance_id)
+        progress.enter_stage('embedding', chunks_embedded=embedded, embedding_seconds=0.0)
+
+        def collect(future):
+            batch, vectors, latency = future.result()
+            np.asarray(vectors, dtype=np.float32).tofile(fp)
+            fp.flush()
+            progress.embedded(len(batch), latency)
+
+        # Batches are embedded concurrently, and written in order.
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            chunks = islice(_read_chunks(instance_id), embedded, None)
+            for batch in batched(chunks, settings.MARTINI_EMBEDDING_BATCH_SIZE):
+                if len(pending) >= concurrency:
+                    collect(pending.popleft())
+                pending.append(executor.submit(embed_batch, embeddings, batch))
+            while pending:
+                collect(pending.popleft())
+
+    os.replace(f'{path}.tmp', path)
+    progress.flush()
+    logger.info(f'Embedding cache for {doc_name}: {embeddings.stats}')
+    return result
+
+
+def upsert_chunks(embedded: dict, instance_id: int, collection_name: str, doc_name: str) -> int:
+    '''
+    Last stage: store the embedded chunks of a document in Qdrant, and mark it as processed.
+    The chunks stored are checkpointed after each batch, so that a retry resumes after them.
+
+    Args:
+        embedded (dict): Result of `embed_chunks`.
+        instance_id (int): ID of the UnstructuredDocument instance.
+        collection_name (str): Name of the collection of the document.
+        doc_name (str): Name of the document the embeddings are extracted from.
+
+    Returns:
+        int: Number of chunks stored.
+    '''
+    from apps.documents.ingestion import store_embeddings
+    from apps.documents.models import DocumentCollection
+
+    vectorstore_name = embedded['vectorstore_name']
+    # Memory-mapped, so that only the vectors of the batch being stored are read, whatever the size of the document.
+    vectors = np.memmap(spool_path(instance_id, 'vectors.f32'), dtype=np.float32, mode='r').reshape(
+        -1, embedded['dimension']
+    )
+    # Chunks stored by a previous attempt are skipped, and the ones it stored after its checkpoint
+    # are replaced, as their IDs are deterministic.
+    checkpoint = read_checkpoint(instance_id, CHECKPOINT_STAGES, vectorstore_name)
+    resumed_chunks = chunks_count = checkpoint['chunk'] if checkpoint else 0
+
+    progress = ProcessingProgress(instance_id)
+    started_at = time.perf_counter()
+    flush_size = settings.MARTINI_QDRANT_UPSERT_BATCH_SIZE * settings.MARTINI_QDRANT_UPSERT_PARALLEL
+    for chunks in batched(islice(_read_chunks(instance_id), chunks_count, None), flush_size):
+        store_embeddings(vectorstore_name, chunks, vectors[chunks_count:chunks_count + len(chunks)].tolist())
+        chunks_count += len(chunks)
+        progress.checkpoint({'kind': CHECKPOINT_STAGES, 'vectorstore_name': vectorstore_name, 'chunk': chunks_count})
+    upsert_time = time.perf_counter() - started_at
+    logger.info(f'Stored {chunks_count - resumed_chunks} chunks from {doc_name} in {upsert_time:.2f}s')
+
+    progress.finish(
+        has_embeddings=True,
+        task_id=None,
+        checkpoint=None,
+        embedding_seconds=models.F('embedding_seconds') + upsert_time
+    )
+    DocumentCollection.bump_content_version(collection_name)
+    remove_spool(instance_id)
+    return chunks_count
@@ -0,0 +1,174 @@
+import time
+
+from typing import Iterable, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from langchain.docstore.document import Document
+
+# Stages of the processing of a document, in order.
+STAGES = ['queued', 'parsing', 'chunking', 'embedding', 'indexed']
+
+# Kinds of checkpoints (their `kind`), by the processing recording them: the state of the splitting
+# after a page, when pages are streamed through all the steps at once (UnstructuredDocument.embed_document),
+# or the chunks stored, when the steps run as separate stages (pipeline.upsert_chunks).
+CHECKPOINT_STREAM = 'stream'
+CHECKPOINT_STAGES = 'stages'
+
+
+def count_pages(filepath: str) -> Optional[int]:
+    '''
+    Count the pages of a document, for the progress of its processing only: None if they cannot be counted.
+    '''
+    from apps.documents.loaders import count_pdf_pages
+
+    try:
+        return count_pdf_pages(filepath)
+    except Exception:
+        # Let the extraction report unreadable documents.
+        return None
+
+
+def read_checkpoint(instance_id: int, kind: str, vectorstore_name: str) -> Optional[dict]:
+    '''
+    Return the checkpoint of the processing of a document to resume it from, if recorded by the same `kind`
+    of processing in the same Qdrant collection: None otherwise, e.g. if the collection was re-embedded since.
+    '''
+    from apps.documents.models import UnstructuredDocument
+
+    checkpoint = UnstructuredDocument.objects.filter(id=instance_id).values_list('checkpoint', flat=True).first()
+    if not checkpoint or checkpoint.get('kind') != kind or checkpoint.get('vectorstore_name') != vectorstore_name:
+        return None
+    return checkpoint
+
+
+class ProcessingProgress:
+    '''
+    Record the progress of the processing of an UnstructuredDocument in its row:
+    its stage, pages parsed, chunks embedded and time spent in each stage.
+    Pages are parsed, chunked and embedded as a stream, so stages overlap: the stage of a document is
+    the last one it entered, and the time spent in a stage is the sum of the time spent on its steps.
+    Counters are written at most every MARTINI_PROGRESS_UPDATE_INTERVAL seconds, changes of stage right away,
+    so that processing a document costs a handful of writes whatever its size.
+    '''
+
+    def __init__(self, instance_id: int, interval: float = None):
+        self.instance_id = instance_id
+        self.interval = settings.MARTINI_PROGRESS_UPDATE_INTERVAL if interval is None else interval
+        self.fields = {}
+        self.written_at = 0.0
+
+    def _set(self, force: bool = False, **fields):
+        from apps.documents.models import UnstructuredDocument
+
+        self.fields.update(fields)
+        now = time.monotonic()
+        if force or now - self.written_at >= self.interval:
+            UnstructuredDocument.objects.filter(id=self.instance_id).update(**self.fields)
+            self.written_at = now
+
+    def _enter(self, status: str):
+        # Stages overlap: only move forward.
+        if STAGES.index(status) > STAGES.index(self.fields.get('status', 'queued')):
+            self._set(force=True, status=status)
+
+    def start(self, pages_total: int = None, **fields):
+        '''
+        Mark the document as being parsed, resetting the progress of a previous attempt,
+        except for the counters in `fields` (e.g. when resuming it from a checkpoint).
+        '''
+        self._set(
+            force=True,
+            **{
+                'status': 'parsing',
+                'error': None,
+                'pages_total': pages_total,
+                'pages_parsed': 0,
+                'chunks_total': 0,
+                'chunks_embedded': 0,
+                'parsing_seconds': 0.0,
+                'chunking_seconds': 0.0,
+                'embedding_seconds': 0.0,
+                'processing_started_at': timezone.now(),
+                'processing_finished_at': None,
+                'checkpoint': None,
+                **fields,
+            }
+        )
+
+    def enter_stage(self, status: str, **fields):
+        '''
+        Mark the document as entering a stage run on its own, possibly in another process
+        (see apps.documents.pipeline), setting the counters of the stage to `fields`.
+        '''
+        self._set(force=True, status=status, **fields)
+
+    def track_pages(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+        '''
+        Count the pages of a stream of pages, and the time spent extracting them.
+        '''
+        pages = iter(pages)
+        while True:
+            started_at = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                self.fields['parsing_seconds'] += time.perf_counter() - started_at
+                return
+            self._set(
+                pages_parsed=self.fields['pages_parsed'] + 1,
+                parsing_seconds=self.fields['parsing_seconds'] + time.perf_counter() - started_at,
+            )
+            yield page
+
+    def track_chunks(self, chunks: Iterable[Document]) -> Iterator[Document]:
+        '''
+        Count the chunks of a stream of chunks split from a stream of pages tracked by `track_pages`,
+        and the time spent splitting them (i.e. not spent extracting pages).
+        '''
+        chunks = iter(chunks)
+        while True:
+            started_at = time.perf_counter()
+            parsing_seconds = self.fields.get('parsing_seconds', 0.0)
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            self._enter('chunking')
+            elapsed = time.perf_counter() - started_at - (self.fields.get('parsing_seconds', 0.0) - parsing_seconds)
+            self._set(
+                chunks_total=self.fields['chunks_total'] + 1,
+                chunking_seconds=self.fields['chunking_seconds'] + elapsed,
+            )
+            yield chunk
+
+    def embedded(self, count: int, seconds: float):
+        '''
+        Count chunks embedded, and the time spent embedding them or storing them in the vector store.
+        Suitable as the `on_progress` callback of `embed_and_store`.
+        '''
+        self._enter('embedding')
+        self._set(
+            chunks_embedded=self.fields['chunks_embedded'] + count,
+            embedding_seconds=self.fields['embedding_seconds'] + seconds,
+        )
+
+    def checkpoint(self, checkpoint: dict):
+        '''
+        Record where the processing can resume from (see UnstructuredDocument.embed_document),
+        along with the counters not written yet.
+        '''
+        self._set(force=True, checkpoint=checkpoint)
+
+    def flush(self):
+        '''
+        Write the counters not written yet, e.g. at the end of a stage.
+        '''
+        self._set(force=True)
+
+    def finish(self, **fields):
+        '''
+        Mark the document as indexed once all its chunks are stored, along with other `fields` of its row.
+        '''
+        self._set(force=True, status='indexed', processing_finished_at=timezone.now(), **fields)
@@ -1,12 +1,18 @@
+from django.core.exceptions import ImproperlyConfigured
+
 from rest_framework import serializers
 
-from .models import UnstructuredDocument, DocumentCollection
+from .models import UnstructuredDocument, DocumentCollection, DeletionJob, ImportJob, ReembeddingJob, UploadSession
 
 
 class UnstructuredDocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = UnstructuredDocument
-        fields = ['id', 'name', 'description', 'file', 'task_id', 'collection']
+        fields = [
+            'id', 'name', 'description', 'file', 'task_id', 'collection', 'sha256', 'import_job', 'deletion_job',
+            'status', 'created_at',
+        ]
+        read_only_fields = ['sha256', 'import_job', 'deletion_job', 'status', 'created_at']
         extra_kwargs = {
             'collection': {'required': False}
         }
@@ -18,10 +24,113 @@ class UnstructuredDocumentSerializer(serializers.ModelSerializer):
 
 
 
+def validate_available_embedding_backend(value):
+    '''
+    Check that an embedding backend can be used in this deployment.
+    '''
+    from apps.chats.llm import get_embeddings_model
+
+    try:
+        get_embeddings_model(value)
+    except ImproperlyConfigured as e:
+        raise serializers.ValidationError(str(e))
+    return value
+
+
 class DocumentCollectionSerializer(serializers.ModelSerializer):
     documents=UnstructuredDocumentSerializer(many=True, required=False)
     slug = serializers.SlugField(read_only=True)
 
     class Meta:
         model = DocumentCollection
-        fields = ['id', 'name', 'slug', 'description', 'documents']
+        fields = [
+            'id', 'name', 'slug', 'description', 'documents',
+            'hnsw_m', 'hnsw_ef_construct', 'search_hnsw_ef',
+            'scalar_quantization', 'quantization_rescore', 'quantization_oversampling',
+            'on_disk_vectors', 'on_disk_payload', 'embedding_backend',
+        ]
+
+    def validate_embedding_backend(self, value):
+        '''
+        The embedding backend sets the dimension of the vectors stored in the collection:
+        it can only be chosen at creation, among the backends available in this deployment,
+        and changed afterwards by re-embedding the collection.
+        '''
+        if self.instance is not None and value != self.instance.embedding_backend:
+            raise serializers.ValidationError(
+                'The embedding backend of a collection can only be changed by re-embedding it.'
+            )
+        return validate_available_embedding_backend(value)
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    pending = serializers.IntegerField(read_only=True)
+    throughput = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+        fields = [
+            'id', 'collection', 'task_id', 'total', 'done', 'failed', 'pending', 'throughput',
+            'created_at', 'finished_at',
+        ]
+        read_only_fields = ['task_id', 'total', 'done', 'failed', 'created_at', 'finished_at']
+        extra_kwargs = {
+            'collection': {'required': False}
+        }
+
+
+class DeletionJobSerializer(serializers.ModelSerializer):
+    pending = serializers.IntegerField(read_only=True)
+    # Delete these documents (among those matching the filters, if any).
+    document_ids = serializers.ListField(
+        child=serializers.IntegerField(), write_only=True, required=False, allow_empty=False
+    )
+
+    class Meta:
+        model = DeletionJob
+        fields = [
+            'id', 'document_ids', 'collection', 'created_before', 'task_id', 'total', 'done', 'pending', 'error',
+            'created_at', 'finished_at',
+        ]
+        read_only_fields = ['task_id', 'total', 'done', 'error', 'created_at', 'finished_at']
+
+    def validate(self, data):
+        if not any(data.get(field) is not None for field in ['document_ids', 'collection', 'created_before']):
+            raise serializers.ValidationError(
+                'document_ids, a collection and/or a created_before date are required.'
+            )
+        return data
+
+    def create(self, validated_data):
+        return DeletionJob.start(**validated_data)
+
+
+class ReembeddingJobSerializer(serializers.ModelSerializer):
+    pending = serializers.IntegerField(read_only=True)
+    # Resume the last re-embedding of the collection if it did not succeed, instead of starting a new one.
+    resume = serializers.BooleanField(write_only=True, default=False)
+
+    class Meta:
+        model = ReembeddingJob
+        fields = [
+            'id', 'collection', 'embedding_backend', 'vectorstore_name', 'previous_vectorstore_name',
+            'status', 'task_id', 'done', 'failed', 'pending', 'error',
+            'created_at', 'switched_at', 'finished_at', 'resume',
+        ]
+        read_only_fields = [
+            'collection', 'vectorstore_name', 'previous_vectorstore_name', 'status', 'task_id',
+            'done', 'failed', 'error', 'created_at', 'switched_at', 'finished_at',
+        ]
+        extra_kwargs = {
+            'embedding_backend': {'required': False}
+        }
+
+    def validate_embedding_backend(self, value):
+        return validate_available_embedding_backend(value)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'name', 'description', 'collection', 'size', 'offset', 'document', 'created_at']
+        read_only_fields = ['offset', 'document', 'created_at']
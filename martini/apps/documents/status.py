@@ -0,0 +1,136 @@
+import json
+import asyncio
+import hashlib
+
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+
+from apps.documents.models import UnstructuredDocument
+
+# Fields of an UnstructuredDocument returned by the status endpoints.
+STATUS_FIELDS = [
+    'id', 'task_id', 'status', 'error', 'pages_total', 'pages_parsed', 'chunks_total', 'chunks_embedded',
+    'parsing_seconds', 'chunking_seconds', 'embedding_seconds', 'processing_started_at', 'processing_finished_at',
+]
+
+
+def status_details(progress: dict) -> str:
+    '''
+    Describe the progress of the processing of a document, as returned by the status endpoints.
+    '''
+    if progress['status'] == 'queued':
+        return 'Waiting to be processed'
+    if progress['status'] == 'failed':
+        return f'Processing failed: {progress["error"]}'
+    if progress['status'] == 'indexed':
+        return f'{progress["chunks_embedded"]} chunks indexed'
+    pages = f'{progress["pages_parsed"]}' + (f' of {progress["pages_total"]}' if progress['pages_total'] else '')
+    return f'{pages} pages parsed, {progress["chunks_embedded"]} of {progress["chunks_total"]} chunks embedded'
+
+
+def parse_status_params(data) -> Tuple[Optional[List[int]], Optional[int]]:
+    '''
+    Read the documents whose status is requested from the parameters of a request:
+    a list of `document_ids` (or a comma-separated string of them, in a query string),
+    or the `collection_id` of their collection. Raises a ValueError if they are invalid.
+    '''
+    document_ids = data.get('document_ids')
+    collection_id = data.get('collection_id')
+    if (document_ids is None) == (collection_id is None):
+        raise ValueError('Either document_ids or collection_id is required.')
+
+    if document_ids is not None:
+        if isinstance(document_ids, str):
+            try:
+                document_ids = [int(id) for id in document_ids.split(',') if id.strip()]
+            except ValueError:
+                raise ValueError('document_ids must be a list of document IDs.')
+        if (
+            not isinstance(document_ids, list) or not document_ids
+            or not all(isinstance(id, int) and not isinstance(id, bool) for id in document_ids)
+        ):
+            raise ValueError('document_ids must be a non-empty list of document IDs.')
+        if len(document_ids) > settings.MARTINI_STATUS_MAX_DOCUMENTS:
+            raise ValueError(f'At most {settings.MARTINI_STATUS_MAX_DOCUMENTS} document_ids can be requested at once.')
+        return sorted(set(document_ids)), None
+
+    try:
+        return None, int(collection_id)
+    except (TypeError, ValueError):
+        raise ValueError('collection_id must be a collection ID.')
+
+
+def parse_long_poll_params(data) -> Tuple[Optional[str], float]:
+    '''
+    Read the `version` of the statuses known to the client, and how long to wait for them to change
+    (`timeout`, in seconds, at most MARTINI_STATUS_LONG_POLL_TIMEOUT), from the parameters of a request.
+    '''
+    try:
+        timeout = float(data.get('timeout', settings.MARTINI_STATUS_LONG_POLL_TIMEOUT))
+    except (TypeError, ValueError):
+        raise ValueError('timeout must be a number of seconds.')
+    return data.get('version') or None, min(max(timeout, 0.0), settings.MARTINI_STATUS_LONG_POLL_TIMEOUT)
+
+
+def _statuses_query(document_ids: Optional[List[int]], collection_id: Optional[int]):
+    documents = UnstructuredDocument.objects.order_by('id')
+    if document_ids is not None:
+        documents = documents.filter(id__in=document_ids)
+    else:
+        documents = documents.filter(collection_id=collection_id)
+    # Lists of IDs are bounded by parse_status_params, the documents of a collection here.
+    return documents.values(*STATUS_FIELDS)[:settings.MARTINI_STATUS_MAX_DOCUMENTS]
+
+
+def _statuses_response(rows: List[dict], document_ids: Optional[List[int]]) -> dict:
+    for row in rows:
+        row['details'] = status_details(row)
+    # Fingerprint of the statuses, for clients to wait for them to change.
+    version = hashlib.blake2b(
+        json.dumps(rows, sort_keys=True, default=str).encode('utf-8'), digest_size=8
+    ).hexdigest()
+    response = {'version': version, 'documents': rows}
+    if document_ids is not None:
+        found = {row['id'] for row in rows}
+        # E.g. deleted documents.
+        response['missing'] = [id for id in document_ids if id not in found]
+    return response
+
+
+def get_statuses(document_ids: Optional[List[int]], collection_id: Optional[int]) -> dict:
+    '''
+    Read the statuses of many documents, by IDs or by collection, in a single query.
+    '''
+    return _statuses_response(list(_statuses_query(document_ids, collection_id)), document_ids)
+
+
+async def aget_statuses(document_ids: Optional[List[int]], collection_id: Optional[int]) -> dict:
+    '''
+    Asynchronous version of `get_statuses`.
+    '''
+    return _statuses_response([row async for row in _statuses_query(document_ids, collection_id)], document_ids)
+
+
+async def await_statuses(
+    document_ids: Optional[List[int]],
+    collection_id: Optional[int],
+    version: Optional[str],
+    timeout: float,
+) -> dict:
+    '''
+    Wait for the statuses of documents to differ from `version`, for at most `timeout` seconds,
+    reading them after MARTINI_STATUS_LONG_POLL_INTERVAL seconds, then twice as long after each read
+    without change, up to MARTINI_STATUS_LONG_POLL_MAX_INTERVAL seconds. Returns them as soon as they differ
+    (right away without `version`), or as they are once the timeout expires.
+    '''
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    interval = settings.MARTINI_STATUS_LONG_POLL_INTERVAL
+    while True:
+        statuses = await aget_statuses(document_ids, collection_id)
+        remaining = deadline - loop.time()
+        if statuses['version'] != version or remaining <= 0:
+            return statuses
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 2, max(settings.MARTINI_STATUS_LONG_POLL_MAX_INTERVAL, interval))
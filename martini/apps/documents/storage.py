@@ -0,0 +1,179 @@
+import os
+import time
+import uuid
+import fcntl
+import hashlib
+import zipfile
+
+from contextlib import contextmanager
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile
+
+from config.cache import LRUCache
+
+# Size of the chunks files are read and written by.
+CHUNK_SIZE = 64 * 1024
+
+# Hashes of the uploads in progress in this process, along with the offset they were computed up to,
+# so that each part of an upload only has to be hashed once.
+_upload_hashers = LRUCache(maxsize=256)
+
+
+def unique_upload_name() -> str:
+    '''
+    Generate a unique name to store an uploaded file with.
+    '''
+    return f'{int(time.time())}_{uuid.uuid4()}.pdf'
+
+
+def storage_path(file_name: str) -> str:
+    '''
+    Path of a stored file, from the perspective of the processes handling the documents.
+    '''
+    media_root = settings.MEDIA_ROOT if settings.APP_ENV == 'local' else settings.MEDIA_ROOT_DOCKER
+    return f'{media_root}/{file_name}'
+
+
+def file_digest(file: File) -> str:
+    '''
+    Compute the SHA-256 of a file, reading it chunk by chunk.
+    '''
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def upload_hasher(upload_id: str, path: str, offset: int) -> 'hashlib._Hash':
+    '''
+    Return the SHA-256 of the first `offset` bytes of an upload in progress.
+    The hash is kept in memory between parts, and only computed again from the file
+    when a part was received by another process.
+    '''
+    cached = _upload_hashers.get_many([upload_id]).get(upload_id)
+    if cached is not None and cached[0] == offset:
+        return cached[1].copy()
+
+    sha256 = hashlib.sha256()
+    remaining = offset
+    with open(path, 'rb') as fp:
+        while remaining > 0:
+            chunk = fp.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            remaining -= len(chunk)
+    return sha256
+
+
+def remember_upload_hasher(upload_id: str, offset: int, sha256: 'hashlib._Hash'):
+    _upload_hashers.set_many({upload_id: (offset, sha256)})
+
+
+@contextmanager
+def upload_lock(path: str) -> Iterator[bool]:
+    '''
+    Lock the file of an upload in progress, so that a single part of the upload is written at a time
+    by the processes of the host. The lock is not waited for: yields whether it was acquired.
+    It is released when the process holding it dies, e.g. if a request is interrupted.
+    '''
+    with open(path, 'rb') as fp:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def write_part(path: str, offset: int, stream: Optional[BinaryIO], sha256: 'hashlib._Hash') -> int:
+    '''
+    Write a part of an upload to the file at `path`, starting at `offset`, straight from the request stream.
+    Anything previously written after `offset` (i.e. a part that was not acknowledged) is discarded.
+    Returns the number of bytes written.
+    '''
+    written = 0
+    with open(path, 'r+b') as fp:
+        fp.seek(offset)
+        fp.truncate()
+        while stream is not None:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            fp.write(chunk)
+            sha256.update(chunk)
+            written += len(chunk)
+    return written
+
+
+def store_file(stream: BinaryIO, file_name: str) -> str:
+    '''
+    Write a file to the media directory under `file_name`, chunk by chunk.
+    Returns the SHA-256 of the file.
+    '''
+    sha256 = hashlib.sha256()
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    with open(os.path.join(settings.MEDIA_ROOT, file_name), 'wb') as fp:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            fp.write(chunk)
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def store_import_files(
+    files: Iterable[UploadedFile],
+    archive: Optional[UploadedFile],
+    max_documents: int,
+) -> List[Tuple[str, str, str]]:
+    '''
+    Store the files of a bulk import in the media directory: uploaded files, and the PDFs of a zip archive.
+    Identical files are only stored once.
+    Returns the name of the document, the name of its stored file and its SHA-256, for each file.
+    Raises ValueError if the archive is not a valid zip file, or if there are more than `max_documents` files;
+    the files stored until then are deleted.
+    '''
+    stored = []
+    file_names = {}
+
+    def store(name: str, stream: BinaryIO):
+        if len(stored) >= max_documents:
+            raise ValueError(f'An import cannot contain more than {max_documents} documents.')
+        file_name = unique_upload_name()
+        sha256 = store_file(stream, file_name)
+        if sha256 in file_names:
+            os.remove(os.path.join(settings.MEDIA_ROOT, file_name))
+        else:
+            file_names[sha256] = file_name
+        stored.append(((name or 'Untitled')[:255], file_names[sha256], sha256))
+
+    try:
+        for file in files:
+            store(os.path.splitext(os.path.basename(file.name))[0], file)
+        if archive is not None:
+            try:
+                with zipfile.ZipFile(archive) as zip_file:
+                    for info in zip_file.infolist():
+                        base_name = os.path.basename(info.filename)
+                        # Skip folders, and the metadata macOS adds to archives.
+                        if info.is_dir() or info.filename.startswith('__MACOSX/') or base_name.startswith('.'):
+                            continue
+                        if not base_name.lower().endswith('.pdf'):
+                            continue
+                        with zip_file.open(info) as stream:
+                            store(os.path.splitext(base_name)[0], stream)
+            except (zipfile.BadZipFile, NotImplementedError) as e:
+                raise ValueError(f'The archive is not a valid zip file: {e}')
+    except Exception:
+        for file_name in file_names.values():
+            os.remove(os.path.join(settings.MEDIA_ROOT, file_name))
+        raise
+    return stored
@@ -1,6 +1,6 @@
 import os
 
-from celery import shared_task
+from celery import chain, shared_task
 from celery.utils.log import get_task_logger
 
 from apps.documents.models import UnstructuredDocument
@@ -8,16 +8,17 @@ from apps.documents.models import UnstructuredDocument
 logger = get_task_logger(__name__)
 
 
-@shared_task(bind=True, max_retries=3)
-def save_embeddings(
+@shared_task(bind=True, max_retries=3, acks_late=True, reject_on_worker_lost=True)
+def copy_embeddings(
     self,
-    filepath: str = None,
-    collection_name: str = None,
-    doc_name: str = None,
-    instance_id: int = None
+    source_collection_name: str,
+    source_instance_id: int,
+    collection_name: str,
+    doc_name: str,
+    instance_id: int
 ):
     '''
-    Celery task creating embeddings and storing them in Qdrant using the
+    Celery task copying the embeddings of an identical document in Qdrant using the
     class method in UnstructuredDocument.
     During this operation, the status of the task can be checked
     via the /api/documents/{task_id}/status endpoint.
@@ -25,32 +26,26 @@ def save_embeddings(
     Note: not used in local development.
 
     Args:
-        filepath (str): Path to the file to process.
+        source_collection_name (str): Name of the collection storing the embeddings to copy.
+        source_instance_id (int): ID of the UnstructuredDocument instance the embeddings belong to.
         collection_name (str): Name of the collection to store the embeddings in.
-        doc_name (str): Name of the document the embeddings are extracted from;
-            this is used as a marker in the metadata of the embeddings for when
-            the document is deleted.
+        doc_name (str): Name of the document the embeddings are copied for.
         instance_id (int): ID of the UnstructuredDocument instance.
     '''
-    from apps.documents.exceptions import UnprocessableDocumentError
-
     try:
-        UnstructuredDocument.save_embeddings(
-            filepath,
+        UnstructuredDocument.copy_embeddings(
+            source_collection_name,
+            source_instance_id,
             collection_name,
             doc_name,
             instance_id
         )
     except Exception as e:
-        # Check exception type to avoid retrying on non-retryable errors.
-        if isinstance(e, UnprocessableDocumentError):
-            logger.error(f'Embeddings storage failed, Aborting. Error: {e}')
-        else:
-            try:
-                logger.error(f'Embeddings storage failed, retrying after 5 seconds. Error: {e}')
-                raise self.retry(exc=e, countdown=5)
-            except self.MaxRetriesExceededError:
-                logger.error('Max retries exceeded for task %s', self.request.id)
+        if self.request.retries >= self.max_retries:
+            # Retrying raises the error from now on.
+            UnstructuredDocument.mark_failed(instance_id, str(e))
+        logger.error('Embeddings copy failed, retrying after 5 seconds. Error: %s', e)
+        raise self.retry(exc=e, countdown=5)
 
 @shared_task(bind=True, max_retries=3)
 def delete_embeddings(self, collection_name: str, doc_name: str, instance_id: int):
@@ -79,3 +74,214 @@ def delete_embeddings(self, collection_name: str, doc_name: str, instance_id: in
     except Exception as e:
         logger.error('Embeddings deletion failed, retrying after 5 seconds. Error: %s', e)
         raise self.retry(exc=e, countdown=5)
+
+@shared_task(bind=True, max_retries=3, acks_late=True, reject_on_worker_lost=True)
+def import_document(self, job_id: int, instance_id: int, file_name: str) -> bool:
+    '''
+    Celery task processing a document of a bulk import using the class method in UnstructuredDocument.
+    The embeddings of an identical document are copied right away, and the document counted as done in its ImportJob.
+    Otherwise, the document is sent to the stages of `dispatch_ingestion`, which count it as done or failed
+    once its embeddings are stored (or given up on).
+
+    Args:
+        job_id (int): ID of the ImportJob instance.
+        instance_id (int): ID of the UnstructuredDocument instance.
+        file_name (str): Name of the file of the document, in the media directory.
+
+    Returns:
+        bool: Whether the embeddings of an identical document were copied.
+    '''
+    from apps.documents.exceptions import UnprocessableDocumentError
+    from apps.documents.models import ImportJob
+
+    try:
+        copied = UnstructuredDocument.import_document(instance_id, file_name, ingest=dispatch_ingestion)
+    except UnprocessableDocumentError as e:
+        logger.error(f'Import of document {instance_id} failed, Aborting. Error: {e}')
+        UnstructuredDocument.mark_failed(instance_id, str(e))
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            logger.error(f'Import of document {instance_id} failed, retrying after 5 seconds. Error: {e}')
+            raise self.retry(exc=e, countdown=5)
+        logger.error('Max retries exceeded for task %s', self.request.id)
+        UnstructuredDocument.mark_failed(instance_id, str(e))
+    else:
+        if copied:
+            ImportJob.record_result(job_id, succeeded=True)
+        return copied
+    ImportJob.record_result(job_id, succeeded=False)
+    return False
+
+# Acknowledged once done, so that the task runs again if its worker is lost: it resumes with the documents left.
+@shared_task(bind=True, max_retries=3, acks_late=True, reject_on_worker_lost=True)
+def delete_documents(self, job_id: int):
+    '''
+    Celery task deleting documents in bulk using the class method in DeletionJob.
+    Retries resume with the documents not deleted yet.
+
+    Note: not used in local development.
+
+    Args:
+        job_id (int): ID of the DeletionJob instance.
+    '''
+    from apps.documents.models import DeletionJob
+
+    try:
+        DeletionJob.run(job_id)
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            logger.error(f'Deletion {job_id} failed, retrying after 5 seconds. Error: {e}')
+            raise self.retry(exc=e, countdown=5)
+        logger.error('Max retries exceeded for task %s', self.request.id)
+        DeletionJob.fail(job_id, str(e))
+
+@shared_task(bind=True, max_retries=3)
+def reembed_collection(self, job_id: int):
+    '''
+    Celery task re-embedding a collection into a new Qdrant collection and switching to it,
+    using the class method in ReembeddingJob. Retries resume after the last document re-embedded.
+    Once the job succeeded, the previous Qdrant collection is deleted after MARTINI_REEMBEDDING_GRACE_PERIOD.
+
+    Note: not used in local development.
+
+    Args:
+        job_id (int): ID of the ReembeddingJob instance.
+    '''
+    from django.conf import settings
+
+    from apps.documents.models import ReembeddingJob
+
+    try:
+        ReembeddingJob.run(job_id)
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            logger.error(f'Re-embedding {job_id} failed, retrying after 5 seconds. Error: {e}')
+            raise self.retry(exc=e, countdown=5)
+        logger.error('Max retries exceeded for task %s', self.request.id)
+        ReembeddingJob.fail(job_id, str(e))
+        return
+    collect_reembedding_garbage.apply_async((job_id,), countdown=settings.MARTINI_REEMBEDDING_GRACE_PERIOD)
+
+@shared_task
+def collect_reembedding_garbage(job_id: int):
+    '''
+    Celery task deleting the Qdrant collection replaced by a re-embedding.
+
+    Args:
+        job_id (int): ID of the ReembeddingJob instance.
+    '''
+    from apps.documents.models import ReembeddingJob
+
+    ReembeddingJob.collect_garbage(job_id)
+
+def ingestion_chain(filepath: str, collection_name: str, doc_name: str, instance_id: int) -> chain:
+    '''
+    Chain of Celery tasks processing a document, one per stage (see apps.documents.pipeline):
+    extract_pages and chunk_pages are routed to the CPU-bound queue (MARTINI_INGESTION_CPU_QUEUE),
+    embed_chunks and upsert_chunks to the I/O-bound queue (MARTINI_INGESTION_IO_QUEUE).
+    All stages are sent with the priority of the size of the document, so that small documents go first.
+
+    Args:
+        filepath (str): Path to the file to process.
+        collection_name (str): Name of the collection to store the embeddings in.
+        doc_name (str): Name of the document the embeddings are extracted from.
+        instance_id (int): ID of the UnstructuredDocument instance.
+
+    Returns:
+        chain: The stages, not sent yet.
+    '''
+    from apps.documents.pipeline import ingestion_priority
+
+    try:
+        priority = ingestion_priority(os.path.getsize(filepath))
+    except OSError:
+        # Let extract_pages report missing files.
+        priority = ingestion_priority(0)
+    return chain(
+        extract_pages.si(instance_id, filepath, doc_name).set(priority=priority),
+        chunk_pages.si(instance_id, doc_name).set(priority=priority),
+        embed_chunks.si(instance_id, collection_name, doc_name).set(priority=priority),
+        # Receives the result of embed_chunks.
+        upsert_chunks.s(instance_id, collection_name, doc_name).set(priority=priority),
+    )
+
+def dispatch_ingestion(filepath: str, collection_name: str, doc_name: str, instance_id: int):
+    '''
+    Send the stages of the processing of a document to the Celery workers (see `ingestion_chain`).
+    Not a task itself: it is called where the document is stored, and returns once the stages are sent.
+    A retried embed_chunks or upsert_chunks resumes where the previous attempt stopped.
+    Documents of a bulk import are counted as done or failed in their ImportJob once processed (or given up on).
+    Counterpart of UnstructuredDocument.save_embeddings, which runs the stages as a stream, in local development.
+
+    Args:
+        filepath (str): Path to the file to process.
+        collection_name (str): Name of the collection to store the embeddings in.
+        doc_name (str): Name of the document the embeddings are extracted from.
+        instance_id (int): ID of the UnstructuredDocument instance.
+
+    Returns:
+        AsyncResult: Result of the last stage.
+    '''
+    return ingestion_chain(filepath, collection_name, doc_name, instance_id).apply_async()
+
+def _run_stage(task, stage, instance_id: int, *args):
+    '''
+    Run a stage of the processing of a document in a Celery task, retrying on errors that may not happen again.
+    Once given up on, the document is marked as failed, and the error raised to stop the chain.
+    '''
+    from apps.documents.exceptions import UnprocessableDocumentError
+    from apps.documents.models import ImportJob
+    from apps.documents.pipeline import remove_spool
+
+    try:
+        return stage(*args)
+    except Exception as e:
+        if not isinstance(e, UnprocessableDocumentError) and task.request.retries < task.max_retries:
+            logger.error(f'{task.name} failed for document {instance_id}, retrying after 5 seconds. Error: {e}')
+            raise task.retry(exc=e, countdown=5)
+        logger.error(f'{task.name} failed for document {instance_id}, Aborting. Error: {e}')
+        UnstructuredDocument.mark_failed(instance_id, str(e))
+        ImportJob.record_document_result(instance_id, succeeded=False)
+        remove_spool(instance_id)
+        raise
+
+@shared_task(bind=True, max_retries=3, acks_late=True, reject_on_worker_lost=True)
+def extract_pages(self, instance_id: int, filepath: str, doc_name: str) -> int:
+    '''
+    Celery task extracting the text of the pages of a document (CPU-bound), first stage of `ingestion_chain`.
+    '''
+    from apps.documents import pipeline
+
+    return _run_stage(self, pipeline.extract_pages, instance_id, instance_id, filepath, doc_name)
+
+@shared_task(bind=True, max_retries=3, acks_late=True, reject_on_worker_lost=True)
+def chunk_pages(self, instance_id: int, doc_name: str) -> int:
+    '''
+    Celery task splitting the pages of a document into chunks (CPU-bound), second stage of `ingestion_chain`.
+    '''
+    from apps.documents import pipeline
+
+    return _run_stage(self, pipeline.chunk_pages, instance_id, instance_id, doc_name)
+
+@shared_task(bind=True, max_retries=3, acks_late=True, reject_on_worker_lost=True)
+def embed_chunks(self, instance_id: int, collection_name: str, doc_name: str) -> dict:
+    '''
+    Celery task embedding the chunks of a document (I/O-bound), third stage of `ingestion_chain`.
+    '''
+    from apps.documents import pipeline
+
+    return _run_stage(self, pipeline.embed_chunks, instance_id, instance_id, collection_name, doc_name)
+
+@shared_task(bind=True, max_retries=3, acks_late=True, reject_on_worker_lost=True)
+def upsert_chunks(self, embedded: dict, instance_id: int, collection_name: str, doc_name: str) -> int:
+    '''
+    Celery task storing the embedded chunks of a document in Qdrant (I/O-bound), last stage of `ingestion_chain`.
+    '''
+    from apps.documents import pipeline
+    from apps.documents.models import ImportJob
+
+    chunks_count = _run_stage(
+        self, pipeline.upsert_chunks, instance_id, embedded, instance_id, collection_name, doc_name
+    )
+    ImportJob.record_document_result(instance_id, succeeded=True)
+    return chunks_count
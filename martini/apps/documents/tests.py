@@ -1,3 +1,593 @@
-from django.test import TestCase
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
 
-# Create your tests here.
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+
+from django.conf import settings
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from apps.documents import ingestion, pipeline, status, storage, tasks, vectorstore
+from apps.documents.loaders import iter_chunks
+from apps.documents.local_vectorstore import LocalCollection, LocalVectorStore, LocalVectorStoreForChains
+from apps.documents.models import DeletionJob, DocumentCollection, UnstructuredDocument, UploadSession
+from apps.documents.progress import CHECKPOINT_STAGES, CHECKPOINT_STREAM, read_checkpoint
+from apps.documents.vectorstore import IndexProfile, point_id
+from config.celery import celery
+
+PAGES = [
+    (1, 'The first page talks about apples. ' * 6),
+    (2, 'The second page talks about pears. ' * 6),
+    (3, ''),
+    (4, 'The fourth page talks about plums. ' * 6),
+]
+SHORT_PAGES = [(number, f'Page {number} is short.') for number in range(1, 7)]
+
+
+class IterChunksTest(SimpleTestCase):
+    def split(self, pages, **kwargs):
+        return [
+            (chunk.page_content, chunk.metadata)
+            for chunk in iter_chunks(pages, chunk_size=100, chunk_overlap=20, **kwargs)
+        ]
+
+    def test_chunks_are_the_same_as_splitting_the_whole_document(self):
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=20)
+        whole_document = '\n'.join(text for _, text in PAGES if text)
+
+        chunks = self.split(PAGES)
+
+        self.assertEqual([text for text, _ in chunks], text_splitter.split_text(whole_document))
+        self.assertEqual([metadata['chunk'] for _, metadata in chunks], list(range(len(chunks))))
+
+    def test_short_pages_are_chunked_together(self):
+        chunks = self.split(SHORT_PAGES)
+
+        # The end of a page is split along with the next pages, not on its own.
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(chunks[0][0].startswith('Page 1 ') and 'Page 4 ' in chunks[0][0])
+        self.assertEqual([metadata['page'] for _, metadata in chunks], [1, 5])
+
+    def test_chunks_belong_to_the_page_they_start_on(self):
+        chunks = self.split(PAGES)
+
+        for text, metadata in chunks:
+            first_fruit = re.search('apples|pears|plums', text).group()
+            self.assertEqual(metadata['page'], {'apples': 1, 'pears': 2, 'plums': 4}[first_fruit], text)
+        self.assertEqual(sorted({metadata['page'] for _, metadata in chunks}), [1, 2, 4])
+
+    def test_resume_from_the_state_after_a_page(self):
+        for pages in (PAGES, SHORT_PAGES):
+            states = []
+            chunks = self.split(pages, on_page=states.append)
+
+            for state in states:
+                resumed = self.split([page for page in pages if page[0] > state['page']], state=state)
+                self.assertEqual(resumed, chunks[state['chunk']:], state)
+
+
+class LocalCollectionTest(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.collection = LocalCollection(os.path.join(temp_dir.name, 'collection'))
+        self.collection.create(3)
+
+    def add(self, instance_id, vectors, text='chunk'):
+        metadatas = [{'instance_id': instance_id, 'chunk': chunk} for chunk in range(len(vectors))]
+        self.collection.add(
+            [point_id(metadata) for metadata in metadatas],
+            [f'{text} {chunk} of {instance_id}' for chunk in range(len(vectors))],
+            vectors,
+            metadatas,
+        )
+
+    def test_search_ranks_by_cosine_similarity(self):
+        self.add(1, [[1, 0, 0], [0, 1, 0]])
+        self.add(2, [[2, 0.2, 0], [0, 0, 1]])
+
+        results = self.collection.search([1, 0, 0], k=3)
+
+        self.assertEqual([document.page_content for document, _, _ in results], [
+            'chunk 0 of 1', 'chunk 0 of 2', 'chunk 1 of 1',
+        ])
+        self.assertAlmostEqual(results[0][1], 1.0, places=5)
+        self.assertGreater(results[1][1], results[2][1])
+
+    def test_search_among_instances(self):
+        self.add(1, [[1, 0, 0]])
+        self.add(2, [[0, 1, 0]])
+
+        results = self.collection.search([1, 0, 0], k=2, instance_ids=[2], with_vectors=True)
+
+        self.assertEqual(len(results), 1)
+        document, _, vector = results[0]
+        self.assertEqual(document.metadata, {'instance_id': 2, 'chunk': 0})
+        self.assertEqual(vector, [0, 1, 0])
+
+    def test_delete_writes_the_next_generation(self):
+        self.add(1, [[1, 0, 0], [0, 1, 0]])
+        self.add(2, [[0, 0, 1]])
+        previous = self.collection.snapshot()
+
+        self.assertEqual(self.collection.delete([1]), 2)
+        self.assertEqual(self.collection.delete([1]), 0)
+
+        files = sorted(os.listdir(self.collection.path))
+        self.assertIn('vectors.1.f32', files)
+        self.assertNotIn('vectors.0.f32', files)
+        results = self.collection.search([1, 0, 0], k=3)
+        self.assertEqual([document.page_content for document, _, _ in results], ['chunk 0 of 2'])
+        # Searches still holding the previous generation keep reading it.
+        self.assertEqual(len(previous.vectors), 3)
+        self.assertEqual(previous.document(0).page_content, 'chunk 0 of 1')
+
+    def test_adding_the_same_ids_replaces_rows(self):
+        self.add(1, [[1, 0, 0], [0, 1, 0]], text='old')
+        self.add(2, [[0, 0, 1]])
+
+        self.add(1, [[1, 0, 0], [0, 1, 0]], text='new')
+
+        snapshot = self.collection.snapshot()
+        self.assertEqual(len(snapshot.vectors), 3)
+        self.assertEqual(
+            sorted(snapshot.document(row).page_content for row in range(3)),
+            ['chunk 0 of 2', 'new 0 of 1', 'new 1 of 1'],
+        )
+
+    def test_vectors_of_another_dimension_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.add(1, [[1, 0]])
+
+    def test_collections_are_shared_through_the_path(self):
+        self.add(1, [[1, 0, 0]])
+
+        other_process = LocalCollection(self.collection.path)
+
+        self.assertEqual(len(other_process.search([1, 0, 0], k=1)), 1)
+        self.collection.delete([1])
+        self.assertEqual(other_process.search([1, 0, 0], k=1), [])
+
+
+class LocalVectorStoreForChainsTest(SimpleTestCase):
+    def test_from_texts(self):
+        from langchain.embeddings.fake import FakeEmbeddings
+
+        with tempfile.TemporaryDirectory() as path:
+            metadatas = [{'instance_id': 1, 'chunk': chunk} for chunk in range(2)]
+            store = LocalVectorStoreForChains.from_texts(
+                ['first', 'second'], FakeEmbeddings(size=4), metadatas, path=path, collection_name='chains'
+            )
+            store.add_texts(['first again'], metadatas[:1])
+
+            self.assertTrue(os.path.exists(os.path.join(path, 'chains', 'meta.json')))
+            self.assertEqual(len(store.collection.snapshot().vectors), 2)
+            self.assertEqual(len(store.similarity_search('query', k=5)), 2)
+
+
+class CheckpointTest(TestCase):
+    CHUNKS_COUNT = 5
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        settings_override = override_settings(
+            MARTINI_INGESTION_SPOOL_DIR=os.path.join(temp_dir.name, 'spool'),
+            MARTINI_QDRANT_UPSERT_BATCH_SIZE=1,
+            MARTINI_QDRANT_UPSERT_PARALLEL=2,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.store = LocalVectorStore(os.path.join(temp_dir.name, 'vectorstore'))
+        store_patch = mock.patch('apps.documents.vectorstore.get_local_store', return_value=self.store)
+        store_patch.start()
+        self.addCleanup(store_patch.stop)
+
+        self.store.create_collection('checkpoints', 3)
+        self.collection = DocumentCollection.objects.create(name='checkpoints', slug='checkpoints')
+        self.document = UnstructuredDocument.objects.create(
+            name='document.pdf', file='document.pdf', collection=self.collection
+        )
+
+    def spool(self):
+        # Output of the stages before upsert_chunks.
+        os.makedirs(pipeline.spool_path(self.document.id))
+        with open(pipeline.spool_path(self.document.id, 'chunks.jsonl'), 'w') as fp:
+            for chunk in range(self.CHUNKS_COUNT):
+                metadata = {'page': 1, 'chunk': chunk, 'instance_id': self.document.id}
+                fp.write(json.dumps({'page_content': f'chunk {chunk}', 'metadata': metadata}) + '\n')
+        np.eye(self.CHUNKS_COUNT, 3, dtype=np.float32).tofile(pipeline.spool_path(self.document.id, 'vectors.f32'))
+
+    def upsert(self):
+        embedded = {'vectorstore_name': 'checkpoints', 'dimension': 3}
+        with mock.patch.object(ingestion, 'store_embeddings', wraps=ingestion.store_embeddings) as store_embeddings:
+            self.assertEqual(
+                pipeline.upsert_chunks(embedded, self.document.id, 'checkpoints', 'document.pdf'),
+                self.CHUNKS_COUNT,
+            )
+        return [chunk.metadata['chunk'] for call in store_embeddings.call_args_list for chunk in call.args[1]]
+
+    def set_checkpoint(self, checkpoint):
+        UnstructuredDocument.objects.filter(id=self.document.id).update(checkpoint=checkpoint)
+
+    def stored_chunks(self):
+        snapshot = self.store.collection('checkpoints').snapshot()
+        return sorted(snapshot.payload(row)['metadata']['chunk'] for row in range(len(snapshot.vectors)))
+
+    def test_point_ids_are_derived_from_the_instance_and_chunk(self):
+        self.assertEqual(point_id({'instance_id': 1, 'chunk': 2}), point_id({'chunk': 2, 'instance_id': 1, 'page': 3}))
+        self.assertNotEqual(point_id({'instance_id': 1, 'chunk': 2}), point_id({'instance_id': 2, 'chunk': 1}))
+        self.assertNotEqual(point_id({'page': 1}), point_id({'page': 1}))
+
+    def test_checkpoints_of_another_processing_or_collection_are_ignored(self):
+        self.set_checkpoint({'kind': CHECKPOINT_STAGES, 'vectorstore_name': 'checkpoints', 'chunk': 2})
+
+        self.assertEqual(read_checkpoint(self.document.id, CHECKPOINT_STAGES, 'checkpoints')['chunk'], 2)
+        self.assertIsNone(read_checkpoint(self.document.id, CHECKPOINT_STREAM, 'checkpoints'))
+        self.assertIsNone(read_checkpoint(self.document.id, CHECKPOINT_STAGES, 'reembedded'))
+        # Recorded before checkpoints had a kind.
+        self.set_checkpoint({'vectorstore_name': 'checkpoints', 'page': 3, 'chunk': 2})
+        self.assertIsNone(read_checkpoint(self.document.id, CHECKPOINT_STAGES, 'checkpoints'))
+
+    def test_upsert_resumes_after_the_checkpoint(self):
+        self.spool()
+        self.set_checkpoint({'kind': CHECKPOINT_STAGES, 'vectorstore_name': 'checkpoints', 'chunk': 2})
+
+        self.assertEqual(self.upsert(), [2, 3, 4])
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, 'indexed')
+        self.assertTrue(self.document.has_embeddings)
+        self.assertIsNone(self.document.checkpoint)
+        self.assertFalse(os.path.exists(pipeline.spool_path(self.document.id)))
+
+    def test_rerunning_an_upsert_replaces_the_chunks_stored(self):
+        self.spool()
+        self.assertEqual(self.upsert(), [0, 1, 2, 3, 4])
+
+        # Redelivered with a checkpoint older than the chunks stored, and one of another processing.
+        for checkpoint in (
+            {'kind': CHECKPOINT_STAGES, 'vectorstore_name': 'checkpoints', 'chunk': 1},
+            {'kind': CHECKPOINT_STREAM, 'vectorstore_name': 'checkpoints', 'page': 1, 'chunk': 4},
+        ):
+            self.spool()
+            self.set_checkpoint(checkpoint)
+            self.upsert()
+
+        self.assertEqual(self.stored_chunks(), [0, 1, 2, 3, 4])
+
+
+@override_settings(MARTINI_INGESTION_PRIORITY_BASE_SIZE=1024)
+class IngestionChainTest(SimpleTestCase):
+    def setUp(self):
+        temp_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(temp_file.close)
+        temp_file.write(b'%PDF' * 768)
+        temp_file.flush()
+        self.filepath = temp_file.name
+
+    def test_stages_are_chained_on_their_queues(self):
+        stages = tasks.ingestion_chain(self.filepath, 'default', 'document.pdf', 7).tasks
+
+        self.assertEqual([stage.task for stage in stages], [
+            'apps.documents.tasks.extract_pages',
+            'apps.documents.tasks.chunk_pages',
+            'apps.documents.tasks.embed_chunks',
+            'apps.documents.tasks.upsert_chunks',
+        ])
+        self.assertEqual([stage.args for stage in stages], [
+            (7, self.filepath, 'document.pdf'),
+            (7, 'document.pdf'),
+            (7, 'default', 'document.pdf'),
+            (7, 'default', 'document.pdf'),
+        ])
+        # Only upsert_chunks receives the result of the previous stage.
+        self.assertEqual([stage.immutable for stage in stages], [True, True, True, False])
+        self.assertEqual(
+            [celery.amqp.router.route(stage.options, stage.task)['queue'].name for stage in stages],
+            [settings.MARTINI_INGESTION_CPU_QUEUE] * 2 + [settings.MARTINI_INGESTION_IO_QUEUE] * 2,
+        )
+
+    def test_stages_have_the_priority_of_the_size_of_the_document(self):
+        stages = tasks.ingestion_chain(self.filepath, 'default', 'document.pdf', 7).tasks
+
+        self.assertEqual(pipeline.ingestion_priority(3072), 2)
+        self.assertEqual([stage.options['priority'] for stage in stages], [2] * 4)
+        missing_file = tasks.ingestion_chain('/missing.pdf', 'default', 'document.pdf', 7).tasks
+        self.assertEqual([stage.options['priority'] for stage in missing_file], [0] * 4)
+
+    def test_dispatch_sends_the_chain(self):
+        with mock.patch('celery.canvas._chain.apply_async') as apply_async:
+            result = tasks.dispatch_ingestion(self.filepath, 'default', 'document.pdf', 7)
+
+        apply_async.assert_called_once_with()
+        self.assertIs(result, apply_async.return_value)
+        self.assertFalse(hasattr(tasks.dispatch_ingestion, 'delay'))
+
+
+class UpdateVectorstoreCollectionTest(SimpleTestCase):
+    def update(self, profile):
+        with mock.patch.object(vectorstore, 'get_local_store', return_value=None), \
+                mock.patch.object(vectorstore, 'get_client') as get_client:
+            vectorstore.update_vectorstore_collection('documents', profile)
+        request = get_client.return_value.http.collections_api.api_client.request
+        request.assert_called_once()
+        self.assertEqual(request.call_args.kwargs['method'], 'PATCH')
+        self.assertEqual(request.call_args.kwargs['path_params'], {'collection_name': 'documents'})
+        return request.call_args.kwargs['json']
+
+    def test_request_body_with_quantization(self):
+        body = self.update(IndexProfile(
+            hnsw_m=32, scalar_quantization=True, on_disk_vectors=True, on_disk_payload=True
+        ))
+
+        self.assertEqual(body, {
+            'vectors': {'': {'on_disk': True}},
+            'params': {'on_disk_payload': True},
+            'quantization_config': {'scalar': {'type': 'int8', 'quantile': 0.99, 'always_ram': True}},
+            'hnsw_config': {'m': 32},
+        })
+
+    def test_request_body_disabling_quantization(self):
+        body = self.update(IndexProfile())
+
+        self.assertEqual(body, {
+            'vectors': {'': {'on_disk': False}},
+            'params': {'on_disk_payload': False},
+            'quantization_config': 'Disabled',
+        })
+
+
+class UploadSessionTest(TestCase):
+    CONTENT = b'%PDF-1.4 ' + bytes(range(256)) * 4
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        settings_override = override_settings(APP_ENV='local', MEDIA_ROOT=temp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        process_patch = mock.patch('apps.documents.views.process_document')
+        self.process_document = process_patch.start()
+        self.addCleanup(process_patch.stop)
+        # Hashes of uploads in progress are kept per process: start from none.
+        self.addCleanup(storage._upload_hashers.clear)
+        storage._upload_hashers.clear()
+
+        self.client = APIClient()
+        self.collection = DocumentCollection.objects.create(name='uploads', slug='uploads')
+        response = self.client.post(
+            '/api/uploads/', {'name': 'document.pdf', 'collection': self.collection.id, 'size': len(self.CONTENT)}
+        )
+        self.assertEqual(response.status_code, 201)
+        self.upload_id = response.data['id']
+
+    def put(self, offset, data):
+        return self.client.put(
+            f'/api/uploads/{self.upload_id}/parts/', data, content_type='application/octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def complete(self):
+        return self.client.post(f'/api/uploads/{self.upload_id}/complete/')
+
+    def test_parts_are_appended_in_order(self):
+        self.assertEqual(self.put(0, self.CONTENT[:500]).data, {'offset': 500})
+        self.assertEqual(self.put(500, self.CONTENT[500:]).data, {'offset': len(self.CONTENT)})
+
+        response = self.complete()
+
+        self.assertEqual(response.status_code, 201)
+        document = UnstructuredDocument.objects.get(id=response.data['id'])
+        self.assertEqual(document.sha256, hashlib.sha256(self.CONTENT).hexdigest())
+        self.assertEqual(document.collection, self.collection)
+        upload = UploadSession.objects.get(id=self.upload_id)
+        with open(upload.path, 'rb') as fp:
+            self.assertEqual(fp.read(), self.CONTENT)
+        self.process_document.assert_called_once_with(document, upload.file_name)
+
+    def test_out_of_order_and_duplicate_parts_are_rejected(self):
+        self.put(0, self.CONTENT[:500])
+
+        ahead = self.put(800, self.CONTENT[800:])
+        duplicate = self.put(0, self.CONTENT[:500])
+
+        self.assertEqual((ahead.status_code, ahead.data['offset']), (409, 500))
+        self.assertEqual((duplicate.status_code, duplicate.data['offset']), (409, 500))
+        self.put(500, self.CONTENT[500:])
+        self.assertEqual(
+            UnstructuredDocument.objects.get(id=self.complete().data['id']).sha256,
+            hashlib.sha256(self.CONTENT).hexdigest(),
+        )
+
+    def test_resume_after_an_interrupted_part(self):
+        self.put(0, self.CONTENT[:500])
+        upload = UploadSession.objects.get(id=self.upload_id)
+        # A part interrupted midway, never acknowledged, handled by another process.
+        with open(upload.path, 'ab') as fp:
+            fp.write(b'garbage')
+        storage._upload_hashers.clear()
+
+        self.assertEqual(self.client.get(f'/api/uploads/{self.upload_id}/').data['offset'], 500)
+        self.put(500, self.CONTENT[500:])
+
+        self.assertEqual(
+            UnstructuredDocument.objects.get(id=self.complete().data['id']).sha256,
+            hashlib.sha256(self.CONTENT).hexdigest(),
+        )
+
+    def test_incomplete_or_oversized_uploads_are_rejected(self):
+        self.put(0, self.CONTENT[:500])
+
+        self.assertEqual(self.complete().status_code, 400)
+        self.assertEqual(self.put(500, self.CONTENT[500:] + b'extra').status_code, 400)
+        self.assertEqual(self.client.get(f'/api/uploads/{self.upload_id}/').data['offset'], 500)
+        self.assertFalse(UnstructuredDocument.objects.filter(upload_session__id=self.upload_id).exists())
+
+    def test_parts_are_written_where_the_workers_read_them(self):
+        with tempfile.TemporaryDirectory() as media_root_docker, \
+                override_settings(APP_ENV='production', MEDIA_ROOT_DOCKER=media_root_docker):
+            response = self.client.post('/api/uploads/', {'name': 'document.pdf', 'size': 3})
+            upload = UploadSession.objects.get(id=response.data['id'])
+
+            self.assertEqual(upload.path, storage.storage_path(upload.file_name))
+            self.assertTrue(os.path.exists(os.path.join(media_root_docker, upload.file_name)))
+
+
+class DeletionJobTest(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.media_root = os.path.join(temp_dir.name, 'media')
+        os.makedirs(self.media_root)
+        settings_override = override_settings(APP_ENV='local', MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.store = LocalVectorStore(os.path.join(temp_dir.name, 'vectorstore'))
+        store_patch = mock.patch('apps.documents.vectorstore.get_local_store', return_value=self.store)
+        store_patch.start()
+        self.addCleanup(store_patch.stop)
+
+        self.collection = DocumentCollection.objects.create(name='deleted', slug='deleted')
+        self.other_collection = DocumentCollection.objects.create(name='kept', slug='kept')
+        for collection in (self.collection, self.other_collection):
+            self.store.create_collection(collection.slug, 3)
+        self.cutoff = timezone.now() - timedelta(days=30)
+        old = self.cutoff - timedelta(days=1)
+        recent = self.cutoff + timedelta(days=1)
+        self.deleted = [
+            self.document('old-1.pdf', self.collection, old),
+            self.document('old-2.pdf', self.collection, old),
+            # Created before creation dates were recorded.
+            self.document('shared.pdf', self.collection, None),
+        ]
+        self.kept = [
+            self.document('recent.pdf', self.collection, recent),
+            self.document('other.pdf', self.other_collection, old),
+            # Identical to a deleted document, sharing its file.
+            self.document('shared.pdf', self.other_collection, recent),
+        ]
+
+    def document(self, file_name, collection, created_at):
+        with open(os.path.join(self.media_root, file_name), 'wb') as fp:
+            fp.write(b'%PDF')
+        document = UnstructuredDocument.objects.create(
+            name=file_name, file=f'{settings.UPLOAD_URL}{file_name}', collection=collection
+        )
+        UnstructuredDocument.objects.filter(id=document.id).update(created_at=created_at)
+        self.store.collection(collection.slug).add(
+            [point_id({'instance_id': document.id, 'chunk': 0})],
+            [file_name],
+            [[1, 0, 0]],
+            [{'instance_id': document.id, 'chunk': 0}],
+        )
+        return document
+
+    def stored_instance_ids(self, collection):
+        return sorted(self.store.collection(collection.slug).snapshot().instance_ids.tolist())
+
+    def test_deletes_the_documents_of_the_collection_created_before_the_date(self):
+        job = DeletionJob.start(collection=self.collection, created_before=self.cutoff)
+        self.assertEqual((job.total, job.done, job.finished_at), (3, 0, None))
+
+        with mock.patch.object(
+            vectorstore, 'delete_points_by_instances', wraps=vectorstore.delete_points_by_instances
+        ) as delete_points_by_instances:
+            DeletionJob.run(job.id, batch_size=2)
+
+        job.refresh_from_db()
+        self.assertEqual((job.total, job.done, job.pending), (3, 3, 0))
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(
+            sorted(UnstructuredDocument.objects.values_list('id', flat=True)),
+            sorted(document.id for document in self.kept),
+        )
+        # One filter deletion per batch and Qdrant collection.
+        self.assertEqual(
+            sorted(id for call in delete_points_by_instances.call_args_list for id in call.args[1]),
+            sorted(document.id for document in self.deleted),
+        )
+        self.assertEqual(len(delete_points_by_instances.call_args_list), 2)
+        self.assertEqual(self.stored_instance_ids(self.collection), [self.kept[0].id])
+        self.assertEqual(self.stored_instance_ids(self.other_collection), sorted([self.kept[1].id, self.kept[2].id]))
+        self.assertEqual(sorted(os.listdir(self.media_root)), ['other.pdf', 'recent.pdf', 'shared.pdf'])
+
+    def test_documents_of_a_running_job_are_left_to_it(self):
+        running = DeletionJob.start(document_ids=[self.deleted[0].id])
+
+        job = DeletionJob.start(collection=self.collection, created_before=self.cutoff)
+
+        self.assertEqual((running.total, job.total), (1, 2))
+
+    def test_nothing_to_delete(self):
+        job = DeletionJob.start(collection=self.other_collection, created_before=self.cutoff - timedelta(days=365))
+
+        self.assertEqual(job.total, 0)
+        self.assertIsNotNone(job.finished_at)
+
+
+@override_settings(MARTINI_STATUS_LONG_POLL_INTERVAL=0.05, MARTINI_STATUS_LONG_POLL_MAX_INTERVAL=0.2)
+class AwaitStatusesTest(TestCase):
+    def setUp(self):
+        collection = DocumentCollection.objects.create(name='statuses', slug='statuses')
+        self.document = UnstructuredDocument.objects.create(
+            name='document.pdf', file='document.pdf', collection=collection, status='parsing'
+        )
+        self.version = status.get_statuses([self.document.id], None)['version']
+
+    async def await_statuses(self, version, timeout):
+        with mock.patch.object(status, 'aget_statuses', wraps=status.aget_statuses) as aget_statuses:
+            started_at = time.monotonic()
+            statuses = await status.await_statuses([self.document.id], None, version, timeout)
+        return statuses, time.monotonic() - started_at, aget_statuses.call_count
+
+    async def test_returns_right_away_without_version(self):
+        statuses, elapsed, reads = await self.await_statuses(None, 5)
+
+        self.assertEqual(statuses['version'], self.version)
+        self.assertEqual(reads, 1)
+        self.assertLess(elapsed, 1)
+
+    async def test_returns_at_the_timeout_without_change(self):
+        statuses, elapsed, reads = await self.await_statuses(self.version, 0.6)
+
+        self.assertEqual(statuses['version'], self.version)
+        self.assertGreaterEqual(elapsed, 0.6)
+        self.assertLess(elapsed, 1.5)
+        # Reads at 0, 0.05, 0.15, 0.35 and 0.55s, then at the timeout: backing off, instead of 13 reads.
+        self.assertEqual(reads, 6)
+
+    async def test_returns_once_statuses_change(self):
+        async def change():
+            await asyncio.sleep(0.2)
+            await UnstructuredDocument.objects.filter(id=self.document.id).aupdate(status='embedding')
+
+        (statuses, elapsed, _), _ = await asyncio.gather(self.await_statuses(self.version, 5), change())
+
+        self.assertNotEqual(statuses['version'], self.version)
+        self.assertEqual(statuses['documents'][0]['status'], 'embedding')
+        self.assertLess(elapsed, 1)
+
+    def test_view_is_exempt_from_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+
+        response = client.post(
+            '/api/documents/status/wait/',
+            {'document_ids': [self.document.id], 'version': self.version, 'timeout': 0},
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], self.version)
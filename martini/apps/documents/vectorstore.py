@@ -1,62 +1,584 @@
 import os
+import uuid
+import asyncio
 import logging
+import weakref
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import httpx
+
+from django.conf import settings
 
 from qdrant_client import QdrantClient
-from qdrant_client.http import models
+from qdrant_client.http import AsyncApis, models
 
-from langchain.embeddings import OpenAIEmbeddings
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
 from langchain.vectorstores.qdrant import Qdrant
 
-qd_client = QdrantClient(url=os.environ.get('QDRANT_URL'), prefer_grpc=False)
+from apps.documents.local_vectorstore import LocalVectorStore, LocalVectorStoreForChains
+
+# Client of the current process, see `get_client`.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# Local vector store of the current process, see `get_local_store`.
+_local_store = None
+_local_store_pid = None
+
+# Async REST clients, bound to the event loop they were created in.
+_async_clients = weakref.WeakKeyDictionary()
 
 logger = logging.getLogger(__name__)
 
-def create_vectorstore_collection(collection_name: str):
+# Payload fields indexed in every collection, so that filtering on them (e.g. deleting the embeddings
+# of a document, or restricting a search to some documents) does not scan the whole collection.
+PAYLOAD_INDEXES = {
+    'metadata.instance_id': models.PayloadSchemaType.INTEGER,
+    'metadata.page': models.PayloadSchemaType.INTEGER,
+}
+
+# Namespace of the IDs of the points of chunks, see `point_id`.
+POINT_ID_NAMESPACE = uuid.UUID('4ba24eee-3fd8-406f-977b-247fd51e7e13')
+
+@dataclass(frozen=True)
+class IndexProfile:
+    '''
+    Settings of the vector index of a Qdrant collection, trading memory and accuracy for search latency.
+    Settings left to None fall back to the defaults of Qdrant.
+    - hnsw_m, hnsw_ef_construct: number of edges per node and neighbours considered when building
+      the HNSW graph. Higher values give a more accurate index, larger and slower to build.
+    - search_hnsw_ef: neighbours considered when searching. Higher values give more accurate, slower searches.
+    - scalar_quantization: also store vectors quantized to int8, 4 times smaller, kept in RAM and searched first.
+    - quantization_rescore, quantization_oversampling: rescore the candidates found with the quantized vectors
+      with the original vectors, fetching `oversampling` times more candidates than requested.
+    - on_disk_vectors, on_disk_payload: store the original vectors and payloads on disk rather than in RAM.
+    '''
+    hnsw_m: Optional[int] = None
+    hnsw_ef_construct: Optional[int] = None
+    search_hnsw_ef: Optional[int] = None
+    scalar_quantization: bool = False
+    quantization_rescore: bool = True
+    quantization_oversampling: Optional[float] = None
+    on_disk_vectors: bool = False
+    on_disk_payload: bool = False
+
+    def hnsw_config(self) -> Optional[models.HnswConfigDiff]:
+        if self.hnsw_m is None and self.hnsw_ef_construct is None:
+            return None
+        return models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct)
+
+    def quantization_config(self) -> Optional[models.ScalarQuantization]:
+        if not self.scalar_quantization:
+            return None
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True,
+            )
+        )
+
+    def search_params(self) -> Optional[models.SearchParams]:
+        quantization = None
+        if self.scalar_quantization:
+            quantization = models.QuantizationSearchParams(
+                rescore=self.quantization_rescore,
+                oversampling=self.quantization_oversampling,
+            )
+        if self.search_hnsw_ef is None and quantization is None:
+            return None
+        return models.SearchParams(hnsw_ef=self.search_hnsw_ef, quantization=quantization)
+
+def _connection_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.MARTINI_QDRANT_POOL_SIZE,
+        max_keepalive_connections=settings.MARTINI_QDRANT_POOL_SIZE,
+    )
+
+def create_client() -> QdrantClient:
     '''
-    Create a Qdrant collection with the given name, and the default vector parameters.
+    Create a Qdrant client, over gRPC or REST depending on MARTINI_QDRANT_PREFER_GRPC.
+    Connections are kept alive and reused between requests, up to MARTINI_QDRANT_POOL_SIZE.
     '''
-    qd_client.recreate_collection(
+    return QdrantClient(
+        url=os.environ.get('QDRANT_URL'),
+        prefer_grpc=settings.MARTINI_QDRANT_PREFER_GRPC,
+        grpc_port=settings.MARTINI_QDRANT_GRPC_PORT,
+        timeout=settings.MARTINI_QDRANT_TIMEOUT,
+        limits=_connection_limits(),
+    )
+
+def get_client() -> QdrantClient:
+    '''
+    Return the Qdrant client of the current process, shared by its threads.
+    It is created on first use in each process: connections (gRPC channels especially)
+    must not be inherited by the processes forked by Celery or gunicorn.
+    '''
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = create_client()
+                _client_pid = pid
+    return _client
+
+def get_local_store() -> Optional[LocalVectorStore]:
+    '''
+    Return the local vector store of the current process if MARTINI_VECTORSTORE_BACKEND is "local",
+    None if vectors are stored in Qdrant. The functions of this module use either transparently.
+    '''
+    global _local_store, _local_store_pid
+    if settings.MARTINI_VECTORSTORE_BACKEND != 'local':
+        return None
+    pid = os.getpid()
+    if _local_store is None or _local_store_pid != pid:
+        with _client_lock:
+            if _local_store is None or _local_store_pid != pid:
+                _local_store = LocalVectorStore(settings.MARTINI_LOCAL_VECTORSTORE_PATH)
+                _local_store_pid = pid
+    return _local_store
+
+def get_async_client() -> AsyncApis:
+    '''
+    Return an asynchronous Qdrant (REST) client for the running event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncApis(
+            host=os.environ.get('QDRANT_URL'),
+            timeout=settings.MARTINI_QDRANT_TIMEOUT,
+            limits=_connection_limits(),
+        )
+    return client
+
+def create_vectorstore_collection(
+    collection_name: str,
+    profile: Optional[IndexProfile] = None,
+    dimension: Optional[int] = None,
+):
+    '''
+    Create a Qdrant collection with the given name, for vectors of `dimension` (those of OpenAI's embeddings
+    if not specified) and with the vector index settings of `profile` (the defaults of Qdrant if not specified).
+    '''
+    dimension = int(dimension or os.environ.get('EMBEDDINGS_DIMENSION_OPENAI') or 1536)
+    local_store = get_local_store()
+    if local_store is not None:
+        # The local store searches exhaustively: there is no index to configure.
+        local_store.create_collection(collection_name, dimension)
+        return
+
+    profile = profile or IndexProfile()
+    get_client().recreate_collection(
         collection_name=collection_name,
         vectors_config=models.VectorParams(
-            size=os.environ.get('EMBEDDINGS_DIMENSION_OPENAI'),
-            distance=models.Distance.COSINE
+            size=dimension,
+            distance=models.Distance.COSINE,
+            on_disk=profile.on_disk_vectors or None,
         ),
+        hnsw_config=profile.hnsw_config(),
+        quantization_config=profile.quantization_config(),
+        on_disk_payload=profile.on_disk_payload or None,
     )
+    create_payload_indexes(collection_name)
+
+def update_vectorstore_collection(collection_name: str, profile: IndexProfile):
+    '''
+    Apply the vector index settings of `profile` to an existing Qdrant collection.
+    Qdrant rebuilds the index and moves the vectors in the background, the collection remains searchable.
+    Search-time settings are not stored in the collection, they are passed along each search.
+    '''
+    if get_local_store() is not None:
+        return
+    # The models of the client predate the update of these settings (Qdrant >= 1.5, as pinned in the compose files):
+    # send the request as is.
+    hnsw_config = profile.hnsw_config()
+    quantization_config = profile.quantization_config()
+    body = {
+        'vectors': {
+            '': {'on_disk': profile.on_disk_vectors},
+        },
+        'params': {
+            'on_disk_payload': profile.on_disk_payload,
+        },
+        'quantization_config': quantization_config.dict(exclude_none=True) if quantization_config else 'Disabled',
+    }
+    if hnsw_config is not None:
+        body['hnsw_config'] = hnsw_config.dict(exclude_none=True)
+    get_client().http.collections_api.api_client.request(
+        type_=models.InlineResponse2003,
+        method='PATCH',
+        url='/collections/{collection_name}',
+        path_params={'collection_name': collection_name},
+        json=body,
+    )
+
+
+def create_payload_indexes(collection_name: str):
+    '''
+    Create the payload indexes of `PAYLOAD_INDEXES` in a Qdrant collection.
+    Creating an index that already exists is a no-op, so this can be run on existing collections.
+    '''
+    if get_local_store() is not None:
+        return
+    for field_name, field_schema in PAYLOAD_INDEXES.items():
+        get_client().create_payload_index(
+            collection_name=collection_name,
+            field_name=field_name,
+            field_schema=field_schema,
+            wait=True,
+        )
 
 def delete_vectorstore_collection(collection_name: str):
     '''
     Delete a Qdrant collection with the given name.
     '''
-    qd_client.delete_collection(collection_name=collection_name)
+    local_store = get_local_store()
+    if local_store is not None:
+        local_store.delete_collection(collection_name)
+        return
+    get_client().delete_collection(collection_name=collection_name)
 
-def get_vectorstore_for_chains(embeddings: OpenAIEmbeddings, collection_name: str) -> Qdrant:
+def get_vectorstore_for_chains(embeddings: Embeddings, collection_name: str) -> VectorStore:
     '''
     Create and return a Langchain-wrapped Qdrant client (vector database),
     optimized for usage in Langchain's chains.
     '''
+    local_store = get_local_store()
+    if local_store is not None:
+        return LocalVectorStoreForChains(local_store.collection(collection_name), embeddings)
     return Qdrant(
-        client=qd_client,
+        client=get_client(),
         collection_name=collection_name,
         embeddings=embeddings,
     )
 
+def search_by_vector(
+    collection_name: str,
+    vector: List[float],
+    k: int = 4,
+    document_ids: Optional[Iterable[int]] = None,
+    search_params: Optional[models.SearchParams] = None,
+) -> List[Tuple[Document, float]]:
+    '''
+    Search the `k` points closest to an already computed embedding in a Qdrant collection,
+    among the points of the UnstructuredDocument instances of `document_ids` if specified.
+    `search_params` are usually the ones of the IndexProfile of the collection.
+    Returns the matching chunks as Langchain Documents, along with their similarity score.
+    '''
+    return [result[:2] for result in _search(collection_name, vector, k, document_ids, search_params, False)]
+
+def search_with_vectors(
+    collection_name: str,
+    vector: List[float],
+    k: int = 4,
+    document_ids: Optional[Iterable[int]] = None,
+    search_params: Optional[models.SearchParams] = None,
+) -> List[Tuple[Document, float, List[float]]]:
+    '''
+    Same as `search_by_vector`, also returning the vectors of the matching chunks, e.g. to re-rank them.
+    '''
+    return _search(collection_name, vector, k, document_ids, search_params, True)
+
+async def asearch_by_vector(
+    collection_name: str,
+    vector: List[float],
+    k: int = 4,
+    document_ids: Optional[Iterable[int]] = None,
+    search_params: Optional[models.SearchParams] = None,
+) -> List[Tuple[Document, float]]:
+    '''
+    Asynchronous counterpart of `search_by_vector`.
+    '''
+    results = await _asearch(collection_name, vector, k, document_ids, search_params, False)
+    return [result[:2] for result in results]
+
+async def asearch_with_vectors(
+    collection_name: str,
+    vector: List[float],
+    k: int = 4,
+    document_ids: Optional[Iterable[int]] = None,
+    search_params: Optional[models.SearchParams] = None,
+) -> List[Tuple[Document, float, List[float]]]:
+    '''
+    Asynchronous counterpart of `search_with_vectors`.
+    '''
+    return await _asearch(collection_name, vector, k, document_ids, search_params, True)
+
+def _search(
+    collection_name: str,
+    vector: List[float],
+    k: int,
+    document_ids: Optional[Iterable[int]],
+    search_params: Optional[models.SearchParams],
+    with_vectors: bool,
+) -> List[Tuple[Document, float, Optional[List[float]]]]:
+    local_store = get_local_store()
+    if local_store is not None:
+        return local_store.collection(collection_name).search(vector, k, document_ids, with_vectors)
+    points = _search_points(collection_name, vector, k, document_ids, search_params, with_vectors)
+    return [(*_document_from_scored_point(point), point.vector) for point in points]
+
+async def _asearch(
+    collection_name: str,
+    vector: List[float],
+    k: int,
+    document_ids: Optional[Iterable[int]],
+    search_params: Optional[models.SearchParams],
+    with_vectors: bool,
+) -> List[Tuple[Document, float, Optional[List[float]]]]:
+    local_store = get_local_store()
+    if local_store is not None:
+        # Searching the local store is CPU-bound: run it in a thread, not to block the event loop.
+        return await asyncio.to_thread(
+            local_store.collection(collection_name).search, vector, k, document_ids, with_vectors
+        )
+    points = await _asearch_points(collection_name, vector, k, document_ids, search_params, with_vectors)
+    return [(*_document_from_scored_point(point), point.vector) for point in points]
+
+def _search_points(
+    collection_name: str,
+    vector: List[float],
+    k: int,
+    document_ids: Optional[Iterable[int]],
+    search_params: Optional[models.SearchParams],
+    with_vectors: bool,
+) -> List[models.ScoredPoint]:
+    return get_client().search(
+        collection_name=collection_name,
+        query_vector=vector,
+        query_filter=instances_filter(document_ids) if document_ids is not None else None,
+        search_params=search_params,
+        limit=k,
+        with_payload=True,
+        with_vectors=with_vectors,
+    )
+
+async def _asearch_points(
+    collection_name: str,
+    vector: List[float],
+    k: int,
+    document_ids: Optional[Iterable[int]],
+    search_params: Optional[models.SearchParams],
+    with_vectors: bool,
+) -> List[models.ScoredPoint]:
+    response = await get_async_client().points_api.search_points(
+        collection_name=collection_name,
+        search_request=models.SearchRequest(
+            vector=vector,
+            filter=instances_filter(document_ids) if document_ids is not None else None,
+            params=search_params,
+            limit=k,
+            with_payload=True,
+            with_vector=with_vectors,
+        ),
+    )
+    return response.result
+
+def _document_from_scored_point(point: models.ScoredPoint) -> Tuple[Document, float]:
+    return (
+        Document(
+            page_content=point.payload[Qdrant.CONTENT_KEY],
+            metadata=point.payload.get(Qdrant.METADATA_KEY) or {},
+        ),
+        point.score,
+    )
+
+def point_id(metadata: dict) -> str:
+    '''
+    ID of the point of a chunk: derived from the UnstructuredDocument instance and the index of the chunk
+    in the document if its metadata has them, so that storing a chunk again (e.g. when a task is retried)
+    replaces its point instead of adding another one. Random otherwise.
+    '''
+    if metadata.get('instance_id') is None or metadata.get('chunk') is None:
+        return uuid.uuid4().hex
+    return uuid.uuid5(POINT_ID_NAMESPACE, f'{metadata["instance_id"]}:{metadata["chunk"]}').hex
+
+def upsert_embeddings(
+    collection_name: str,
+    texts: List[str],
+    vectors: List[List[float]],
+    metadatas: List[dict],
+    batch_size: int = None,
+    parallel: int = None,
+) -> List[str]:
+    '''
+    Store already computed embeddings in a Qdrant collection.
+    Points are sent by batches of `batch_size`, `parallel` requests at a time
+    (MARTINI_QDRANT_UPSERT_BATCH_SIZE and MARTINI_QDRANT_UPSERT_PARALLEL by default).
+    Points are laid out the way Langchain's Qdrant wrapper expects them, so they can be
+    retrieved through `get_vectorstore_for_chains`. Their IDs are derived from their metadata (see `point_id`):
+    storing the chunks of a document again is idempotent.
+    '''
+    batch_size = batch_size or settings.MARTINI_QDRANT_UPSERT_BATCH_SIZE
+    parallel = parallel or settings.MARTINI_QDRANT_UPSERT_PARALLEL
+
+    ids = [point_id(metadata) for metadata in metadatas]
+    local_store = get_local_store()
+    if local_store is not None:
+        local_store.collection(collection_name).add(ids, texts, vectors, metadatas)
+        return ids
+
+    batches = [
+        (ids[start:start + batch_size], texts[start:start + batch_size],
+         vectors[start:start + batch_size], metadatas[start:start + batch_size])
+        for start in range(0, len(ids), batch_size)
+    ]
+    if len(batches) <= 1 or parallel <= 1:
+        for batch in batches:
+            _upsert_batch(collection_name, *batch)
+    else:
+        with ThreadPoolExecutor(max_workers=min(parallel, len(batches))) as executor:
+            # Consume the results to re-raise the exception of a failed batch, if any.
+            list(executor.map(lambda batch: _upsert_batch(collection_name, *batch), batches))
+    return ids
+
+def _upsert_batch(
+    collection_name: str,
+    ids: List[str],
+    texts: List[str],
+    vectors: List[List[float]],
+    metadatas: List[dict],
+):
+    get_client().upsert(
+        collection_name=collection_name,
+        points=models.Batch.construct(
+            ids=ids,
+            vectors=vectors,
+            payloads=[
+                {
+                    Qdrant.CONTENT_KEY: text,
+                    Qdrant.METADATA_KEY: metadata,
+                }
+                for text, metadata in zip(texts, metadatas)
+            ],
+        ),
+    )
+
+def instance_filter(instance_id: int) -> models.Filter:
+    '''
+    Filter matching the points (i.e. embeddings) of an UnstructuredDocument instance.
+    '''
+    return models.Filter(
+        must=[
+            models.FieldCondition(
+                key='metadata.instance_id',
+                match=models.MatchValue(
+                    value=instance_id
+                )
+            )
+        ]
+    )
+
+def instances_filter(instance_ids: Iterable[int]) -> models.Filter:
+    '''
+    Filter matching the points (i.e. embeddings) of several UnstructuredDocument instances.
+    '''
+    return models.Filter(
+        must=[
+            models.FieldCondition(
+                key='metadata.instance_id',
+                match=models.MatchAny(
+                    any=list(instance_ids)
+                )
+            )
+        ]
+    )
+
 def delete_points_by_metadata(collection_name: str, doc_name: str, instance_id: int):
     '''
     Delete points (i.e. embeddings) from a Qdrant collection, targeted by metadata "name" and "instance_id".
     '''
     logger.info(f'Deleting embeddings for document "{doc_name}" from collection "{collection_name}"')
-    qd_client.delete(
+    local_store = get_local_store()
+    if local_store is not None:
+        local_store.collection(collection_name).delete([instance_id])
+        return
+    get_client().delete(
         collection_name=collection_name,
         points_selector=models.FilterSelector(
-            filter=models.Filter(
-                must=[
-                    models.FieldCondition(
-                        key='metadata.instance_id',
-                        match=models.MatchValue(
-                            value=instance_id
-                        )
-                    )
-                ]
-            )
+            filter=instance_filter(instance_id)
         ),
     )
+
+def delete_points_by_instances(collection_name: str, instance_ids: List[int]):
+    '''
+    Delete the points (i.e. embeddings) of several UnstructuredDocument instances from a Qdrant collection,
+    with a single filter deletion.
+    '''
+    logger.info(f'Deleting embeddings for {len(instance_ids)} documents from collection "{collection_name}"')
+    local_store = get_local_store()
+    if local_store is not None:
+        local_store.collection(collection_name).delete(instance_ids)
+        return
+    get_client().delete(
+        collection_name=collection_name,
+        points_selector=models.FilterSelector(
+            filter=instances_filter(instance_ids)
+        ),
+    )
+
+def copy_points_by_metadata(
+    source_collection_name: str,
+    source_instance_id: int,
+    collection_name: str,
+    instance_id: int,
+    batch_size: int = None,
+) -> int:
+    '''
+    Copy the points (i.e. embeddings) of a document to another document, possibly in another collection,
+    without computing the embeddings again. The copies are marked with the "instance_id" of the target document.
+    Points are read `batch_size` at a time (by default, as many as `upsert_embeddings` sends in parallel).
+    Returns the number of points copied.
+    '''
+    batch_size = batch_size or settings.MARTINI_QDRANT_UPSERT_BATCH_SIZE * settings.MARTINI_QDRANT_UPSERT_PARALLEL
+    copied = 0
+    for texts, vectors, metadatas in _scroll_points(source_collection_name, source_instance_id, batch_size):
+        upsert_embeddings(
+            collection_name,
+            texts,
+            vectors,
+            [{**metadata, 'instance_id': instance_id} for metadata in metadatas],
+        )
+        copied += len(texts)
+    return copied
+
+def _scroll_points(
+    collection_name: str,
+    instance_id: int,
+    batch_size: int,
+) -> Iterator[Tuple[List[str], List[List[float]], List[dict]]]:
+    '''
+    Iterate over the texts, vectors and metadata of the points of a document, `batch_size` at a time.
+    '''
+    local_store = get_local_store()
+    if local_store is not None:
+        yield from local_store.collection(collection_name).records([instance_id], batch_size)
+        return
+
+    offset = None
+    while True:
+        records, offset = get_client().scroll(
+            collection_name=collection_name,
+            scroll_filter=instance_filter(instance_id),
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        if records:
+            yield (
+                [record.payload[Qdrant.CONTENT_KEY] for record in records],
+                [record.vector for record in records],
+                [record.payload.get(Qdrant.METADATA_KEY) or {} for record in records],
+            )
+        if offset is None:
+            return
@@ -1,30 +1,168 @@
 import os
-import time
-import uuid
+import json
+import logging
 
 from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
 from django.utils.text import slugify
+from django.views import View
 
-from rest_framework import viewsets, status
+from rest_framework import mixins, viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
 
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from celery import group
 
-from celery.result import AsyncResult
-
-from .models import UnstructuredDocument, DocumentCollection
-from .tasks import delete_embeddings, save_embeddings
+from .models import UnstructuredDocument, DocumentCollection, DeletionJob, ImportJob, ReembeddingJob, UploadSession
+from .tasks import (
+    copy_embeddings,
+    delete_documents,
+    delete_embeddings,
+    dispatch_ingestion,
+    import_document,
+    reembed_collection,
+)
+from .storage import (
+    file_digest,
+    remember_upload_hasher,
+    storage_path,
+    store_import_files,
+    unique_upload_name,
+    upload_hasher,
+    upload_lock,
+    write_part,
+)
 from .serializers import (
     UnstructuredDocumentSerializer,
-    DocumentCollectionSerializer
+    DocumentCollectionSerializer,
+    DeletionJobSerializer,
+    ImportJobSerializer,
+    ReembeddingJobSerializer,
+    UploadSessionSerializer,
+)
+from .status import (
+    STATUS_FIELDS,
+    await_statuses,
+    get_statuses,
+    parse_long_poll_params,
+    parse_status_params,
+    status_details,
 )
 from .vectorstore import (
     create_vectorstore_collection,
-    delete_vectorstore_collection
+    delete_vectorstore_collection,
+    update_vectorstore_collection,
 )
 
+logger = logging.getLogger(__name__)
+
+
+def process_document(udoc: UnstructuredDocument, file_name: str):
+    '''
+    Process a saved UnstructuredDocument, whose file is stored under `file_name` in the media directory:
+    extract embeddings from the document and store them in Qdrant.
+    If an identical file was already processed, its stored file and embeddings are reused instead.
+    '''
+    # Look for an identical document, already processed, using the digest of the file.
+    duplicate = udoc.find_processed_duplicate()
+
+    if duplicate:
+        # Reuse the stored file, and copy the embeddings of the identical document
+        # instead of parsing and embedding the file again.
+        os.remove(os.path.join(settings.MEDIA_ROOT, file_name))
+        udoc.file.name = duplicate.file.name
+        udoc.save(update_fields=['file'])
+        _dispatch(
+            udoc,
+            UnstructuredDocument.copy_embeddings,
+            copy_embeddings.delay,
+            duplicate.collection.slug,
+            duplicate.id,
+            udoc.collection.slug,
+            udoc.name,
+            udoc.id
+        )
+    else:
+        _dispatch(
+            udoc,
+            UnstructuredDocument.save_embeddings,
+            dispatch_ingestion,
+            storage_path(file_name),
+            udoc.collection.slug,
+            udoc.name,
+            udoc.id
+        )
+
+
+def _dispatch(udoc: UnstructuredDocument, method, send, *args):
+    '''
+    Run a processing step of an UnstructuredDocument.
+    In local development, this is done directly and synchronously with the class method.
+    In production, this is done asynchronously via Celery, sending the task(s) with `send`.
+    '''
+    if settings.APP_ENV == 'local':
+        try:
+            method(*args)
+        except Exception as e:
+            UnstructuredDocument.mark_failed(udoc.id, str(e))
+            raise
+    else:
+        result = send(*args)
+        # Set the task ID on the model instance for retrieval
+        # via the /api/documents/{task_id}/status endpoint.
+        udoc.task_id = result.id
+        udoc.save(update_fields=['task_id'])
+
+
+def _dispatch_import(job: ImportJob, documents: list):
+    '''
+    Process the documents of a bulk import, given as (UnstructuredDocument, stored file name) pairs.
+    In local development, this is done directly and synchronously with the class method.
+    In production, the documents are processed in parallel by the Celery workers, as a group of tasks,
+    one per document, sending those not identical to a processed document to the stages of `dispatch_ingestion`.
+    The import is marked finished once all its documents were counted as done or failed.
+    '''
+    if settings.APP_ENV == 'local':
+        for udoc, file_name in documents:
+            try:
+                UnstructuredDocument.import_document(udoc.id, file_name)
+            except Exception as e:
+                logger.error(f'Import of document {udoc.id} failed. Error: {e}')
+                UnstructuredDocument.mark_failed(udoc.id, str(e))
+                ImportJob.record_result(job.id, succeeded=False)
+            else:
+                ImportJob.record_result(job.id, succeeded=True)
+        return
+
+    # Task IDs are assigned before sending the tasks, not to overwrite those cleared by finished tasks.
+    # The task ID of each document can be retrieved via the /api/documents/{task_id}/status endpoint.
+    tasks = group([import_document.s(job.id, udoc.id, file_name) for udoc, file_name in documents])
+    for (udoc, _), task in zip(documents, tasks.tasks):
+        udoc.task_id = task.freeze().id
+    UnstructuredDocument.objects.bulk_update([udoc for udoc, _ in documents], ['task_id'])
+    job.task_id = tasks.freeze().id
+    job.save(update_fields=['task_id'])
+    tasks.apply_async()
+
+
+def _dispatch_deletion(job: DeletionJob):
+    '''
+    Delete the documents of a bulk deletion.
+    In local development, this is done directly and synchronously with the class method.
+    In production, this is done asynchronously via the Celery task.
+    '''
+    if settings.APP_ENV == 'local':
+        try:
+            DeletionJob.run(job.id)
+        except Exception as e:
+            DeletionJob.fail(job.id, str(e))
+            raise
+    else:
+        result = delete_documents.delay(job.id)
+        job.task_id = result.id
+        job.save(update_fields=['task_id'])
+
 
 class UnstructuredDocumentViewSet(viewsets.ModelViewSet):
     queryset = UnstructuredDocument.objects.all()
@@ -35,61 +173,31 @@ class UnstructuredDocumentViewSet(viewsets.ModelViewSet):
         When saving the model, saves the uploaded file to the media directory with a unique name.
         Submits a task to process the UnstructuredDocument if APP_ENV is not local,
         i.e. extract embeddings from the document and store them in Qdrant.
+        If an identical file was already processed, its stored file and embeddings are reused instead.
         '''
-        udoc = serializer.save()
-
-        # Read the uploaded file binary data.
-        file_data = udoc.file.read()
-
-        # Save the binary file data to a new file.
-        timestamp = int(time.time())
-        unique_id = uuid.uuid4()
-        new_file_name = f'{timestamp}_{unique_id}.pdf'
-        file_path = default_storage.save(new_file_name, ContentFile(file_data))
-
-        # Construct the full file path with the new name.
-        media_root = settings.MEDIA_ROOT if settings.APP_ENV == 'local' else settings.MEDIA_ROOT_DOCKER
-        storage_file_path = f'{media_root}/{file_path}'
-
+        # Give the upload its unique name before saving the model, so that the storage
+        # writes it to its final location directly, chunk by chunk.
+        serializer.validated_data['file'].name = unique_upload_name()
         # If not specified, assign the document to the default collection.
-        if not udoc.collection:
-            default_collection = DocumentCollection.objects.get(
-                slug=settings.MARTINI_DEFAULT_COLLECTION_NAME
-            )
-            udoc.collection = default_collection
-
-        # Process the UnstructuredDocument.
-        # In local development, this is done directly and synchronously.
-        # In production, this is done asynchronously via a Celery task.
-        if settings.APP_ENV == 'local':
-            UnstructuredDocument.save_embeddings(
-                storage_file_path,
-                udoc.collection.slug,
-                udoc.name,
-                udoc.id
-            )
-        else:
-            task = save_embeddings.delay(
-                storage_file_path,
-                udoc.collection.slug,
-                udoc.name,
-                udoc.id
-            )
-            # Set the task ID on the model instance for retrieval
-            # via the /api/documents/{task_id}/status endpoint.
-            udoc.task_id = task.id
+        udoc = serializer.save(
+            collection=serializer.validated_data.get('collection') or DocumentCollection.get_default()
+        )
+        file_path = udoc.file.name
 
-        # Delete the initially uploaded file and save the model.
-        os.remove(os.path.join(settings.MEDIA_ROOT, udoc.file.name))
+        udoc.sha256 = file_digest(udoc.file)
         udoc.file.name = settings.UPLOAD_URL + file_path
         udoc.save()
 
+        process_document(udoc, file_path)
+
     def perform_destroy(self, instance):
         '''
         Overrides the default destroy method of the ModelSerializer.
         Deletes the associated file from the media directory, and the associated embeddings.
         '''
-        instance.file.delete(False)
+        # Identical documents share the same stored file: only delete it along with its last document.
+        if not UnstructuredDocument.objects.filter(file=instance.file.name).exclude(id=instance.id).exists():
+            instance.file.delete(False)
 
         if settings.APP_ENV == 'local':
             UnstructuredDocument.delete_embeddings(
@@ -118,42 +226,38 @@ class UnstructuredDocumentViewSet(viewsets.ModelViewSet):
 
         return super().update(request, *args, **kwargs)
 
+    @action(detail=False, methods=['get', 'post'], url_path='status')
+    def get_statuses(self, request):
+        '''
+        Generate a /api/documents/status endpoint to query the progress of the processing of many Documents
+        in a single request and a single query: those of a list of `document_ids`, or those of a `collection_id`.
+        Parameters are read from the query string (with comma-separated `document_ids`) or from a JSON body.
+        The `version` of the response changes with any status: see /api/documents/status/wait to wait for it.
+        '''
+        data = request.data if request.method == 'POST' else request.query_params
+        try:
+            document_ids, collection_id = parse_status_params(data)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_statuses(document_ids, collection_id), status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['get'], url_path='status')
     def get_task_status(self, request, pk=None):
         '''
-        Generate a /api/documents/{id}/status endpoint to query the status of a Document's current processing task.
+        Generate a /api/documents/{id}/status endpoint to query the progress of the processing of a Document.
         Because upload is synchronous but processing embeddings is not, this endpoint is necessary to check the status
-        of the processing task from a frontend client.
+        of the processing from a frontend client. Progress is recorded in the row of the Document by the processing
+        itself, so polling it costs a single read by primary key (and nothing to the Celery result backend).
         '''
-        instance = self.get_object()
-        task_id = instance.task_id
-
-        if not task_id:
-            return Response(
-                {'status': 'No task or task ID found'},
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        task = AsyncResult(task_id)
-        if not task:
+        progress = UnstructuredDocument.objects.filter(pk=pk).values(*STATUS_FIELDS).first()
+        if progress is None:
             return Response(
-                {'status': 'No task or task ID found'},
+                {'detail': 'Not found.'},
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        if task.status == 'PENDING':
-            # Job has not started yet
-            response = {
-                'status': task.status,
-                'details': 'Task has not started yet'
-            }
-        else:
-            response = {
-                'status': task.status,
-                'details': task.info.get('details', '')
-            }
-
-        return Response(response, status=status.HTTP_200_OK)
+        progress['details'] = status_details(progress)
+        return Response(progress, status=status.HTTP_200_OK)
 
 
 class DocumentCollectionViewSet(viewsets.ModelViewSet):
@@ -164,20 +268,340 @@ class DocumentCollectionViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         '''
         Create slug and save it as part of the instance.
-        Create a Qdrant collection for the DocumentCollection.
+        Create a Qdrant collection for the DocumentCollection, with its index profile
+        and the dimension of the vectors of its embedding model.
         '''
+        from apps.chats.llm import get_embeddings_model
+
         name = serializer.validated_data['name']
         slug = slugify(name)
-        try:
-            create_vectorstore_collection(slug)
-            serializer.save(slug=slug)
-        except Exception as e:
-            raise e
+        with transaction.atomic():
+            instance = serializer.save(slug=slug)
+            dimension = get_embeddings_model(instance.embedding_backend).dimension
+            create_vectorstore_collection(slug, instance.index_profile, dimension)
+
+    def perform_update(self, serializer):
+        '''
+        Apply changes of the index profile to the Qdrant collection,
+        and to the one being built by a re-embedding in progress, if any.
+        '''
+        previous_profile = serializer.instance.index_profile
+        with transaction.atomic():
+            instance = serializer.save()
+            if instance.index_profile != previous_profile:
+                for vectorstore_name in DocumentCollection.get_vectorstore_collection_names(instance.slug):
+                    update_vectorstore_collection(vectorstore_name, instance.index_profile)
 
     def perform_destroy(self, instance):
         try:
-            delete_vectorstore_collection(instance.slug)
+            for vectorstore_name in DocumentCollection.get_vectorstore_collection_names(instance.slug):
+                delete_vectorstore_collection(vectorstore_name)
             return super().perform_destroy(instance)
         except Exception as e:
             raise e
 
+    @action(detail=True, methods=['get', 'post'], url_path='reembed', serializer_class=ReembeddingJobSerializer)
+    def reembed(self, request, pk=None):
+        '''
+        Generate a /api/collections/{id}/reembed endpoint to re-embed the documents of a collection
+        into a new Qdrant collection, e.g. with another `embedding_backend` or after a change of chunk size,
+        while the current one keeps answering questions. The collection is switched to the new one once done.
+        POST starts a re-embedding (or resumes the last one if it did not succeed, with `resume`),
+        GET returns the progress of the last one.
+        '''
+        collection = self.get_object()
+        if request.method == 'GET':
+            job = collection.reembedding_jobs.order_by('-created_at').first()
+            if job is None:
+                return Response(
+                    {'detail': 'The collection was never re-embedded.'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            return Response(self.get_serializer(job).data, status=status.HTTP_200_OK)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            if serializer.validated_data['resume']:
+                job = ReembeddingJob.resume(collection)
+            else:
+                job = ReembeddingJob.start(collection, serializer.validated_data.get('embedding_backend'))
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_409_CONFLICT)
+
+        if settings.APP_ENV == 'local':
+            try:
+                ReembeddingJob.run(job.id)
+            except Exception as e:
+                logger.error(f'Re-embedding {job.id} failed. Error: {e}')
+                ReembeddingJob.fail(job.id, str(e))
+            else:
+                ReembeddingJob.collect_garbage(job.id)
+        else:
+            job.task_id = reembed_collection.delay(job.id).id
+            job.save(update_fields=['task_id'])
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class UploadSessionViewSet(
+    mixins.CreateModelMixin,
+    mixins.RetrieveModelMixin,
+    mixins.DestroyModelMixin,
+    viewsets.GenericViewSet,
+):
+    '''
+    Resumable uploads, for large files.
+    1. POST /api/uploads/ with the name, description, collection and size of the document starts an upload.
+    2. PUT /api/uploads/{id}/parts with the bytes of the file as body, starting at the offset given in
+       the Upload-Offset header, appends a part. GET /api/uploads/{id} returns the offset to resume from.
+    3. POST /api/uploads/{id}/complete creates the UnstructuredDocument and submits it for processing.
+    '''
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+
+    def perform_create(self, serializer):
+        '''
+        Create the (empty) file the parts of the upload are appended to.
+        '''
+        file_name = unique_upload_name()
+        path = storage_path(file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+        serializer.save(file_name=file_name)
+
+    def perform_destroy(self, instance):
+        '''
+        Abort an upload, deleting the partial file unless it already became a document's.
+        '''
+        if instance.document_id is None and os.path.exists(instance.path):
+            os.remove(instance.path)
+        return super().perform_destroy(instance)
+
+    @action(detail=True, methods=['put'], url_path='parts')
+    def upload_part(self, request, pk=None):
+        '''
+        Append a part to the file, streaming the request body to disk.
+        The Upload-Offset header must match the offset of the upload, i.e. the number of bytes
+        acknowledged so far: a conflicting offset, or a part sent while another one is being written,
+        is answered with the offset to resume from.
+        The file is locked while the part is written, rather than the row of the upload, which is only updated
+        once the part is written: no transaction is held open for as long as the request body takes to arrive.
+        '''
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return Response(
+                {'detail': 'Upload-Offset header is required.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        upload = self.get_object()
+        with upload_lock(upload.path) as locked:
+            if not locked:
+                return Response(
+                    {'detail': 'Another part of the upload is being written.', 'offset': upload.offset},
+                    status=status.HTTP_409_CONFLICT
+                )
+            # Read the offset acknowledged by the last part written, now that no other part can be.
+            upload.refresh_from_db(fields=['offset', 'document'])
+            if upload.document_id is not None:
+                return Response(
+                    {'detail': 'Upload is already complete.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if offset != upload.offset:
+                return Response(
+                    {'detail': 'Upload-Offset does not match the offset of the upload.', 'offset': upload.offset},
+                    status=status.HTTP_409_CONFLICT
+                )
+
+            sha256 = upload_hasher(str(upload.id), upload.path, offset)
+            written = write_part(upload.path, offset, request.stream, sha256)
+            if upload.size is not None and offset + written > upload.size:
+                # Discard the part, the file would be larger than announced.
+                write_part(upload.path, offset, None, sha256)
+                return Response(
+                    {'detail': 'Part exceeds the size of the upload.', 'offset': offset},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # Acknowledge the part, unless the upload was aborted meanwhile.
+            acknowledged = UploadSession.objects.filter(
+                id=upload.id,
+                offset=offset,
+                document__isnull=True,
+            ).update(offset=offset + written)
+            if not acknowledged:
+                return Response(
+                    {'detail': 'Upload changed while the part was written.'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            upload.offset = offset + written
+            remember_upload_hasher(str(upload.id), upload.offset, sha256)
+
+        return Response(
+            {'offset': upload.offset},
+            status=status.HTTP_200_OK,
+            headers={'Upload-Offset': str(upload.offset)}
+        )
+
+    @action(detail=True, methods=['post'], url_path='complete')
+    def complete(self, request, pk=None):
+        '''
+        Finalize the upload: the file becomes the file of a new UnstructuredDocument,
+        which is submitted for processing.
+        '''
+        upload = self.get_object()
+        with upload_lock(upload.path) as locked:
+            if not locked:
+                return Response(
+                    {'detail': 'A part of the upload is being written.', 'offset': upload.offset},
+                    status=status.HTTP_409_CONFLICT
+                )
+            upload.refresh_from_db(fields=['offset', 'document'])
+            if upload.document_id is not None:
+                return Response(
+                    {'detail': 'Upload is already complete.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if upload.size is not None and upload.offset != upload.size:
+                return Response(
+                    {'detail': 'Upload is incomplete.', 'offset': upload.offset},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # Hash the file before the transaction, as it may have to be read again from disk.
+            sha256 = upload_hasher(str(upload.id), upload.path, upload.offset).hexdigest()
+            with transaction.atomic():
+                udoc = UnstructuredDocument.objects.create(
+                    name=upload.name,
+                    description=upload.description,
+                    collection=upload.collection or DocumentCollection.get_default(),
+                    file=settings.UPLOAD_URL + upload.file_name,
+                    sha256=sha256,
+                )
+                upload.document = udoc
+                upload.save(update_fields=['document'])
+
+        process_document(udoc, upload.file_name)
+        return Response(
+            UnstructuredDocumentSerializer(udoc, context={'request': request}).data,
+            status=status.HTTP_201_CREATED
+        )
+
+
+class ImportJobViewSet(
+    mixins.CreateModelMixin,
+    mixins.RetrieveModelMixin,
+    mixins.ListModelMixin,
+    viewsets.GenericViewSet,
+):
+    '''
+    Bulk imports of documents, e.g. to onboard a collection in one request rather than one per document.
+    - POST /api/imports/ with a zip archive of PDFs as `archive` and/or several files as `files`,
+      and optionally a `collection`, creates all the documents at once and processes them in parallel.
+    - GET /api/imports/{id} returns the progress of the import: documents done, failed and pending,
+      and documents processed per second.
+    '''
+    queryset = ImportJob.objects.all().order_by('-created_at')
+    serializer_class = ImportJobSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        files = request.FILES.getlist('files')
+        archive = request.FILES.get('archive')
+        if not files and archive is None:
+            return Response(
+                {'detail': 'A zip archive (archive) or files (files) are required.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            stored = store_import_files(files, archive, settings.MARTINI_IMPORT_MAX_DOCUMENTS)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not stored:
+            return Response({'detail': 'No PDF found in the archive.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        collection = serializer.validated_data.get('collection') or DocumentCollection.get_default()
+        with transaction.atomic():
+            job = serializer.save(collection=collection, total=len(stored))
+            udocs = UnstructuredDocument.objects.bulk_create([
+                UnstructuredDocument(
+                    name=name,
+                    collection=collection,
+                    file=settings.UPLOAD_URL + file_name,
+                    sha256=sha256,
+                    import_job=job,
+                )
+                for name, file_name, sha256 in stored
+            ])
+
+        _dispatch_import(job, [(udoc, file_name) for udoc, (_, file_name, _) in zip(udocs, stored)])
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data, status=status.HTTP_201_CREATED)
+
+
+class DeletionJobViewSet(
+    mixins.CreateModelMixin,
+    mixins.RetrieveModelMixin,
+    mixins.ListModelMixin,
+    viewsets.GenericViewSet,
+):
+    '''
+    Bulk deletions of documents, e.g. to clean up thousands of documents at once rather than one request
+    (and one task) per document.
+    - POST /api/deletions/ with a list of `document_ids`, and/or a `collection` and/or a `created_before` date,
+      deletes the documents matching all of them: their embeddings, files and rows, by batches.
+      E.g. a `collection` alone purges all its documents, while keeping the collection.
+    - GET /api/deletions/{id} returns the progress of the deletion: documents deleted and pending.
+    '''
+    queryset = DeletionJob.objects.all().order_by('-created_at')
+    serializer_class = DeletionJobSerializer
+
+    def perform_create(self, serializer):
+        job = serializer.save()
+        if job.finished_at is None:
+            _dispatch_deletion(job)
+            job.refresh_from_db()
+
+
+class AsyncDocumentStatusView(View):
+    '''
+    Long-poll version of the /api/documents/status endpoint, with the same parameters and responses:
+    given the `version` of the statuses last received, the request is held until any of them changes,
+    or for at most `timeout` seconds (MARTINI_STATUS_LONG_POLL_TIMEOUT at most).
+    Served through the ASGI application, waiting requests do not hold a worker.
+    '''
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Exempt from CSRF like the API views of DRF, which only enforce it with session authentication,
+        # not used by the API. POST only reads statuses anyway (it takes lists of IDs too long for a query string):
+        # a cross-site request can change nothing.
+        view.csrf_exempt = True
+        return view
+
+    async def get(self, request):
+        return await self._wait(request.GET)
+
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            data = {}
+        return await self._wait(data)
+
+    async def _wait(self, data):
+        try:
+            document_ids, collection_id = parse_status_params(data)
+            version, timeout = parse_long_poll_params(data)
+        except ValueError as e:
+            return JsonResponse({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return JsonResponse(
+            await await_statuses(document_ids, collection_id, version, timeout),
+            status=status.HTTP_200_OK
+        )
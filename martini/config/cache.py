@@ -0,0 +1,230 @@
+import time
+import asyncio
+import logging
+import weakref
+import threading
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    '''
+    Thread-safe in-process cache, evicting the least recently used entries
+    beyond `maxsize` entries, and entries older than `ttl` seconds if specified.
+    '''
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                value, expires_at = entry
+                if expires_at is not None and expires_at < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, mapping: Dict[str, Any]):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            for key, value in mapping.items():
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    '''
+    Cache shared between processes, stored in Redis under a namespace.
+    The number of entries is bounded to `max_entries`: an index of keys sorted by last access
+    is kept alongside the values, and the least recently used entries are evicted beyond the limit.
+    Values expire after `ttl` seconds, and keys not accessed for as long are dropped from the index
+    before it is sized, so that expired entries neither count toward the limit nor accumulate in it.
+    Redis errors are logged and treated as cache misses, a cache never breaks its caller.
+    '''
+
+    def __init__(
+        self,
+        url: str,
+        namespace: str,
+        max_entries: int,
+        ttl: Optional[int] = None,
+        dumps: Callable[[Any], bytes] = None,
+        loads: Callable[[bytes], Any] = None,
+    ):
+        import redis
+
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+        # Async clients are bound to the event loop they were created in.
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dumps = dumps or (lambda value: value)
+        self.loads = loads or (lambda value: value)
+        self._index_key = f'{namespace}:lru'
+
+    def _key(self, key: str) -> str:
+        return f'{self.namespace}:{key}'
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        try:
+            values = self.client.mget([self._key(key) for key in keys])
+            found = {key: self.loads(value) for key, value in zip(keys, values) if value is not None}
+            if found:
+                now = time.time()
+                self.client.zadd(self._index_key, {self._key(key): now for key in found})
+            return found
+        except Exception as e:
+            logger.warning(f'Cache "{self.namespace}" could not be read: {e}')
+            return {}
+
+    def set_many(self, mapping: Dict[str, Any]):
+        if not mapping:
+            return
+
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            self._queue_set_many(pipeline, mapping)
+            size = pipeline.execute()[-1]
+            if size > self.max_entries:
+                self._evict(size - self.max_entries)
+        except Exception as e:
+            logger.warning(f'Cache "{self.namespace}" could not be written: {e}')
+
+    def _queue_set_many(self, pipeline, mapping: Dict[str, Any]):
+        # Queue the writes of `mapping` in a (synchronous or asynchronous) pipeline, ending with the size of the index.
+        now = time.time()
+        for key, value in mapping.items():
+            pipeline.set(self._key(key), self.dumps(value), ex=self.ttl)
+        pipeline.zadd(self._index_key, {self._key(key): now for key in mapping})
+        if self.ttl:
+            # Values are only read back before they expire: keys not accessed for `ttl` seconds are dead.
+            pipeline.zremrangebyscore(self._index_key, '-inf', now - self.ttl)
+        pipeline.zcard(self._index_key)
+
+    def _evict(self, count: int):
+        evicted = [key for key, _ in self.client.zpopmin(self._index_key, count)]
+        if evicted:
+            self.client.delete(*evicted)
+
+    def _async_client(self):
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = redis.asyncio.Redis.from_url(self.url)
+        return client
+
+    async def aget_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        try:
+            client = self._async_client()
+            values = await client.mget([self._key(key) for key in keys])
+            found = {key: self.loads(value) for key, value in zip(keys, values) if value is not None}
+            if found:
+                now = time.time()
+                await client.zadd(self._index_key, {self._key(key): now for key in found})
+            return found
+        except Exception as e:
+            logger.warning(f'Cache "{self.namespace}" could not be read: {e}')
+            return {}
+
+    async def aset_many(self, mapping: Dict[str, Any]):
+        if not mapping:
+            return
+
+        try:
+            client = self._async_client()
+            pipeline = client.pipeline(transaction=False)
+            self._queue_set_many(pipeline, mapping)
+            size = (await pipeline.execute())[-1]
+            if size > self.max_entries:
+                evicted = [key for key, _ in await client.zpopmin(self._index_key, size - self.max_entries)]
+                if evicted:
+                    await client.delete(*evicted)
+        except Exception as e:
+            logger.warning(f'Cache "{self.namespace}" could not be written: {e}')
+
+
+class TwoTierCache:
+    '''
+    In-process LRU cache in front of an optional shared cache.
+    Entries found in the shared tier only are copied to the local tier.
+    Methods prefixed with "a" are the asynchronous counterparts of the others, the local tier
+    being in memory, only the shared tier is accessed asynchronously.
+    '''
+
+    def __init__(self, local: LRUCache, shared: Optional[RedisCache] = None):
+        self.local = local
+        self.shared = shared
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        found = self.local.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing and self.shared is not None:
+            shared_found = self.shared.get_many(missing)
+            self.local.set_many(shared_found)
+            found.update(shared_found)
+        return found
+
+    def set_many(self, mapping: Dict[str, Any]):
+        self.local.set_many(mapping)
+        if self.shared is not None:
+            self.shared.set_many(mapping)
+
+    def get(self, key: str) -> Any:
+        return self.get_many([key]).get(key)
+
+    def set(self, key: str, value: Any):
+        self.set_many({key: value})
+
+    async def aget_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        found = self.local.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing and self.shared is not None:
+            shared_found = await self.shared.aget_many(missing)
+            self.local.set_many(shared_found)
+            found.update(shared_found)
+        return found
+
+    async def aset_many(self, mapping: Dict[str, Any]):
+        self.local.set_many(mapping)
+        if self.shared is not None:
+            await self.shared.aset_many(mapping)
+
+    async def aget(self, key: str) -> Any:
+        return (await self.aget_many([key])).get(key)
+
+    async def aset(self, key: str, value: Any):
+        await self.aset_many({key: value})
@@ -27,6 +27,7 @@ if APP_ENV == 'local':
     # But change the environment variables anyway, in case this is fixed in the future.
     os.environ['CELERY_BROKER_URL'] = os.environ.get('DJ_CELERY_BROKER_URL')
     os.environ['CELERY_RESULT_BACKEND'] = os.environ.get('DJ_CELERY_RESULT_BACKEND')
+    os.environ['CACHE_REDIS_URL'] = os.environ.get('DJ_CACHE_REDIS_URL', '')
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
@@ -150,7 +151,9 @@ UPLOAD_URL = 'static/uploads/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'static', 'uploads')
 
-# Media root from Docker container's perspective.
+# Media root from Docker container's perspective. Outside of local development, stored files are read and written
+# there by every process (see apps.documents.storage.storage_path), so it must be the MEDIA_ROOT of the containers,
+# i.e. BASE_DIR must be /app/martini, where the Dockerfiles copy the app.
 MEDIA_ROOT_DOCKER = '/app/martini/static/uploads'
 
 # Default primary key field type
@@ -172,3 +175,124 @@ REST_FRAMEWORK = {
 MARTINI_DEFAULT_COLLECTION_NAME = 'default'
 MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_SIZE = 500
 MARTINI_DEFAULT_TEXT_SPLITTER_CHUNK_OVERLAP = 50
+# Number of chunks embedded and stored at once during ingestion, and number of such batches
+# processed concurrently. Together, they bound the memory used by the processing of a document,
+# whatever its size.
+MARTINI_EMBEDDING_BATCH_SIZE = int(os.environ.get('MARTINI_EMBEDDING_BATCH_SIZE', 100))
+MARTINI_EMBEDDING_CONCURRENCY = int(os.environ.get('MARTINI_EMBEDDING_CONCURRENCY', 4))
+
+# Caches shared between workers are stored in this Redis database. Leave empty to only cache in-process.
+MARTINI_CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+# Maximum number of embeddings cached in-process, and in Redis.
+MARTINI_EMBEDDING_CACHE_LOCAL_SIZE = int(os.environ.get('MARTINI_EMBEDDING_CACHE_LOCAL_SIZE', 2000))
+MARTINI_EMBEDDING_CACHE_SHARED_SIZE = int(os.environ.get('MARTINI_EMBEDDING_CACHE_SHARED_SIZE', 200000))
+# Maximum number of query embeddings cached in-process and in Redis, and for how long (in seconds).
+MARTINI_QUERY_CACHE_LOCAL_SIZE = int(os.environ.get('MARTINI_QUERY_CACHE_LOCAL_SIZE', 1000))
+MARTINI_QUERY_CACHE_SHARED_SIZE = int(os.environ.get('MARTINI_QUERY_CACHE_SHARED_SIZE', 50000))
+MARTINI_QUERY_CACHE_TTL = int(os.environ.get('MARTINI_QUERY_CACHE_TTL', 24 * 60 * 60))
+# Maximum number of answers cached in-process and in Redis, and for how long (in seconds).
+# Answers are invalidated anyway when the content of their collection changes.
+MARTINI_ANSWER_CACHE_LOCAL_SIZE = int(os.environ.get('MARTINI_ANSWER_CACHE_LOCAL_SIZE', 1000))
+MARTINI_ANSWER_CACHE_SHARED_SIZE = int(os.environ.get('MARTINI_ANSWER_CACHE_SHARED_SIZE', 50000))
+MARTINI_ANSWER_CACHE_TTL = int(os.environ.get('MARTINI_ANSWER_CACHE_TTL', 24 * 60 * 60))
+
+# Transport to Qdrant: gRPC is faster than REST for large upserts and searches.
+MARTINI_QDRANT_PREFER_GRPC = os.environ.get('MARTINI_QDRANT_PREFER_GRPC', 'false').lower() in ('1', 'true', 'yes')
+MARTINI_QDRANT_GRPC_PORT = int(os.environ.get('MARTINI_QDRANT_GRPC_PORT', 6334))
+# Timeout of requests to Qdrant (in seconds), and number of connections kept open to it by each process.
+MARTINI_QDRANT_TIMEOUT = int(os.environ.get('MARTINI_QDRANT_TIMEOUT', 30))
+MARTINI_QDRANT_POOL_SIZE = int(os.environ.get('MARTINI_QDRANT_POOL_SIZE', 16))
+# Points sent to Qdrant per upsert request, and number of such requests sent in parallel.
+MARTINI_QDRANT_UPSERT_BATCH_SIZE = int(os.environ.get('MARTINI_QDRANT_UPSERT_BATCH_SIZE', 256))
+MARTINI_QDRANT_UPSERT_PARALLEL = int(os.environ.get('MARTINI_QDRANT_UPSERT_PARALLEL', 4))
+
+# Number of chunks retrieved to answer a question, whatever the number of collections searched,
+# and maximum number of tokens of the LLM they are packed into (overlaps between chunks removed).
+MARTINI_RETRIEVAL_K = int(os.environ.get('MARTINI_RETRIEVAL_K', 4))
+MARTINI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('MARTINI_CONTEXT_TOKEN_BUDGET', 2000))
+
+# Re-ranking of retrieved chunks, when requested: number of candidates fetched from each collection
+# (and its maximum), trade-off between relevance (1) and diversity (0) of the chunks,
+# and cosine similarity above which chunks are considered near-duplicates.
+MARTINI_RERANK_CANDIDATES = int(os.environ.get('MARTINI_RERANK_CANDIDATES', 20))
+MARTINI_RERANK_MAX_CANDIDATES = int(os.environ.get('MARTINI_RERANK_MAX_CANDIDATES', 100))
+MARTINI_RERANK_MMR_LAMBDA = float(os.environ.get('MARTINI_RERANK_MMR_LAMBDA', 0.5))
+MARTINI_RERANK_DEDUP_THRESHOLD = float(os.environ.get('MARTINI_RERANK_DEDUP_THRESHOLD', 0.95))
+
+# Local ONNX embedding backend: paths to the exported model and to its tokenizer.json, name used in cache keys
+# (the directory of the model by default), chunks embedded per batch and threads used by inference.
+MARTINI_ONNX_EMBEDDING_MODEL_PATH = os.environ.get('MARTINI_ONNX_EMBEDDING_MODEL_PATH')
+MARTINI_ONNX_EMBEDDING_TOKENIZER_PATH = os.environ.get('MARTINI_ONNX_EMBEDDING_TOKENIZER_PATH')
+MARTINI_ONNX_EMBEDDING_MODEL_NAME = os.environ.get('MARTINI_ONNX_EMBEDDING_MODEL_NAME')
+MARTINI_ONNX_EMBEDDING_BATCH_SIZE = int(os.environ.get('MARTINI_ONNX_EMBEDDING_BATCH_SIZE', 32))
+MARTINI_ONNX_EMBEDDING_THREADS = int(os.environ.get('MARTINI_ONNX_EMBEDDING_THREADS', 0)) or None
+# Dimension of the vectors of the hashing embedding backend.
+MARTINI_HASHING_EMBEDDING_DIMENSION = int(os.environ.get('MARTINI_HASHING_EMBEDDING_DIMENSION', 384))
+
+# Where embeddings are stored: "qdrant", or "local" to keep each collection in memory-mapped files
+# under MARTINI_LOCAL_VECTORSTORE_PATH, searched exhaustively in-process. The local store needs no
+# external service, for small deployments and CI; processes must share the same directory.
+MARTINI_VECTORSTORE_BACKEND = os.environ.get('MARTINI_VECTORSTORE_BACKEND', 'qdrant')
+MARTINI_LOCAL_VECTORSTORE_PATH = os.environ.get('MARTINI_LOCAL_VECTORSTORE_PATH', os.path.join(BASE_DIR, 'vectorstore'))
+
+# Maximum number of documents of a bulk import (files uploaded at once, or PDFs of a zip archive).
+MARTINI_IMPORT_MAX_DOCUMENTS = int(os.environ.get('MARTINI_IMPORT_MAX_DOCUMENTS', 5000))
+# Django rejects requests with more than 100 files by default: allow bulk imports of files.
+DATA_UPLOAD_MAX_NUMBER_FILES = MARTINI_IMPORT_MAX_DOCUMENTS
+
+# Documents deleted at once by a bulk deletion: one Qdrant filter deletion and one query per batch.
+MARTINI_DELETION_BATCH_SIZE = int(os.environ.get('MARTINI_DELETION_BATCH_SIZE', 1000))
+
+# Text extraction of large PDFs: documents with at least MARTINI_PDF_PARALLEL_MIN_PAGES pages are extracted
+# by MARTINI_PDF_EXTRACTION_WORKERS processes (the number of CPUs by default, 1 to disable),
+# in ranges of MARTINI_PDF_PAGES_PER_TASK pages.
+MARTINI_PDF_PARALLEL_MIN_PAGES = int(os.environ.get('MARTINI_PDF_PARALLEL_MIN_PAGES', 100))
+MARTINI_PDF_EXTRACTION_WORKERS = int(os.environ.get('MARTINI_PDF_EXTRACTION_WORKERS', 0)) or os.cpu_count() or 1
+MARTINI_PDF_PAGES_PER_TASK = int(os.environ.get('MARTINI_PDF_PAGES_PER_TASK', 20))
+
+# Re-embedding of collections into a new Qdrant collection (see ReembeddingJob): pause between documents
+# (in seconds) and batches of chunks embedded concurrently, to throttle it next to the processing of new documents,
+# and delay (in seconds) before deleting the previous Qdrant collection, for searches started before the switch.
+MARTINI_REEMBEDDING_PAUSE = float(os.environ.get('MARTINI_REEMBEDDING_PAUSE', 0.5))
+MARTINI_REEMBEDDING_CONCURRENCY = int(os.environ.get('MARTINI_REEMBEDDING_CONCURRENCY', 1))
+MARTINI_REEMBEDDING_GRACE_PERIOD = int(os.environ.get('MARTINI_REEMBEDDING_GRACE_PERIOD', 60))
+
+# Minimum delay (in seconds) between two writes of the progress of the processing of a document to its row.
+MARTINI_PROGRESS_UPDATE_INTERVAL = float(os.environ.get('MARTINI_PROGRESS_UPDATE_INTERVAL', 1.0))
+
+# Status of many documents at once: maximum number of documents per request, and long-polling of their changes,
+# i.e. maximum time (in seconds) a request waits for a change, and delay (in seconds) between two reads meanwhile,
+# doubled after each read without change up to MARTINI_STATUS_LONG_POLL_MAX_INTERVAL: as the async ORM runs
+# queries one at a time per process, idle clients must not take turns with the others every second.
+MARTINI_STATUS_MAX_DOCUMENTS = int(os.environ.get('MARTINI_STATUS_MAX_DOCUMENTS', 1000))
+MARTINI_STATUS_LONG_POLL_TIMEOUT = float(os.environ.get('MARTINI_STATUS_LONG_POLL_TIMEOUT', 30))
+MARTINI_STATUS_LONG_POLL_INTERVAL = float(os.environ.get('MARTINI_STATUS_LONG_POLL_INTERVAL', 1.0))
+MARTINI_STATUS_LONG_POLL_MAX_INTERVAL = float(os.environ.get('MARTINI_STATUS_LONG_POLL_MAX_INTERVAL', 5.0))
+
+# Documents are processed by a chain of Celery tasks, one per stage (see apps.documents.pipeline):
+# extraction and chunking on MARTINI_INGESTION_CPU_QUEUE, for solo workers (which can extract large documents
+# with a pool of processes, see MARTINI_PDF_EXTRACTION_WORKERS),
+# embedding and upserting on MARTINI_INGESTION_IO_QUEUE, for workers with many threads.
+# Stages hand their output over through files in MARTINI_INGESTION_SPOOL_DIR (a directory of the media directory
+# by default), which must be shared by both kinds of workers.
+MARTINI_INGESTION_CPU_QUEUE = os.environ.get('MARTINI_INGESTION_CPU_QUEUE', 'ingestion-cpu')
+MARTINI_INGESTION_IO_QUEUE = os.environ.get('MARTINI_INGESTION_IO_QUEUE', 'ingestion-io')
+MARTINI_INGESTION_SPOOL_DIR = os.environ.get('MARTINI_INGESTION_SPOOL_DIR')
+# Documents are processed with a priority depending on their size, from 0 for documents smaller than
+# MARTINI_INGESTION_PRIORITY_BASE_SIZE (in bytes) to 9, one step each time the size doubles.
+MARTINI_INGESTION_PRIORITY_BASE_SIZE = int(os.environ.get('MARTINI_INGESTION_PRIORITY_BASE_SIZE', 512 * 1024))
+
+CELERY_TASK_ROUTES = {
+    'apps.documents.tasks.extract_pages': {'queue': MARTINI_INGESTION_CPU_QUEUE},
+    'apps.documents.tasks.chunk_pages': {'queue': MARTINI_INGESTION_CPU_QUEUE},
+    'apps.documents.tasks.embed_chunks': {'queue': MARTINI_INGESTION_IO_QUEUE},
+    'apps.documents.tasks.upsert_chunks': {'queue': MARTINI_INGESTION_IO_QUEUE},
+}
+# Priorities with the Redis broker: one list per priority, 0 being the highest, consumed in order.
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+# Workers only reserve a task per process (or thread), so that tasks wait in the broker, in order of priority.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
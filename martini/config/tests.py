@@ -0,0 +1,58 @@
+import asyncio
+
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from config.cache import RedisCache
+
+
+class RedisCacheTest(SimpleTestCase):
+    def cache(self, size, ttl=60):
+        with mock.patch('redis.Redis.from_url') as from_url:
+            cache = RedisCache('redis://cache', 'answers', max_entries=2, ttl=ttl)
+        client = from_url.return_value
+        pipeline = client.pipeline.return_value
+        pipeline.execute.return_value = [True, True, 1, 0, size]
+        client.zpopmin.return_value = [(b'answers:old', 1.0)]
+        return cache, client, pipeline
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_keys_not_accessed_within_the_ttl_are_dropped_before_sizing_the_index(self, _):
+        cache, client, pipeline = self.cache(size=2)
+
+        cache.set_many({'a': b'1'})
+
+        self.assertEqual([call[0] for call in pipeline.method_calls[-3:]], ['zremrangebyscore', 'zcard', 'execute'])
+        pipeline.set.assert_called_once_with('answers:a', b'1', ex=60)
+        pipeline.zremrangebyscore.assert_called_once_with('answers:lru', '-inf', 940.0)
+        client.zpopmin.assert_not_called()
+
+    def test_least_recently_used_entries_are_evicted_beyond_the_limit(self):
+        cache, client, pipeline = self.cache(size=3)
+
+        cache.set_many({'a': b'1'})
+
+        client.zpopmin.assert_called_once_with('answers:lru', 1)
+        client.delete.assert_called_once_with(b'answers:old')
+
+    def test_index_is_not_pruned_without_ttl(self):
+        cache, client, pipeline = self.cache(size=2, ttl=None)
+
+        cache.set_many({'a': b'1'})
+
+        pipeline.zremrangebyscore.assert_not_called()
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_asynchronous_writes_prune_and_evict_alike(self, _):
+        cache, _, _ = self.cache(size=3)
+        client = mock.MagicMock(zpopmin=mock.AsyncMock(return_value=[(b'answers:old', 1.0)]), delete=mock.AsyncMock())
+        pipeline = client.pipeline.return_value
+        pipeline.execute = mock.AsyncMock(return_value=[True, 1, 0, 3])
+
+        with mock.patch('redis.asyncio.Redis.from_url', return_value=client):
+            asyncio.run(cache.aset_many({'a': b'1'}))
+
+        pipeline.zremrangebyscore.assert_called_once_with('answers:lru', '-inf', 940.0)
+        client.zpopmin.assert_awaited_once_with('answers:lru', 1)
+        client.delete.assert_awaited_once_with(b'answers:old')
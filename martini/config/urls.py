@@ -25,10 +25,14 @@ from rest_framework.routers import DefaultRouter
 
 from apps.documents.views import (
     UnstructuredDocumentViewSet,
-    DocumentCollectionViewSet
+    DocumentCollectionViewSet,
+    ImportJobViewSet,
+    DeletionJobViewSet,
+    UploadSessionViewSet,
+    AsyncDocumentStatusView,
 )
 
-from apps.chats.views import MessageViewSet
+from apps.chats.views import MessageViewSet, AsyncMessageView
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -46,6 +50,9 @@ schema_view = get_schema_view(
 router = DefaultRouter()
 router.register(r'documents', UnstructuredDocumentViewSet)
 router.register(r'collections', DocumentCollectionViewSet)
+router.register(r'uploads', UploadSessionViewSet)
+router.register(r'imports', ImportJobViewSet)
+router.register(r'deletions', DeletionJobViewSet)
 router.register(r'messages', MessageViewSet, basename='message')
 
 urlpatterns = [
@@ -53,6 +60,8 @@ urlpatterns = [
 
     path('api-auth/', include('rest_framework.urls')),
 
+    path('api/messages/async/', AsyncMessageView.as_view(), name='message-async'),
+    path('api/documents/status/wait/', AsyncDocumentStatusView.as_view(), name='document-status-wait'),
     path('api/', include(router.urls)),
 
     re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),